@@ -128,7 +128,7 @@ class SubMaster:
 
     for s in services:
       p = self.poller if s not in self.non_polled_services else None
-      self.sock[s] = sub_sock(s, poller=p, addr=addr, conflate=True)
+      self.sock[s] = self._sub_sock(s, p, addr)
 
       try:
         data = new_message(s)
@@ -155,6 +155,9 @@ class SubMaster:
       self.min_freq[s] = min_freq*0.8
       self.recv_dts[s] = deque(maxlen=int(10*freq))
 
+  def _sub_sock(self, s: str, poller: Optional[Poller], addr: str) -> SubSocket:
+    return sub_sock(s, poller=poller, addr=addr, conflate=True)
+
   def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
     return self.data[s]
 
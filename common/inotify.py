@@ -0,0 +1,87 @@
+"""Minimal inotify bindings, for watching directories without polling them."""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from typing import NamedTuple
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+  wd: int
+  mask: int
+  cookie: int
+  name: str
+
+
+class Inotify:
+  def __init__(self):
+    libc_name = ctypes.util.find_library("c")
+    self.libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(self.libc, "inotify_init1"):
+      raise OSError("inotify is not supported on this platform")
+
+    self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
+
+  def close(self) -> None:
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+    if wd < 0:
+      errno = ctypes.get_errno()
+      raise OSError(errno, os.strerror(errno), path)
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    self.libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout: float = 0) -> list[InotifyEvent]:
+    """Returns the pending events, waiting up to timeout seconds for the first one."""
+    events: list[InotifyEvent] = []
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return events
+
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        break
+
+      offset = 0
+      while offset < len(buf):
+        wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, offset)
+        offset += EVENT_HEADER.size
+        name = buf[offset:offset + name_len].rstrip(b"\0").decode(errors="replace")
+        offset += name_len
+        events.append(InotifyEvent(wd, mask, cookie, name))
+    return events
@@ -2,6 +2,8 @@
 import capnp
 import os
 import time
+import typing
+from collections.abc import Callable
 from typing import Any
 
 import cereal.messaging as messaging
@@ -66,63 +68,148 @@ def is_dataclass(obj):
   return hasattr(obj, _FIELDS)
 
 
-def asdictref(obj) -> dict[str, Any]:
+# how a field is copied between a dataclass and a capnp struct
+_VALUE, _ENUM, _LIST, _STRUCT, _STRUCT_LIST, _UNION = range(6)
+
+
+def _field_kind(field: capnp.lib.capnp._StructSchemaField) -> int:
+  if field.proto.which() == 'group':
+    return _UNION
+  field_type = field.proto.slot.type
+  which = field_type.which()
+  if which == 'struct':
+    return _STRUCT
+  elif which == 'list':
+    return _STRUCT_LIST if field_type.list.elementType.which() == 'struct' else _LIST
+  elif which == 'enum':
+    return _ENUM
+  return _VALUE
+
+
+_writers: dict[tuple[type, int], Callable[[Any, capnp.lib.capnp._DynamicStructBuilder], None]] = {}
+_readers: dict[tuple[type, int], Callable[[capnp.lib.capnp._DynamicStructReader], Any]] = {}
+
+
+def get_capnp_writer(cls: type, schema) -> Callable[[Any, capnp.lib.capnp._DynamicStructBuilder], None]:
   """
-  Similar to dataclasses.asdict without recursive type checking and copy.deepcopy
-  Note that the resulting dict will contain references to the original struct as a result
+  Returns a function copying the fields of a dataclass into a capnp builder, walking the fields from the schema
+  and the type hints once per dataclass type instead of building a dict of the struct for every message
   """
-  if not is_dataclass(obj):
-    raise TypeError("asdictref() should be called on dataclass instances")
-
-  def _asdictref_inner(obj) -> dict[str, Any] | Any:
-    if is_dataclass(obj):
-      ret = {}
-      for field in getattr(obj, _FIELDS):  # similar to dataclasses.fields()
-        ret[field] = _asdictref_inner(getattr(obj, field))
-      return ret
-    elif isinstance(obj, (tuple, list)):
-      return type(obj)(_asdictref_inner(v) for v in obj)
+  key = (cls, schema.node.id)
+  if key in _writers:
+    return _writers[key]
+
+  hints = typing.get_type_hints(cls)
+  fields: list[tuple[str, int, Any]] = []
+  for name in getattr(cls, _FIELDS):
+    field = schema.fields[name]
+    kind = _field_kind(field)
+    if kind == _STRUCT:
+      fields.append((name, kind, get_capnp_writer(hints[name], field.schema)))
+    elif kind == _STRUCT_LIST:
+      fields.append((name, kind, get_capnp_writer(typing.get_args(hints[name])[0], field.schema.elementType)))
+    elif kind == _UNION:
+      # writers of the struct members, other members are set directly
+      member_hints = typing.get_type_hints(hints[name])
+      members = {}
+      for member_name in field.schema.union_fields:
+        member_field = field.schema.fields[member_name]
+        if member_name in member_hints and _field_kind(member_field) == _STRUCT:
+          members[member_name] = get_capnp_writer(member_hints[member_name], member_field.schema)
+      fields.append((name, kind, members))
     else:
-      return obj
-
-  return _asdictref_inner(obj)
+      fields.append((name, kind, None))
+
+  def write(obj, builder: capnp.lib.capnp._DynamicStructBuilder) -> None:
+    for name, kind, write_field in fields:
+      value = getattr(obj, name)
+      if kind == _STRUCT:
+        write_field(value, getattr(builder, name))
+      elif kind == _STRUCT_LIST:
+        values = builder.init(name, len(value))
+        for i, v in enumerate(value):
+          write_field(v, values[i])
+      elif kind == _UNION:
+        # only the set member of a union is written, like CarParams.lateralTuning
+        which = value.which()
+        member = getattr(value, which)
+        if which in write_field:
+          write_field[which](member, getattr(builder, name).init(which))
+        else:
+          setattr(getattr(builder, name), which, member)
+      else:
+        setattr(builder, name, value)
+
+  _writers[key] = write
+  return write
+
+
+def get_capnp_reader(cls: type, schema) -> Callable[[capnp.lib.capnp._DynamicStructReader], Any]:
+  """
+  Returns a function building a dataclass from a capnp reader, the reverse of get_capnp_writer.
+  Fields only in the schema, like deprecated ones, are skipped.
+  """
+  key = (cls, schema.node.id)
+  if key in _readers:
+    return _readers[key]
+
+  hints = typing.get_type_hints(cls)
+  fields = []
+  for name in getattr(cls, _FIELDS):
+    if name not in schema.fields:
+      continue
+    field = schema.fields[name]
+    kind = _field_kind(field)
+    if kind == _STRUCT:
+      fields.append((name, kind, get_capnp_reader(hints[name], field.schema)))
+    elif kind == _STRUCT_LIST:
+      fields.append((name, kind, get_capnp_reader(typing.get_args(hints[name])[0], field.schema.elementType)))
+    elif kind == _UNION:
+      raise TypeError(f"Reading unions is not supported: {cls.__name__}.{name}")
+    else:
+      fields.append((name, kind, None))
+
+  def read(reader: capnp.lib.capnp._DynamicStructReader):
+    obj = cls()
+    for name, kind, read_field in fields:
+      value = getattr(reader, name)
+      if kind == _STRUCT:
+        value = read_field(value)
+      elif kind == _STRUCT_LIST:
+        value = [read_field(v) for v in value]
+      elif kind == _LIST:
+        value = list(value)
+      elif kind == _ENUM:
+        value = str(value)
+      setattr(obj, name, value)
+    return obj
+
+  _readers[key] = read
+  return read
+
+
+CAPNP_STRUCTS = {
+  structs.CarParams: car.CarParams,
+  structs.CarState: car.CarState,
+  structs.CarControl.Actuators: car.CarControl.Actuators,
+}
+for _cls, _capnp_cls in CAPNP_STRUCTS.items():
+  get_capnp_writer(_cls, _capnp_cls.schema)
+_read_carControl = get_capnp_reader(structs.CarControl, car.CarControl.schema)
 
 
 def convert_to_capnp(struct: structs.CarParams | structs.CarState | structs.CarControl.Actuators) -> capnp.lib.capnp._DynamicStructBuilder:
-  struct_dict = asdictref(struct)
-
-  if isinstance(struct, structs.CarParams):
-    del struct_dict['lateralTuning']
-    struct_capnp = car.CarParams.new_message(**struct_dict)
-
-    # this is the only union, special handling
-    which = struct.lateralTuning.which()
-    struct_capnp.lateralTuning.init(which)
-    lateralTuning_dict = asdictref(getattr(struct.lateralTuning, which))
-    setattr(struct_capnp.lateralTuning, which, lateralTuning_dict)
-  elif isinstance(struct, structs.CarState):
-    struct_capnp = car.CarState.new_message(**struct_dict)
-  elif isinstance(struct, structs.CarControl.Actuators):
-    struct_capnp = car.CarControl.Actuators.new_message(**struct_dict)
-  else:
+  capnp_cls = CAPNP_STRUCTS.get(type(struct))
+  if capnp_cls is None:
     raise ValueError(f"Unsupported struct type: {type(struct)}")
 
+  struct_capnp = capnp_cls.new_message()
+  get_capnp_writer(type(struct), capnp_cls.schema)(struct, struct_capnp)
   return struct_capnp
 
 
 def convert_carControl(struct: capnp.lib.capnp._DynamicStructReader) -> structs.CarControl:
-  # TODO: recursively handle any car struct as needed
-  def remove_deprecated(s: dict) -> dict:
-    return {k: v for k, v in s.items() if not k.endswith('DEPRECATED')}
-
-  struct_dict = struct.to_dict()
-  struct_dataclass = structs.CarControl(**remove_deprecated({k: v for k, v in struct_dict.items() if not isinstance(k, dict)}))
-
-  struct_dataclass.actuators = structs.CarControl.Actuators(**remove_deprecated(struct_dict.get('actuators', {})))
-  struct_dataclass.cruiseControl = structs.CarControl.CruiseControl(**remove_deprecated(struct_dict.get('cruiseControl', {})))
-  struct_dataclass.hudControl = structs.CarControl.HUDControl(**remove_deprecated(struct_dict.get('hudControl', {})))
-
-  return struct_dataclass
+  return _read_carControl(struct)
 
 
 class Car:
@@ -0,0 +1,50 @@
+import dataclasses
+import hypothesis.strategies as st
+from hypothesis import given, settings
+
+from cereal import car
+from opendbc.car import structs
+from opendbc.car.car_helpers import interfaces
+from openpilot.selfdrive.car.card import convert_carControl, convert_to_capnp
+from openpilot.selfdrive.test.fuzzy_generation import DrawType, FuzzyGenerator
+
+
+def check_dataclass(obj, reader):
+  for name in obj.__dataclass_fields__:
+    value, expected = getattr(obj, name), getattr(reader, name)
+    if dataclasses.is_dataclass(value):
+      check_dataclass(value, expected)
+    elif isinstance(value, list):
+      assert value == list(expected), name
+    else:
+      assert value == expected, name
+
+
+class TestCard:
+  def test_convert_carParams(self):
+    # same message as built from a dict of the struct
+    for car_name, CarInterface in sorted(interfaces.items()):
+      CP = CarInterface.get_non_essential_params(car_name)
+      CP_dict = dataclasses.asdict(CP)
+      del CP_dict['lateralTuning']
+      expected = car.CarParams.new_message(**CP_dict)
+      which = CP.lateralTuning.which()
+      expected.lateralTuning.init(which)
+      setattr(expected.lateralTuning, which, dataclasses.asdict(getattr(CP.lateralTuning, which)))
+
+      assert convert_to_capnp(CP).to_bytes() == expected.to_bytes(), car_name
+
+  def test_convert_carState(self):
+    CS = structs.CarState(vEgo=10., gearShifter=structs.CarState.GearShifter.drive)
+    CS.wheelSpeeds.fl = 9.
+    CS.buttonEvents = [structs.CarState.ButtonEvent(pressed=True, type=structs.CarState.ButtonEvent.Type.accelCruise)]
+
+    expected = car.CarState.new_message(**dataclasses.asdict(CS))
+    assert convert_to_capnp(CS).to_bytes() == expected.to_bytes()
+
+  @settings(max_examples=100, deadline=None)
+  @given(data=st.data())
+  def test_convert_carControl(self, data):
+    draw: DrawType = data.draw
+    CC = car.CarControl.new_message(**FuzzyGenerator.get_random_msg(draw, car.CarControl, real_floats=True)).as_reader()
+    check_dataclass(convert_carControl(CC), CC)
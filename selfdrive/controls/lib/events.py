@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
-import bisect
 import math
 import os
 from enum import IntEnum
 from collections.abc import Callable
 
+import numpy as np
+
 from cereal import log, car
 import cereal.messaging as messaging
 from openpilot.common.conversions import Conversions as CV
@@ -45,39 +46,65 @@ class ET:
 
 # get event name from enum
 EVENT_NAME = {v: k for k, v in EventName.schema.enumerants.items()}
+NUM_EVENTS = max(EVENT_NAME) + 1
 
 
 class Events:
+  """
+  Events are counted in arrays indexed by event name, so adding, clearing and checking for event types don't
+  scan lists. Names, event type checks and the message are cached until the events change.
+  """
   def __init__(self):
-    self.events: list[int] = []
-    self.static_events: list[int] = []
-    self.event_counters = dict.fromkeys(EVENTS.keys(), 0)
+    # times each event was added
+    self.counts = np.zeros(NUM_EVENTS, dtype=np.int32)
+    self.static_counts = np.zeros(NUM_EVENTS, dtype=np.int32)
+    # cycles each event has been active for
+    self.event_counters = np.zeros(NUM_EVENTS, dtype=np.int64)
+
+    self._cache_key = b''
+    self._cache: dict = {}
+
+  def _cached(self) -> dict:
+    key = self.counts.tobytes()
+    if key != self._cache_key:
+      self._cache_key = key
+      self._cache = {}
+    return self._cache
 
   @property
   def names(self) -> list[int]:
-    return self.events
+    cache = self._cached()
+    if 'names' not in cache:
+      active = np.flatnonzero(self.counts)
+      cache['names'] = np.repeat(active, self.counts[active]).tolist()
+    return cache['names']
 
   def __len__(self) -> int:
-    return len(self.events)
+    return len(self.names)
 
   def add(self, event_name: int, static: bool=False) -> None:
     if static:
-      bisect.insort(self.static_events, event_name)
-    bisect.insort(self.events, event_name)
+      self.static_counts[event_name] += 1
+    self.counts[event_name] += 1
 
   def clear(self) -> None:
-    self.event_counters = {k: (v + 1 if k in self.events else 0) for k, v in self.event_counters.items()}
-    self.events = self.static_events.copy()
+    self.event_counters = np.where(self.counts > 0, self.event_counters + 1, 0)
+    np.copyto(self.counts, self.static_counts)
 
   def contains(self, event_type: str) -> bool:
-    return any(event_type in EVENTS.get(e, {}) for e in self.events)
+    cache = self._cached()
+    key = ('contains', event_type)
+    if key not in cache:
+      mask = EVENT_TYPE_MASKS.get(event_type)
+      cache[key] = mask is not None and bool(np.any(self.counts[mask]))
+    return cache[key]
 
   def create_alerts(self, event_types: list[str], callback_args=None):
     if callback_args is None:
       callback_args = []
 
     ret = []
-    for e in self.events:
+    for e in self.names:
       types = EVENTS[e].keys()
       for et in event_types:
         if et in types:
@@ -93,17 +120,20 @@ class Events:
 
   def add_from_msg(self, events):
     for e in events:
-      bisect.insort(self.events, e.name.raw)
+      self.counts[e.name.raw] += 1
 
   def to_msg(self):
-    ret = []
-    for event_name in self.events:
-      event = car.CarEvent.new_message()
-      event.name = event_name
-      for event_type in EVENTS.get(event_name, {}):
-        setattr(event, event_type, True)
-      ret.append(event)
-    return ret
+    cache = self._cached()
+    if 'msg' not in cache:
+      ret = []
+      for event_name in self.names:
+        event = car.CarEvent.new_message()
+        event.name = event_name
+        for event_type in EVENTS.get(event_name, {}):
+          setattr(event, event_type, True)
+        ret.append(event)
+      cache['msg'] = ret
+    return cache['msg']
 
 
 class Alert:
@@ -959,6 +989,10 @@ EVENTS: dict[int, dict[str, Alert | AlertCallbackType]] = {
 
 }
 
+# events with an alert for each event type
+EVENT_TYPE_MASKS = {et: np.array([et in EVENTS.get(e, {}) for e in range(NUM_EVENTS)])
+                    for k, et in vars(ET).items() if not k.startswith('_')}
+
 
 if __name__ == '__main__':
   # print all alerts by type and priority
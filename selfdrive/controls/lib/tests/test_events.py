@@ -0,0 +1,53 @@
+from cereal import car
+from openpilot.selfdrive.controls.lib.events import ET, EVENTS, Events, EventName
+
+
+class TestEvents:
+  def test_names(self):
+    events = Events()
+    events.add(EventName.pcmEnable)
+    events.add(EventName.buttonCancel, static=True)
+    events.add(EventName.pcmEnable)
+    # sorted, and events added twice are kept twice
+    assert events.names == sorted([EventName.pcmEnable, EventName.pcmEnable, EventName.buttonCancel])
+    assert len(events) == 3
+
+    events.clear()
+    assert events.names == [EventName.buttonCancel]
+
+    msg = car.CarEvent.new_message(name=EventName.doorOpen)
+    events.add_from_msg([msg, msg])
+    assert events.names == sorted([EventName.buttonCancel, EventName.doorOpen, EventName.doorOpen])
+
+  def test_contains(self):
+    events = Events()
+    for event_name, alerts in EVENTS.items():
+      events.clear()
+      events.add(event_name)
+      for et in vars(ET).values():
+        if isinstance(et, str) and not et.startswith('_'):
+          assert events.contains(et) == (et in alerts)
+
+  def test_counters(self):
+    events = Events()
+    for _ in range(3):
+      events.clear()
+      events.add(EventName.doorOpen)
+    assert events.event_counters[EventName.doorOpen] == 2
+    events.clear()
+    events.clear()
+    assert events.event_counters[EventName.doorOpen] == 0
+
+  def test_to_msg(self):
+    events = Events()
+    events.add(EventName.doorOpen)
+    msg = events.to_msg()
+    assert [e.name for e in msg] == ['doorOpen']
+    assert msg[0].noEntry and msg[0].softDisable
+
+    # the same events give the same message, until they change
+    events.clear()
+    events.add(EventName.doorOpen)
+    assert events.to_msg() is msg
+    events.add(EventName.seatbeltNotLatched)
+    assert [e.name for e in events.to_msg()] == ['doorOpen', 'seatbeltNotLatched']
@@ -7,6 +7,14 @@ from openpilot.selfdrive.controls.lib.longitudinal_planner import LongitudinalPl
 import cereal.messaging as messaging
 
 
+def plannerd_step(sm: messaging.SubMaster, pm: messaging.PubMaster, longitudinal_planner: LongitudinalPlanner) -> None:
+  # one iteration of the main loop, also run by the in-process replay
+  sm.update()
+  if sm.updated['modelV2']:
+    longitudinal_planner.update(sm)
+    longitudinal_planner.publish(sm, pm)
+
+
 def plannerd_thread():
   config_realtime_process(5, Priority.CTRL_LOW)
 
@@ -21,10 +29,7 @@ def plannerd_thread():
                            poll='modelV2', ignore_avg_freq=['radarState'])
 
   while True:
-    sm.update()
-    if sm.updated['modelV2']:
-      longitudinal_planner.update(sm)
-      longitudinal_planner.publish(sm, pm)
+    plannerd_step(sm, pm, longitudinal_planner)
 
 
 def main():
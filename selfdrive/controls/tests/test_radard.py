@@ -0,0 +1,50 @@
+import random
+
+from openpilot.common.simple_kalman import KF1D
+from openpilot.selfdrive.controls.radard import _LEAD_ACCEL_TAU, KalmanParams, TrackBank
+
+
+class ScalarTrack:
+  """One Kalman filter per track, as radard used to keep them"""
+  def __init__(self, v_lead: float, kalman_params: KalmanParams):
+    self.kf = KF1D([[v_lead], [0.0]], kalman_params.A, kalman_params.C, kalman_params.K)
+    self.cnt = 0
+    self.aLeadTau = _LEAD_ACCEL_TAU
+
+  def update(self, v_lead: float):
+    if self.cnt > 0:
+      self.kf.update(v_lead)
+    self.vLeadK, self.aLeadK = self.kf.x0_0, self.kf.x1_0
+    if abs(self.aLeadK) < 0.5:
+      self.aLeadTau = _LEAD_ACCEL_TAU
+    else:
+      self.aLeadTau *= 0.9
+    self.cnt += 1
+
+
+class TestTrackBank:
+  def test_matches_scalar_tracks(self):
+    random.seed(0)
+    kalman_params = KalmanParams(0.05)
+    bank = TrackBank(kalman_params)
+    tracks: dict[int, ScalarTrack] = {}
+
+    for _ in range(500):
+      # tracks come and go, and their speed changes quickly enough to learn an acceleration
+      ids = random.sample(range(48), random.randint(0, 32))
+      ar_pts = {tid: [random.uniform(0, 150), random.uniform(-5, 5), random.uniform(-20, 20), 1.] for tid in ids}
+      v_ego = random.uniform(0, 30)
+      bank.update(ar_pts, v_ego)
+
+      tracks = {tid: t for tid, t in tracks.items() if tid in ar_pts}
+      for tid, pt in ar_pts.items():
+        v_lead = pt[2] + v_ego
+        if tid not in tracks:
+          tracks[tid] = ScalarTrack(v_lead, kalman_params)
+        tracks[tid].update(v_lead)
+
+      assert bank.ids.tolist() == list(tracks.keys())
+      assert bank.dRel.tolist() == [ar_pts[tid][0] for tid in tracks]
+      assert bank.vLeadK.tolist() == [t.vLeadK for t in tracks.values()]
+      assert bank.aLeadK.tolist() == [t.aLeadK for t in tracks.values()]
+      assert bank.aLeadTau.tolist() == [t.aLeadTau for t in tracks.values()]
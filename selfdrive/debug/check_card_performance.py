@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import numpy as np
+import time
+from tqdm import tqdm
+
+from cereal import car
+from opendbc.car import structs
+from openpilot.selfdrive.car.card import convert_carControl, convert_to_capnp
+from openpilot.selfdrive.car.tests.routes import CarTestRoute
+from openpilot.selfdrive.car.tests.test_models import TestCarModelBase
+from openpilot.selfdrive.pandad import can_capnp_to_list
+from openpilot.tools.plotjuggler.juggle import DEMO_ROUTE
+
+N_RUNS = 10
+
+
+class CarModelTestCase(TestCarModelBase):
+  test_route = CarTestRoute(DEMO_ROUTE, None)
+  ci = False
+
+
+def asdictref(obj):
+  # the dict based conversion card used before, for comparison
+  if hasattr(obj, '__dataclass_fields__'):
+    return {f: asdictref(getattr(obj, f)) for f in obj.__dataclass_fields__}
+  elif isinstance(obj, (tuple, list)):
+    return type(obj)(asdictref(v) for v in obj)
+  return obj
+
+
+def convert_carState_dict(CS: structs.CarState):
+  return car.CarState.new_message(**asdictref(CS))
+
+
+def convert_carControl_dict(CC: car.CarControl) -> structs.CarControl:
+  def remove_deprecated(s: dict) -> dict:
+    return {k: v for k, v in s.items() if not k.endswith('DEPRECATED')}
+
+  CC_dict = CC.to_dict()
+  ret = structs.CarControl(**remove_deprecated(CC_dict))
+  ret.actuators = structs.CarControl.Actuators(**remove_deprecated(CC_dict.get('actuators', {})))
+  ret.cruiseControl = structs.CarControl.CruiseControl(**remove_deprecated(CC_dict.get('cruiseControl', {})))
+  ret.hudControl = structs.CarControl.HUDControl(**remove_deprecated(CC_dict.get('hudControl', {})))
+  return ret
+
+
+def run(tm, convert_carState, convert_CC) -> list[float]:
+  CC = car.CarControl.new_message(enabled=True, latActive=True, longActive=True).as_reader()
+  ets = []
+  for _ in tqdm(range(N_RUNS)):
+    msgs = [m.as_builder().to_bytes() for m in tm.can_msgs]
+    start_t = time.process_time_ns()
+    for msg in msgs:
+      convert_carState(tm.CI.update(can_capnp_to_list([msg])))
+      convert_CC(CC)
+    ets.append((time.process_time_ns() - start_t) * 1e-6)
+  return ets
+
+
+if __name__ == '__main__':
+  # card's carState update and carControl conversion, for each CAN packet of the route
+  tm = CarModelTestCase()
+  tm.setUpClass()
+  tm.setUp()
+
+  for name, convert_carState, convert_CC in (("dict", convert_carState_dict, convert_carControl_dict),
+                                             ("schema", convert_to_capnp, convert_carControl)):
+    ets = run(tm, convert_carState, convert_CC)
+    print(f'{name} conversion: {len(tm.can_msgs)} CAN packets, {N_RUNS} runs')
+    print(f'{np.mean(ets):.2f} mean ms, {max(ets):.2f} max ms, {min(ets):.2f} min ms, {np.std(ets):.2f} std ms')
+    print(f'{np.mean(ets) / len(tm.can_msgs):.4f} mean ms / CAN packet')
@@ -117,6 +117,8 @@ class Calibrator:
     self.idx = 0
     self.block_idx = 0
     self.v_ego = 0.0
+    # blocks the calibration was last averaged over
+    self.valid_window: tuple[int, int] | None = None
 
     if smooth_from is None:
       self.old_rpy = RPY_INIT
@@ -131,7 +133,7 @@ class Calibrator:
     after_current = list(range(min(self.valid_blocks, self.block_idx + 1), self.valid_blocks))
     return before_current + after_current
 
-  def update_status(self) -> None:
+  def update_calibration(self) -> None:
     valid_idxs = self.get_valid_idxs()
     if valid_idxs:
       self.wide_from_device_euler = np.mean(self.wide_from_device_eulers[valid_idxs], axis=0)
@@ -144,6 +146,13 @@ class Calibrator:
     else:
       self.calib_spread = np.zeros(3)
 
+  def update_status(self) -> None:
+    # only finished blocks are averaged, so the calibration changes once per block, not for every message
+    valid_window = (self.block_idx, self.valid_blocks)
+    if valid_window != self.valid_window:
+      self.valid_window = valid_window
+      self.update_calibration()
+
     if self.valid_blocks < INPUTS_NEEDED:
       if self.cal_status == log.LiveCalibrationData.Status.recalibrating:
         self.cal_status = log.LiveCalibrationData.Status.recalibrating
@@ -255,6 +264,30 @@ class Calibrator:
     pm.send('liveCalibration', self.get_msg(valid))
 
 
+def calibrationd_step(sm: messaging.SubMaster, pm: messaging.PubMaster, calibrator: Calibrator) -> None:
+  # one iteration of the main loop, also run by the in-process replay
+  timeout = 0 if sm.frame == -1 else 100
+  sm.update(timeout)
+
+  calibrator.not_car = sm['carParams'].notCar
+
+  if sm.updated['cameraOdometry']:
+    calibrator.handle_v_ego(sm['carState'].vEgo)
+    new_rpy = calibrator.handle_cam_odom(sm['cameraOdometry'].trans,
+                                         sm['cameraOdometry'].rot,
+                                         sm['cameraOdometry'].wideFromDeviceEuler,
+                                         sm['cameraOdometry'].transStd,
+                                         sm['cameraOdometry'].roadTransformTrans,
+                                         sm['cameraOdometry'].roadTransformTransStd)
+
+    if DEBUG and new_rpy is not None:
+      print('got new rpy', new_rpy)
+
+  # 4Hz driven by cameraOdometry
+  if sm.frame % 5 == 0:
+    calibrator.send_data(pm, sm.all_checks())
+
+
 def main() -> NoReturn:
   gc.disable()
   set_realtime_priority(1)
@@ -265,26 +298,7 @@ def main() -> NoReturn:
   calibrator = Calibrator(param_put=True)
 
   while 1:
-    timeout = 0 if sm.frame == -1 else 100
-    sm.update(timeout)
-
-    calibrator.not_car = sm['carParams'].notCar
-
-    if sm.updated['cameraOdometry']:
-      calibrator.handle_v_ego(sm['carState'].vEgo)
-      new_rpy = calibrator.handle_cam_odom(sm['cameraOdometry'].trans,
-                                           sm['cameraOdometry'].rot,
-                                           sm['cameraOdometry'].wideFromDeviceEuler,
-                                           sm['cameraOdometry'].transStd,
-                                           sm['cameraOdometry'].roadTransformTrans,
-                                           sm['cameraOdometry'].roadTransformTransStd)
-
-      if DEBUG and new_rpy is not None:
-        print('got new rpy', new_rpy)
-
-    # 4Hz driven by cameraOdometry
-    if sm.frame % 5 == 0:
-      calibrator.send_data(pm, sm.all_checks())
+    calibrationd_step(sm, pm, calibrator)
 
 
 if __name__ == "__main__":
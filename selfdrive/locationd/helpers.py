@@ -14,27 +14,47 @@ def rotate_std(rot_matrix, std_in):
 
 
 class NPQueue:
-  def __init__(self, maxlen: int, rowsize: int) -> None:
+  """
+  Queue of the last maxlen values, or rows of rowsize values, in a preallocated circular buffer.
+  Every value is stored twice, so arr is always a view of the values in insertion order.
+  """
+  def __init__(self, maxlen: int, rowsize: int | None = None) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.zeros((2 * maxlen,) if rowsize is None else (2 * maxlen, rowsize))
+    self.start = 0
+    self.size = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
+    return self.size
 
-  def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+  @property
+  def arr(self) -> np.ndarray:
+    # only valid until the next append
+    return self.buf[self.start:self.start + self.size]
+
+  def append(self, pt: float | list[float]) -> None:
+    if self.size < self.maxlen:
+      idx = self.size
+      self.size += 1
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      idx = self.start
+      self.start = (self.start + 1) % self.maxlen
+    self.buf[idx] = pt
+    self.buf[idx + self.maxlen] = pt
 
 
 class PointBuckets:
+  # points added between recomputing the moments from scratch, to drop the rounding errors of adding and removing points
+  MOMENTS_REFRESH = 10000
+
   def __init__(self, x_bounds: list[tuple[float, float]], min_points: list[float], min_points_total: int, points_per_bucket: int, rowsize: int) -> None:
     self.x_bounds = x_bounds
     self.buckets = {bounds: NPQueue(maxlen=points_per_bucket, rowsize=rowsize) for bounds in x_bounds}
     self.buckets_min_points = dict(zip(x_bounds, min_points, strict=True))
     self.min_points_total = min_points_total
+    # sum of the outer products of all points with themselves, kept up to date as points enter and leave the buckets
+    self.moments = np.zeros((rowsize, rowsize))
+    self.moments_updates = 0
 
   def __len__(self) -> int:
     return sum([len(v) for v in self.buckets.values()])
@@ -50,6 +70,21 @@ class PointBuckets:
   def add_point(self, x: float, y: float) -> None:
     raise NotImplementedError
 
+  def append(self, bounds: tuple[float, float], pt: list[float]) -> None:
+    bucket = self.buckets[bounds]
+    pt_arr = np.asarray(pt, dtype=np.float64)
+    if len(bucket) == bucket.maxlen:
+      dropped = bucket.arr[0]
+      self.moments -= np.outer(dropped, dropped)
+    bucket.append(pt_arr)
+    self.moments += np.outer(pt_arr, pt_arr)
+
+    self.moments_updates += 1
+    if self.moments_updates >= self.MOMENTS_REFRESH:
+      points = self.get_points()
+      self.moments = points.T @ points
+      self.moments_updates = 0
+
   def get_points(self, num_points: int = None) -> Any:
     points = np.vstack([x.arr for x in self.buckets.values()])
     if num_points is None:
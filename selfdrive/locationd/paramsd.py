@@ -123,72 +123,66 @@ def check_valid_with_hysteresis(current_valid: bool, val: float, threshold: floa
   return current_valid
 
 
-def main():
-  config_realtime_process([0, 1, 2, 3], 5)
-
-  DEBUG = bool(int(os.getenv("DEBUG", "0")))
-  REPLAY = bool(int(os.getenv("REPLAY", "0")))
-
-  pm = messaging.PubMaster(['liveParameters'])
-  sm = messaging.SubMaster(['livePose', 'liveCalibration', 'carState'], poll='livePose')
-
-  params_reader = Params()
-  # wait for stats about the car to come in from controls
-  cloudlog.info("paramsd is waiting for CarParams")
-  CP = messaging.log_from_bytes(params_reader.get("CarParams", block=True), car.CarParams)
-  cloudlog.info("paramsd got CarParams")
-
-  min_sr, max_sr = 0.5 * CP.steerRatio, 2.0 * CP.steerRatio
-
-  params = params_reader.get("LiveParameters")
-
-  # Check if car model matches
-  if params is not None:
-    params = json.loads(params)
-    if params.get('carFingerprint', None) != CP.carFingerprint:
-      cloudlog.info("Parameter learner found parameters for wrong car.")
-      params = None
+class ParamsEstimator:
+  """
+  Learner of paramsd along with the output filters of liveParameters. Driven by the main loop, and by the
+  in-process replay without sockets.
+  """
+  def __init__(self, CP, params_reader, debug: bool = False, replay: bool = False):
+    self.CP = CP
+    self.params_reader = params_reader
+    self.debug = debug
+    self.min_sr, self.max_sr = 0.5 * CP.steerRatio, 2.0 * CP.steerRatio
+
+    params = params_reader.get("LiveParameters")
+
+    # Check if car model matches
+    if params is not None:
+      params = json.loads(params)
+      if params.get('carFingerprint', None) != CP.carFingerprint:
+        cloudlog.info("Parameter learner found parameters for wrong car.")
+        params = None
 
-  # Check if starting values are sane
-  if params is not None:
-    try:
-      steer_ratio_sane = min_sr <= params['steerRatio'] <= max_sr
-      if not steer_ratio_sane:
-        cloudlog.info(f"Invalid starting values found {params}")
+    # Check if starting values are sane
+    if params is not None:
+      try:
+        steer_ratio_sane = self.min_sr <= params['steerRatio'] <= self.max_sr
+        if not steer_ratio_sane:
+          cloudlog.info(f"Invalid starting values found {params}")
+          params = None
+      except Exception as e:
+        cloudlog.info(f"Error reading params {params}: {str(e)}")
         params = None
-    except Exception as e:
-      cloudlog.info(f"Error reading params {params}: {str(e)}")
-      params = None
-
-  # TODO: cache the params with the capnp struct
-  if params is None:
-    params = {
-      'carFingerprint': CP.carFingerprint,
-      'steerRatio': CP.steerRatio,
-      'stiffnessFactor': 1.0,
-      'angleOffsetAverageDeg': 0.0,
-    }
-    cloudlog.info("Parameter learner resetting to default values")
-
-  if not REPLAY:
-    # When driving in wet conditions the stiffness can go down, and then be too low on the next drive
-    # Without a way to detect this we have to reset the stiffness every drive
-    params['stiffnessFactor'] = 1.0
-
-  pInitial = None
-  if DEBUG:
-    pInitial = np.array(params['debugFilterState']['std']) if 'debugFilterState' in params else None
-
-  learner = ParamsLearner(CP, params['steerRatio'], params['stiffnessFactor'], math.radians(params['angleOffsetAverageDeg']), pInitial)
-  angle_offset_average = params['angleOffsetAverageDeg']
-  angle_offset = angle_offset_average
-  roll = 0.0
-  avg_offset_valid = True
-  total_offset_valid = True
-  roll_valid = True
 
-  while True:
-    sm.update()
+    # TODO: cache the params with the capnp struct
+    if params is None:
+      params = {
+        'carFingerprint': CP.carFingerprint,
+        'steerRatio': CP.steerRatio,
+        'stiffnessFactor': 1.0,
+        'angleOffsetAverageDeg': 0.0,
+      }
+      cloudlog.info("Parameter learner resetting to default values")
+
+    if not replay:
+      # When driving in wet conditions the stiffness can go down, and then be too low on the next drive
+      # Without a way to detect this we have to reset the stiffness every drive
+      params['stiffnessFactor'] = 1.0
+
+    pInitial = None
+    if debug:
+      pInitial = np.array(params['debugFilterState']['std']) if 'debugFilterState' in params else None
+
+    self.learner = ParamsLearner(CP, params['steerRatio'], params['stiffnessFactor'], math.radians(params['angleOffsetAverageDeg']), pInitial)
+    self.angle_offset_average = params['angleOffsetAverageDeg']
+    self.angle_offset = self.angle_offset_average
+    self.roll = 0.0
+    self.avg_offset_valid = True
+    self.total_offset_valid = True
+    self.roll_valid = True
+
+  def update(self, sm, pm) -> None:
+    learner = self.learner
     if sm.all_checks():
       for which in sorted(sm.updated.keys(), key=lambda x: sm.logMonoTime[x]):
         if sm.updated[which]:
@@ -200,14 +194,14 @@ def main():
       P = np.sqrt(learner.kf.P.diagonal())
       if not all(map(math.isfinite, x)):
         cloudlog.error("NaN in liveParameters estimate. Resetting to default values")
-        learner = ParamsLearner(CP, CP.steerRatio, 1.0, 0.0)
+        learner = self.learner = ParamsLearner(self.CP, self.CP.steerRatio, 1.0, 0.0)
         x = learner.kf.x
 
-      angle_offset_average = clip(math.degrees(x[States.ANGLE_OFFSET].item()),
-                                  angle_offset_average - MAX_ANGLE_OFFSET_DELTA, angle_offset_average + MAX_ANGLE_OFFSET_DELTA)
-      angle_offset = clip(math.degrees(x[States.ANGLE_OFFSET].item() + x[States.ANGLE_OFFSET_FAST].item()),
-                          angle_offset - MAX_ANGLE_OFFSET_DELTA, angle_offset + MAX_ANGLE_OFFSET_DELTA)
-      roll = clip(float(x[States.ROAD_ROLL].item()), roll - ROLL_MAX_DELTA, roll + ROLL_MAX_DELTA)
+      self.angle_offset_average = clip(math.degrees(x[States.ANGLE_OFFSET].item()),
+                                       self.angle_offset_average - MAX_ANGLE_OFFSET_DELTA, self.angle_offset_average + MAX_ANGLE_OFFSET_DELTA)
+      self.angle_offset = clip(math.degrees(x[States.ANGLE_OFFSET].item() + x[States.ANGLE_OFFSET_FAST].item()),
+                               self.angle_offset - MAX_ANGLE_OFFSET_DELTA, self.angle_offset + MAX_ANGLE_OFFSET_DELTA)
+      self.roll = clip(float(x[States.ROAD_ROLL].item()), self.roll - ROLL_MAX_DELTA, self.roll + ROLL_MAX_DELTA)
       roll_std = float(P[States.ROAD_ROLL].item())
       if learner.active and learner.speed > LOW_ACTIVE_SPEED:
         # Account for the opposite signs of the yaw rates
@@ -215,9 +209,9 @@ def main():
         sensors_valid = bool(abs(learner.speed * (x[States.YAW_RATE].item() + learner.yaw_rate)) < LATERAL_ACC_SENSOR_THRESHOLD)
       else:
         sensors_valid = True
-      avg_offset_valid = check_valid_with_hysteresis(avg_offset_valid, angle_offset_average, OFFSET_MAX, OFFSET_LOWERED_MAX)
-      total_offset_valid = check_valid_with_hysteresis(total_offset_valid, angle_offset, OFFSET_MAX, OFFSET_LOWERED_MAX)
-      roll_valid = check_valid_with_hysteresis(roll_valid, roll, ROLL_MAX, ROLL_LOWERED_MAX)
+      self.avg_offset_valid = check_valid_with_hysteresis(self.avg_offset_valid, self.angle_offset_average, OFFSET_MAX, OFFSET_LOWERED_MAX)
+      self.total_offset_valid = check_valid_with_hysteresis(self.total_offset_valid, self.angle_offset, OFFSET_MAX, OFFSET_LOWERED_MAX)
+      self.roll_valid = check_valid_with_hysteresis(self.roll_valid, self.roll, ROLL_MAX, ROLL_LOWERED_MAX)
 
       msg = messaging.new_message('liveParameters')
 
@@ -226,22 +220,22 @@ def main():
       liveParameters.sensorValid = sensors_valid
       liveParameters.steerRatio = float(x[States.STEER_RATIO].item())
       liveParameters.stiffnessFactor = float(x[States.STIFFNESS].item())
-      liveParameters.roll = roll
-      liveParameters.angleOffsetAverageDeg = angle_offset_average
-      liveParameters.angleOffsetDeg = angle_offset
+      liveParameters.roll = self.roll
+      liveParameters.angleOffsetAverageDeg = self.angle_offset_average
+      liveParameters.angleOffsetDeg = self.angle_offset
       liveParameters.valid = all((
-        avg_offset_valid,
-        total_offset_valid,
-        roll_valid,
+        self.avg_offset_valid,
+        self.total_offset_valid,
+        self.roll_valid,
         roll_std < ROLL_STD_MAX,
         0.2 <= liveParameters.stiffnessFactor <= 5.0,
-        min_sr <= liveParameters.steerRatio <= max_sr,
+        self.min_sr <= liveParameters.steerRatio <= self.max_sr,
       ))
       liveParameters.steerRatioStd = float(P[States.STEER_RATIO].item())
       liveParameters.stiffnessFactorStd = float(P[States.STIFFNESS].item())
       liveParameters.angleOffsetAverageStd = float(P[States.ANGLE_OFFSET].item())
       liveParameters.angleOffsetFastStd = float(P[States.ANGLE_OFFSET_FAST].item())
-      if DEBUG:
+      if self.debug:
         liveParameters.debugFilterState = log.LiveParametersData.FilterState.new_message()
         liveParameters.debugFilterState.value = x.tolist()
         liveParameters.debugFilterState.std = P.tolist()
@@ -250,15 +244,37 @@ def main():
 
       if sm.frame % 1200 == 0:  # once a minute
         params = {
-          'carFingerprint': CP.carFingerprint,
+          'carFingerprint': self.CP.carFingerprint,
           'steerRatio': liveParameters.steerRatio,
           'stiffnessFactor': liveParameters.stiffnessFactor,
           'angleOffsetAverageDeg': liveParameters.angleOffsetAverageDeg,
         }
-        params_reader.put_nonblocking("LiveParameters", json.dumps(params))
+        self.params_reader.put_nonblocking("LiveParameters", json.dumps(params))
 
       pm.send('liveParameters', msg)
 
 
+def main():
+  config_realtime_process([0, 1, 2, 3], 5)
+
+  DEBUG = bool(int(os.getenv("DEBUG", "0")))
+  REPLAY = bool(int(os.getenv("REPLAY", "0")))
+
+  pm = messaging.PubMaster(['liveParameters'])
+  sm = messaging.SubMaster(['livePose', 'liveCalibration', 'carState'], poll='livePose')
+
+  params_reader = Params()
+  # wait for stats about the car to come in from controls
+  cloudlog.info("paramsd is waiting for CarParams")
+  CP = messaging.log_from_bytes(params_reader.get("CarParams", block=True), car.CarParams)
+  cloudlog.info("paramsd got CarParams")
+
+  estimator = ParamsEstimator(CP, params_reader, DEBUG, REPLAY)
+
+  while True:
+    sm.update()
+    estimator.update(sm, pm)
+
+
 if __name__ == "__main__":
   main()
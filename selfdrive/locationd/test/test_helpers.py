@@ -0,0 +1,25 @@
+from collections import deque
+
+import numpy as np
+
+from openpilot.selfdrive.locationd.helpers import NPQueue
+
+
+class TestNPQueue:
+  def test_matches_deque(self):
+    for rowsize in (None, 3):
+      q = NPQueue(maxlen=10, rowsize=rowsize)
+      d: deque = deque(maxlen=10)
+      for i in range(35):
+        pt = float(i) if rowsize is None else [i, 1.0, -i]
+        q.append(pt)
+        d.append(pt)
+        assert len(q) == len(d)
+        np.testing.assert_array_equal(q.arr, np.array(d))
+
+  def test_view(self):
+    q = NPQueue(maxlen=4)
+    for i in range(6):
+      q.append(i)
+    # reading the values back doesn't copy them
+    assert np.shares_memory(q.arr, q.buf)
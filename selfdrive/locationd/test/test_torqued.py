@@ -0,0 +1,31 @@
+import numpy as np
+
+from cereal import car
+from openpilot.selfdrive.locationd.torqued import TorqueEstimator, slope2rot, FRICTION_FACTOR, POINTS_PER_BUCKET
+
+
+def batch_estimate(points):
+  # total least squares over all points, as the estimator fit the points before keeping running moments
+  _, _, v = np.linalg.svd(points, full_matrices=False)
+  slope, offset = -v.T[0:2, 2] / v.T[2, 2]
+  _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
+  return slope, offset, np.std(spread) * FRICTION_FACTOR
+
+
+class TestTorqueEstimator:
+  def test_matches_batch_fit(self):
+    np.random.seed(0)
+    CP = car.CarParams.new_message()
+    CP.lateralTuning.init('torque')
+    est = TorqueEstimator(CP)
+
+    # enough points for the buckets to fill up and drop their oldest points
+    for i in range(4 * POINTS_PER_BUCKET):
+      steer = np.random.uniform(-0.5, 0.5, 10)
+      # the fit drifts over time, so dropped points change the result
+      lat_accel = (2.5 + i / POINTS_PER_BUCKET) * steer + 0.1 + np.random.normal(0, 0.2, 10)
+      for x, y in zip(steer, lat_accel, strict=True):
+        est.filtered_points.add_point(x, y)
+
+      if i % 500 == 0 and est.filtered_points.is_calculable():
+        np.testing.assert_allclose(est.estimate_params(), batch_estimate(est.filtered_points.get_points()), rtol=1e-6)
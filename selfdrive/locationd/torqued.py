@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import numpy as np
-from collections import deque, defaultdict
+from collections import defaultdict
 
 import cereal.messaging as messaging
 from cereal import car, log
@@ -9,14 +9,12 @@ from openpilot.common.realtime import config_realtime_process, DT_MDL
 from openpilot.common.filter_simple import FirstOrderFilter
 from openpilot.common.swaglog import cloudlog
 from openpilot.selfdrive.controls.lib.vehicle_model import ACCELERATION_DUE_TO_GRAVITY
-from openpilot.selfdrive.locationd.helpers import PointBuckets, ParameterEstimator, PoseCalibrator, Pose
+from openpilot.selfdrive.locationd.helpers import NPQueue, PointBuckets, ParameterEstimator, PoseCalibrator, Pose
 
 HISTORY = 5  # secs
 POINTS_PER_BUCKET = 1500
 MIN_POINTS_TOTAL = 4000
 MIN_POINTS_TOTAL_QLOG = 600
-FIT_POINTS_TOTAL = 2000
-FIT_POINTS_TOTAL_QLOG = 600
 MIN_VEL = 15  # m/s
 FRICTION_FACTOR = 1.5  # ~85% of data coverage
 FACTOR_SANITY = 0.3
@@ -45,7 +43,7 @@ class TorqueBuckets(PointBuckets):
   def add_point(self, x, y):
     for bound_min, bound_max in self.x_bounds:
       if (x >= bound_min) and (x < bound_max):
-        self.buckets[(bound_min, bound_max)].append([x, 1.0, y])
+        self.append((bound_min, bound_max), [x, 1.0, y])
         break
 
 
@@ -57,14 +55,12 @@ class TorqueEstimator(ParameterEstimator):
     if decimated:
       self.min_bucket_points = MIN_BUCKET_POINTS / 10
       self.min_points_total = MIN_POINTS_TOTAL_QLOG
-      self.fit_points = FIT_POINTS_TOTAL_QLOG
       self.factor_sanity = FACTOR_SANITY_QLOG
       self.friction_sanity = FRICTION_SANITY_QLOG
 
     else:
       self.min_bucket_points = MIN_BUCKET_POINTS
       self.min_points_total = MIN_POINTS_TOTAL
-      self.fit_points = FIT_POINTS_TOTAL
       self.factor_sanity = FACTOR_SANITY
       self.friction_sanity = FRICTION_SANITY
 
@@ -133,7 +129,7 @@ class TorqueEstimator(ParameterEstimator):
   def reset(self):
     self.resets += 1.0
     self.decay = MIN_FILTER_DECAY
-    self.raw_points = defaultdict(lambda: deque(maxlen=self.hist_len))
+    self.raw_points = defaultdict(lambda: NPQueue(maxlen=self.hist_len))
     self.filtered_points = TorqueBuckets(x_bounds=STEER_BUCKET_BOUNDS,
                                          min_points=self.min_bucket_points,
                                          min_points_total=self.min_points_total,
@@ -142,14 +138,20 @@ class TorqueEstimator(ParameterEstimator):
     self.all_torque_points = []
 
   def estimate_params(self):
-    points = self.filtered_points.get_points(self.fit_points)
     # total least square solution as both x and y are noisy observations
     # this is empirically the slope of the hysteresis parallelogram as opposed to the line through the diagonals
+    # the points are rows of [x, 1, y], the fit is the last right singular vector of all points, which is the
+    # eigenvector of the smallest eigenvalue of their second moments
+    moments = self.filtered_points.moments
     try:
-      _, _, v = np.linalg.svd(points, full_matrices=False)
-      slope, offset = -v.T[0:2, 2] / v.T[2, 2]
-      _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
-      friction_coeff = np.std(spread) * FRICTION_FACTOR
+      _, v = np.linalg.eigh(moments)
+      slope, offset = -v[0:2, 0] / v[2, 0]
+      # spread of the points across the fit line, from the same moments
+      n = moments[1, 1]
+      a, b = slope2rot(slope)[:, 1]
+      spread_mean = (a * moments[0, 1] + b * moments[1, 2]) / n
+      spread_sq_mean = (a * a * moments[0, 0] + 2 * a * b * moments[0, 2] + b * b * moments[2, 2]) / n
+      friction_coeff = np.sqrt(max(spread_sq_mean - spread_mean ** 2, 0.)) * FRICTION_FACTOR
     except np.linalg.LinAlgError as e:
       cloudlog.exception(f"Error computing live torque params: {e}")
       slope = offset = friction_coeff = np.nan
@@ -186,14 +188,14 @@ class TorqueEstimator(ParameterEstimator):
         yaw_rate = angular_velocity_calibrated.yaw
         roll = device_pose.orientation.roll
         # check lat active up to now (without lag compensation)
-        lat_active = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL),
-                               self.raw_points['carControl_t'], self.raw_points['lat_active']).astype(bool)
-        steer_override = np.interp(np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL),
-                                   self.raw_points['carState_t'], self.raw_points['steer_override']).astype(bool)
-        vego = np.interp(t, self.raw_points['carState_t'], self.raw_points['vego'])
-        steer = np.interp(t, self.raw_points['carOutput_t'], self.raw_points['steer_torque']).item()
+        raw = self.raw_points
+        engage_t = np.arange(t - MIN_ENGAGE_BUFFER, t + self.lag, DT_MDL)
+        lat_active = np.interp(engage_t, raw['carControl_t'].arr, raw['lat_active'].arr).astype(bool)
+        steer_override = np.interp(engage_t, raw['carState_t'].arr, raw['steer_override'].arr).astype(bool)
+        vego = np.interp(t, raw['carState_t'].arr, raw['vego'].arr)
+        steer = np.interp(t, raw['carOutput_t'].arr, raw['steer_torque'].arr).item()
         lateral_acc = (vego * yaw_rate) - (np.sin(roll) * ACCELERATION_DUE_TO_GRAVITY).item()
-        if all(lat_active) and not any(steer_override) and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD):
+        if lat_active.all() and not steer_override.any() and (vego > MIN_VEL) and (abs(steer) > STEER_MIN_THRESHOLD):
           if abs(lateral_acc) <= LAT_ACC_THRESHOLD:
             self.filtered_points.add_point(steer, lateral_acc)
 
@@ -237,6 +239,25 @@ class TorqueEstimator(ParameterEstimator):
     return msg
 
 
+def torqued_step(sm: messaging.SubMaster, pm: messaging.PubMaster, params: Params, estimator: TorqueEstimator) -> None:
+  # one iteration of the main loop, also run by the in-process replay
+  sm.update()
+  if sm.all_checks():
+    for which in sm.updated.keys():
+      if sm.updated[which]:
+        t = sm.logMonoTime[which] * 1e-9
+        estimator.handle_log(t, which, sm[which])
+
+  # 4Hz driven by livePose
+  if sm.frame % 5 == 0:
+    pm.send('liveTorqueParameters', estimator.get_msg(valid=sm.all_checks()))
+
+  # Cache points every 60 seconds while onroad
+  if sm.frame % 240 == 0:
+    msg = estimator.get_msg(valid=sm.all_checks(), with_points=True)
+    params.put_nonblocking("LiveTorqueParameters", msg.to_bytes())
+
+
 def main(demo=False):
   config_realtime_process([0, 1, 2, 3], 5)
 
@@ -247,21 +268,7 @@ def main(demo=False):
   estimator = TorqueEstimator(messaging.log_from_bytes(params.get("CarParams", block=True), car.CarParams))
 
   while True:
-    sm.update()
-    if sm.all_checks():
-      for which in sm.updated.keys():
-        if sm.updated[which]:
-          t = sm.logMonoTime[which] * 1e-9
-          estimator.handle_log(t, which, sm[which])
-
-    # 4Hz driven by livePose
-    if sm.frame % 5 == 0:
-      pm.send('liveTorqueParameters', estimator.get_msg(valid=sm.all_checks()))
-
-    # Cache points every 60 seconds while onroad
-    if sm.frame % 240 == 0:
-      msg = estimator.get_msg(valid=sm.all_checks(), with_points=True)
-      params.put_nonblocking("LiveTorqueParameters", msg.to_bytes())
+    torqued_step(sm, pm, params, estimator)
 
 
 if __name__ == "__main__":
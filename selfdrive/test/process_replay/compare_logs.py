@@ -1,45 +1,216 @@
 #!/usr/bin/env python3
+import os
 import sys
 import math
-import capnp
-import numbers
-import dictdiffer
-from collections import Counter
+import multiprocessing
+import concurrent.futures
+from collections import Counter, defaultdict
+from typing import Any
 
 from openpilot.tools.lib.logreader import LogReader
 
 EPSILON = sys.float_info.epsilon
 
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
+# kinds of values the diff distinguishes, derived from the schema
+STRUCT, LIST, ENUM, NUMBER, VALUE = range(5)
+NUMBER_TYPES = {"int8", "int16", "int32", "int64", "uint8", "uint16", "uint32", "uint64", "float32", "float64"}
+
+SCALAR_KINDS = (ENUM, NUMBER, VALUE)
+_NO_IGNORE: dict = {}
+
+
+def _type_kind(t) -> Any:
+  which = t.which()
+  if which == "struct":
+    return STRUCT
+  elif which == "list":
+    return (LIST, _type_kind(t.list.elementType))
+  elif which == "enum":
+    return ENUM
+  elif which in NUMBER_TYPES:
+    return NUMBER
+  elif which == "void":
+    return None
+  return VALUE
+
+
+def _field_kind(field) -> Any:
+  return STRUCT if field.proto.which() == "group" else _type_kind(field.proto.slot.type)
+
 
+def _element_schema(schema, kind):
+  # struct schema of the innermost elements of a (nested) list schema
+  while isinstance(kind, tuple):
+    schema, kind = schema.elementType, kind[1]
+  return schema
+
+
+def _build_ignore_tree(ignore_fields: list[str]) -> dict:
+  # nested dict of ignored path components, a True leaf ignores everything below it
+  tree: dict = {}
+  for key in ignore_fields:
+    node = tree
+    keys = key.split(".")
     for k in keys[:-1]:
-      # indexing into list
-      if k.isdigit():
-        attr = attr[int(k)]
+      node = node.setdefault(k, {})
+      if node is True:
+        break
+    else:
+      node[keys[-1]] = True
+  return tree
+
+
+def _to_python(v, kind) -> Any:
+  if kind == STRUCT:
+    return v.to_dict(verbose=True)
+  elif isinstance(kind, tuple):
+    return [_to_python(x, kind[1]) for x in v]
+  elif kind == ENUM:
+    return str(v)
+  return v
+
+
+def _dotted(path: list) -> str | list:
+  # same path format as dictdiffer
+  return ".".join(path) if all(isinstance(k, str) for k in path) else list(path)
+
+
+class _StructPlan:
+  """
+  Fields of a struct type to compare, in schema order and without the ignored ones. Fields are read through their
+  schema field, which skips the name lookup of getattr, and structs with equal scalars only need their nested fields
+  compared. Plans of nested structs are resolved once, on first use.
+  """
+  def __init__(self, schema, ignore: dict, group: bool = False):
+    self.schema = schema
+    self.ignore = ignore
+    # groups share their parent's encoding
+    self.group = group
+    self.kinds = {name: _field_kind(schema.fields[name]) for name in schema.fields}
+    self.fields = [(name, schema.fields[name], self.kinds[name]) for name in schema.non_union_fields
+                   if self.kinds[name] is not None and ignore.get(name) is not True]
+    self.union = {name: (schema.fields[name], self.kinds[name]) for name in schema.union_fields}
+    self.scalars = [field for _, field, kind in self.fields if kind in SCALAR_KINDS]
+    self.nested = [(name, field, kind) for name, field, kind in self.fields if kind not in SCALAR_KINDS]
+    self._children: dict[tuple, _StructPlan] = {}
+
+  def child(self, name: str, ignore: dict) -> "_StructPlan":
+    # plan of a nested struct, or of the struct elements of a list, with the ignored fields below it
+    key = (name, id(ignore))
+    if key not in self._children:
+      field = self.schema.fields[name]
+      self._children[key] = _StructPlan(_element_schema(field.schema, self.kinds[name]), ignore, field.proto.which() == "group")
+    return self._children[key]
+
+
+class _LogDiff:
+  def __init__(self, ignore_fields: list[str], tolerance: float):
+    self.ignore = _build_ignore_tree(ignore_fields)
+    self.tolerance = tolerance
+    self._plan: _StructPlan | None = None
+
+  def msgs(self, msg1, msg2) -> list[tuple]:
+    if self._plan is None:
+      self._plan = _StructPlan(msg1.schema, self.ignore)
+    out: list[tuple] = []
+    self._struct(msg1, msg2, self._plan, [], out, True)
+    return out
+
+  def _struct(self, a, b, plan: _StructPlan, path, out, encode: bool) -> None:
+    if encode and not plan.group:
+      # identical subtrees, ignored fields included, are found by one native encoding of each side
+      if a.total_size.word_count == b.total_size.word_count and a.as_builder().to_bytes() == b.as_builder().to_bytes():
+        return
+      # without ignored fields below, the difference is real and encoding the subtrees again can't skip any of them
+      encode = bool(plan.ignore)
+
+    # most structs are identical, which their scalars show in one comparison
+    scalars_equal = [a._get_by_field(f) for f in plan.scalars] == [b._get_by_field(f) for f in plan.scalars]
+
+    for name, field, kind in (plan.nested if scalars_equal else plan.fields):
+      if kind in SCALAR_KINDS:
+        self._scalar(a._get_by_field(field), b._get_by_field(field), kind, path + [name], out)
       else:
-        attr = getattr(attr, k)
-
-    v = getattr(attr, keys[-1])
-    if isinstance(v, bool):
-      val = False
-    elif isinstance(v, numbers.Number):
-      val = 0
-    elif isinstance(v, (list, capnp.lib.capnp._DynamicListBuilder)):
-      val = []
+        self._nested(a._get_by_field(field), b._get_by_field(field), kind, plan, name, path + [name], out, encode)
+
+    if len(plan.union):
+      wa, wb = a.which(), b.which()
+      if wa != wb:
+        out.append(("add", _dotted(path), [(wb, _to_python(getattr(b, wb), plan.union[wb][1]))]))
+        out.append(("remove", _dotted(path), [(wa, _to_python(getattr(a, wa), plan.union[wa][1]))]))
+        return
+
+      field, kind = plan.union[wa]
+      if kind is None or plan.ignore.get(wa) is True:
+        return
+      if kind in SCALAR_KINDS:
+        self._scalar(a._get_by_field(field), b._get_by_field(field), kind, path + [wa], out)
+      else:
+        self._nested(a._get_by_field(field), b._get_by_field(field), kind, plan, wa, path + [wa], out, encode)
+
+  def _nested(self, a, b, kind, plan: _StructPlan, name: str, path, out, encode: bool) -> None:
+    ignore = plan.ignore.get(name) or _NO_IGNORE
+    if kind == STRUCT:
+      self._struct(a, b, plan.child(name, ignore), path, out, encode)
+    else:
+      self._list(a, b, kind, plan, name, ignore, path, out, encode)
+
+  def _list(self, a, b, kind, plan: _StructPlan, name: str, ignore: dict, path, out, encode: bool) -> None:
+    elem_kind = kind[1]
+    if elem_kind in SCALAR_KINDS:
+      va, vb = list(a), list(b)
+      if not ignore and va == vb:
+        return
     else:
-      raise NotImplementedError(f"Unknown type: {type(v)}")
-    setattr(attr, keys[-1], val)
-  return msg
+      va, vb = a, b
+
+    n = min(len(va), len(vb))
+    for i in range(n):
+      node = ignore.get(str(i))
+      if node is True:
+        continue
+      if elem_kind == STRUCT:
+        self._struct(va[i], vb[i], plan.child(name, node or _NO_IGNORE), path + [i], out, encode)
+      elif isinstance(elem_kind, tuple):
+        self._list(va[i], vb[i], elem_kind, plan, name, node or _NO_IGNORE, path + [i], out, encode)
+      else:
+        self._scalar(va[i], vb[i], elem_kind, path + [i], out)
+    if len(vb) > n:
+      out.append(("add", _dotted(path), [(i, _to_python(vb[i], elem_kind)) for i in range(n, len(vb))]))
+    if len(va) > n:
+      out.append(("remove", _dotted(path), [(i, _to_python(va[i], elem_kind)) for i in range(n, len(va))]))
+
+  def _scalar(self, a, b, kind, path, out) -> None:
+    if kind == ENUM:
+      if a != b:
+        out.append(("change", _dotted(path), (str(a), str(b))))
+    elif kind == NUMBER:
+      if a != b and self._outside_tolerance(a, b):
+        out.append(("change", _dotted(path), (a, b)))
+    elif a != b:
+      out.append(("change", _dotted(path), (a, b)))
+
+  def _outside_tolerance(self, a, b) -> bool:
+    if math.isfinite(a) and math.isfinite(b):
+      return abs(a - b) > max(self.tolerance, self.tolerance * max(abs(a), abs(b)))
+    return not (math.isnan(a) and math.isnan(b))
+
+
+_worker_args: tuple | None = None
+
+def _init_worker(*args):
+  global _worker_args
+  _worker_args = args
+
 
+def _diff_msgs(idxs: list[int]) -> list[tuple[int, list[tuple]]]:
+  assert _worker_args is not None
+  log1, log2, differ = _worker_args
+  return [(i, differ.msgs(log1[i], log2[i])) for i in idxs]
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, num_workers=1):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -56,37 +227,23 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
-  for msg1, msg2 in zip(log1, log2, strict=True):
+  msg_types: defaultdict[str, list[int]] = defaultdict(list)
+  for i, (msg1, msg2) in enumerate(zip(log1, log2, strict=True)):
     if msg1.which() != msg2.which():
       raise Exception("msgs not aligned between logs")
+    msg_types[msg1.which()].append(i)
 
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
-
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
+  differ = _LogDiff(ignore_fields, tolerance)
+  if num_workers <= 1 or len(msg_types) <= 1:
+    results = [(i, differ.msgs(msg1, msg2)) for i, (msg1, msg2) in enumerate(zip(log1, log2, strict=True))]
+  else:
+    # compare message types in forked workers, which inherit the logs instead of pickling them
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(num_workers, len(msg_types)), mp_context=multiprocessing.get_context("fork"),
+                                                initializer=_init_worker, initargs=(log1, log2, differ)) as pool:
+      results = sorted(r for rs in pool.map(_diff_msgs, msg_types.values()) for r in rs)
 
-      diff.extend(dd)
-  return diff
+  # each diff is a dictdiffer style tuple, followed by the logMonoTime of the message in the first log
+  return [(*d, log1[i].logMonoTime) for i, dd in results for d in dd]
 
 
 def format_process_diff(diff):
@@ -97,14 +254,16 @@ def format_process_diff(diff):
     diff_long += f"\t{diff}\n"
   else:
     cnt: dict[str, int] = {}
+    first: dict[str, int] = {}
     for d in diff:
       diff_long += f"\t{str(d)}\n"
 
       k = str(d[1])
       cnt[k] = 1 if k not in cnt else cnt[k] + 1
+      first.setdefault(k, d[3])
 
     for k, v in sorted(cnt.items()):
-      diff_short += f"        {k}: {v}\n"
+      diff_short += f"        {k}: {v} (first at logMonoTime {first[k]})\n"
 
   return diff_short, diff_long
 
@@ -142,7 +301,7 @@ if __name__ == "__main__":
   log1 = list(LogReader(sys.argv[1]))
   log2 = list(LogReader(sys.argv[2]))
   ignore_fields = sys.argv[3:] or ["logMonoTime", "controlsState.startMonoTime", "controlsState.cumLagMs"]
-  results = {"segment": {"proc": compare_logs(log1, log2, ignore_fields)}}
+  results = {"segment": {"proc": compare_logs(log1, log2, ignore_fields, num_workers=os.cpu_count() or 1)}}
   log_paths = {"segment": {"proc": {"ref": sys.argv[1], "new": sys.argv[2]}}}
   diff_short, diff_long, failed = format_diff(results, log_paths, None)
 
@@ -0,0 +1,157 @@
+import importlib
+import os
+import time
+
+import capnp
+
+import cereal.messaging as messaging
+from cereal import car
+from openpilot.common.params import Params
+from openpilot.common.realtime import DT_CTRL
+
+
+class ReplaySubMaster(messaging.SubMaster):
+  """
+  SubMaster without sockets, updated with the messages of the replay cycle fed to it. Like the conflated sockets
+  of SubMaster, only the latest message of each service in the cycle is seen.
+  """
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.cycle_msgs: list[capnp._DynamicStructReader] = []
+
+  def _sub_sock(self, s, poller, addr):
+    return None
+
+  def feed(self, msgs: list[capnp._DynamicStructReader]) -> None:
+    self.cycle_msgs = msgs
+
+  def update(self, timeout: int = 100) -> None:
+    latest = {m.which(): m for m in self.cycle_msgs if m.which() in self.data}
+    self.cycle_msgs = []
+    self.update_msgs(time.monotonic(), list(latest.values()))
+
+
+class ReplayPubMaster:
+  def __init__(self):
+    self.sent: list[tuple[str, bytes]] = []
+
+  def send(self, s: str, dat: bytes | capnp.lib.capnp._DynamicStructBuilder) -> None:
+    if not isinstance(dat, bytes):
+      dat = dat.to_bytes()
+    self.sent.append((s, dat))
+
+  def drain(self) -> list[tuple[str, bytes]]:
+    sent, self.sent = self.sent, []
+    return sent
+
+
+def get_car_params() -> car.CarParams:
+  return messaging.log_from_bytes(Params().get("CarParams", block=True), car.CarParams)
+
+
+class InProcessDaemon:
+  """
+  Drives a python daemon with the messages of each replay cycle, running the same step as an iteration of the
+  daemon's main loop, without sockets, threads or the daemon's process setup.
+  """
+  def __init__(self):
+    self.pm = ReplayPubMaster()
+
+  def update(self, msgs: list[capnp._DynamicStructReader]) -> None:
+    raise NotImplementedError
+
+  def step(self, msgs: list[capnp._DynamicStructReader]) -> list[tuple[str, bytes]]:
+    self.update(msgs)
+    return self.pm.drain()
+
+
+class RadardDaemon(InProcessDaemon):
+  def __init__(self):
+    super().__init__()
+    from openpilot.selfdrive.controls.radard import RadarD
+
+    CP = get_car_params()
+    RadarInterface = importlib.import_module(f'opendbc.car.{CP.carName}.radar_interface').RadarInterface
+    self.sm = ReplaySubMaster(['modelV2', 'carState'], frequency=int(1./DT_CTRL))
+    self.RI = RadarInterface(CP)
+    self.RD = RadarD(CP.radarTimeStep, self.RI.delay)
+
+  def update(self, msgs):
+    from openpilot.selfdrive.controls.radard import radard_step
+
+    # can is drained, so each cycle ends with an empty receive
+    can_strings = [m.as_builder().to_bytes() for m in msgs if m.which() == 'can']
+    for cycle_msgs, cycle_can in ((msgs, can_strings), ([], [])):
+      self.sm.feed(cycle_msgs)
+      radard_step(self.sm, self.pm, self.RI, self.RD, cycle_can)
+
+
+class PlannerdDaemon(InProcessDaemon):
+  def __init__(self):
+    super().__init__()
+    from openpilot.selfdrive.controls.lib.longitudinal_planner import LongitudinalPlanner
+
+    self.longitudinal_planner = LongitudinalPlanner(get_car_params())
+    self.sm = ReplaySubMaster(['carControl', 'carState', 'controlsState', 'radarState', 'modelV2'],
+                              poll='modelV2', ignore_avg_freq=['radarState'])
+
+  def update(self, msgs):
+    from openpilot.selfdrive.controls.plannerd import plannerd_step
+
+    self.sm.feed(msgs)
+    plannerd_step(self.sm, self.pm, self.longitudinal_planner)
+
+
+class CalibrationdDaemon(InProcessDaemon):
+  def __init__(self):
+    super().__init__()
+    from openpilot.selfdrive.locationd.calibrationd import Calibrator
+
+    self.sm = ReplaySubMaster(['cameraOdometry', 'carState', 'carParams'], poll='cameraOdometry')
+    self.calibrator = Calibrator(param_put=True)
+
+  def update(self, msgs):
+    from openpilot.selfdrive.locationd.calibrationd import calibrationd_step
+
+    self.sm.feed(msgs)
+    calibrationd_step(self.sm, self.pm, self.calibrator)
+
+
+class ParamsdDaemon(InProcessDaemon):
+  def __init__(self):
+    super().__init__()
+    from openpilot.selfdrive.locationd.paramsd import ParamsEstimator
+
+    self.sm = ReplaySubMaster(['livePose', 'liveCalibration', 'carState'], poll='livePose')
+    debug, replay = (bool(int(os.getenv(k, "0"))) for k in ("DEBUG", "REPLAY"))
+    self.estimator = ParamsEstimator(get_car_params(), Params(), debug, replay)
+
+  def update(self, msgs):
+    self.sm.feed(msgs)
+    self.sm.update()
+    self.estimator.update(self.sm, self.pm)
+
+
+class TorquedDaemon(InProcessDaemon):
+  def __init__(self):
+    super().__init__()
+    from openpilot.selfdrive.locationd.torqued import TorqueEstimator
+
+    self.sm = ReplaySubMaster(['carControl', 'carOutput', 'carState', 'liveCalibration', 'livePose'], poll='livePose')
+    self.params = Params()
+    self.estimator = TorqueEstimator(get_car_params())
+
+  def update(self, msgs):
+    from openpilot.selfdrive.locationd.torqued import torqued_step
+
+    self.sm.feed(msgs)
+    torqued_step(self.sm, self.pm, self.params, self.estimator)
+
+
+IN_PROCESS_DAEMONS: dict[str, type[InProcessDaemon]] = {
+  "radard": RadardDaemon,
+  "plannerd": PlannerdDaemon,
+  "calibrationd": CalibrationdDaemon,
+  "paramsd": ParamsdDaemon,
+  "torqued": TorquedDaemon,
+}
@@ -6,7 +6,9 @@ import json
 import heapq
 import signal
 import platform
-from collections import Counter, OrderedDict
+import multiprocessing
+import concurrent.futures
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass, field
 from typing import Any
 from collections.abc import Callable, Iterable
@@ -14,7 +16,7 @@ from tqdm import tqdm
 import capnp
 
 import cereal.messaging as messaging
-from cereal import car
+from cereal import car, log
 from cereal.services import SERVICE_LIST
 from msgq.visionipc import VisionIpcServer, get_endpoint_name as vipc_get_endpoint_name
 from opendbc.car import structs
@@ -29,6 +31,7 @@ from openpilot.system.manager.process_config import managed_processes
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_camera_state, available_streams
 from openpilot.selfdrive.test.process_replay.migration import migrate_all
 from openpilot.selfdrive.test.process_replay.capture import ProcessOutputCapture
+from openpilot.selfdrive.test.process_replay.inprocess import IN_PROCESS_DAEMONS, InProcessDaemon
 from openpilot.tools.lib.logreader import LogIterable
 from openpilot.tools.lib.framereader import BaseFrameReader
 
@@ -36,6 +39,8 @@ from openpilot.tools.lib.framereader import BaseFrameReader
 NUMPY_TOLERANCE = 1e-7
 PROC_REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
 FAKEDATA = os.path.join(PROC_REPLAY_DIR, "fakedata/")
+# python daemons which can be replayed inside the replay process, stepped synchronously with each cycle instead of going through msgq
+IN_PROCESS_PROCS = set(IN_PROCESS_DAEMONS)
 
 class DummySocket:
   def __init__(self):
@@ -319,6 +324,66 @@ class ProcessContainer:
     return output_msgs
 
 
+class InProcessContainer(ProcessContainer):
+  """
+  Replays a python daemon by driving its estimator directly in the replay process, handing it messages
+  instead of sending them through msgq. The daemon sees the same messages per cycle as with ProcessContainer.
+  """
+  def __init__(self, cfg: ProcessConfig):
+    super().__init__(cfg)
+    assert cfg.proc_name in IN_PROCESS_PROCS, f"{cfg.proc_name} can't be replayed in-process"
+    assert len(cfg.vision_pubs) == 0
+    self.daemon: InProcessDaemon | None = None
+
+  def start(
+    self, params_config: dict[str, Any], environ_config: dict[str, Any],
+    all_msgs: LogIterable, frs: dict[str, BaseFrameReader] | None,
+    fingerprint: str | None, capture_output: bool
+  ):
+    assert not capture_output, "output capture isn't supported for processes replayed in-process"
+    with self.prefix:
+      self._setup_env(params_config, environ_config)
+
+      if self.cfg.config_callback is not None:
+        params = Params()
+        self.cfg.config_callback(params, self.cfg, all_msgs)
+
+      if self.cfg.init_callback is not None:
+        self.cfg.init_callback(None, None, all_msgs, fingerprint)
+
+      self.daemon = IN_PROCESS_DAEMONS[self.cfg.proc_name]()
+
+  def stop(self):
+    with self.prefix:
+      self.prefix.clean_dirs()
+      self._clean_env()
+
+  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, BaseFrameReader] | None) -> list[capnp._DynamicStructReader]:
+    assert self.daemon is not None
+
+    output_msgs = []
+    with self.prefix:
+      end_of_cycle = True
+      if self.cfg.should_recv_callback is not None:
+        end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+      self.msg_queue.append(msg)
+      if end_of_cycle:
+        sent = self.daemon.step(self.msg_queue)
+        self.msg_queue = []
+
+        # same order as draining each of the subscribed sockets
+        for sub in self.cfg.subs:
+          for s, dat in sent:
+            if s == sub:
+              m = messaging.log_from_bytes(dat).as_builder()
+              m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+              output_msgs.append(m.as_reader())
+        self.cnt += 1
+
+    return output_msgs
+
+
 def card_fingerprint_callback(rc, pm, msgs, fingerprint):
   print("start fingerprinting")
   params = Params()
@@ -662,7 +727,8 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False,
+  num_workers: int = 1, timing_store: dict[str, float] = None, in_process: bool = False
 ) -> list[capnp._DynamicStructReader]:
   if isinstance(cfg, Iterable):
     cfgs = list(cfg)
@@ -673,7 +739,8 @@ def replay_process(
                          manager_states=True,
                          panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
                          camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress,
+                                       num_workers, timing_store, in_process)
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -687,9 +754,22 @@ def replay_process(
   return log_msgs
 
 
+def get_process_graphs(cfgs: list[ProcessConfig]) -> list[list[int]]:
+  """
+  Split processes into independent graphs, which don't exchange any messages with each other
+  and can be replayed separately. Returns the indices of the processes of each graph.
+  """
+  graphs: list[set[int]] = []
+  for i, cfg in enumerate(cfgs):
+    connected = [g for g in graphs if any(set(cfg.pubs) & set(cfgs[j].subs) or set(cfg.subs) & set(cfgs[j].pubs) for j in g)]
+    graphs = [g for g in graphs if g not in connected] + [{i}.union(*connected)]
+  return sorted(sorted(g) for g in graphs)
+
+
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  num_workers: int = 1, timing_store: dict[str, float] | None = None, in_process: bool = False
 ) -> list[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
@@ -709,43 +789,111 @@ def _replay_multi_process(
     assert all(st in frs for st in required_vision_pubs), f"frs for this process must contain following vision streams: {required_vision_pubs}"
 
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
-  log_msgs = []
+  graphs = get_process_graphs(cfgs)
+  if num_workers <= 1 or len(graphs) == 1:
+    schedule = _replay_process_graph(cfgs, list(range(len(cfgs))), all_msgs, frs, params_config, env_config, fingerprint,
+                                     captured_output_store, timing_store, disable_progress, in_process)
+    return [m for _, m in schedule]
+
+  # replay independent graphs in forked workers, which inherit the messages and frame readers instead of pickling them
+  replay_args = (cfgs, all_msgs, frs, params_config, env_config, fingerprint, captured_output_store is not None, in_process)
+  with concurrent.futures.ProcessPoolExecutor(max_workers=min(num_workers, len(graphs)), mp_context=multiprocessing.get_context("fork"),
+                                              initializer=_init_graph_worker, initargs=replay_args) as pool:
+    results = list(tqdm(pool.map(_replay_graph_worker, graphs), total=len(graphs), disable=disable_progress))
+
+  # merge the graphs' outputs into the order a single replay of all processes produces them in,
+  # up to ties between messages generated by processes of different graphs
+  schedule = []
+  for keys, dats, captured_outputs, timings, _ in results:
+    schedule.extend(zip(keys, dats, strict=True))
+    if captured_output_store is not None:
+      captured_output_store.update(captured_outputs)
+    if timing_store is not None:
+      timing_store.update(timings)
+  errors = [error for *_, error in results if error is not None]
+  if len(errors) != 0:
+    raise errors[0]
+
+  schedule.sort(key=lambda s: s[0])
+  return list(log.Event.read_multiple_bytes(b"".join(dat for _, dat in schedule)))
+
+
+_graph_worker_args: tuple | None = None
+
+def _init_graph_worker(*args):
+  global _graph_worker_args
+  _graph_worker_args = args
+
+
+def _replay_graph_worker(cfg_ids: list[int]) -> tuple[list[tuple], list[bytes], dict[str, dict[str, str]], dict[str, float], Exception | None]:
+  assert _graph_worker_args is not None
+  cfgs, all_msgs, frs, params_config, env_config, fingerprint, capture_output, in_process = _graph_worker_args
+  captured_output_store: dict[str, dict[str, str]] = {}
+  timing_store: dict[str, float] = {}
+  try:
+    schedule = _replay_process_graph([cfgs[i] for i in cfg_ids], cfg_ids, all_msgs, frs, params_config, env_config, fingerprint,
+                                     captured_output_store if capture_output else None, timing_store, True, in_process)
+  except Exception as e:
+    # captured output is returned even if the replay fails
+    return [], [], captured_output_store, timing_store, e
+  return [k for k, _ in schedule], [m.as_builder().to_bytes() for _, m in schedule], captured_output_store, timing_store, None
+
+
+def _replay_process_graph(
+  cfgs: list[ProcessConfig], cfg_ids: list[int], all_msgs: list[capnp._DynamicStructReader], frs: dict[str, BaseFrameReader] | None,
+  params_config: dict[str, Any], env_config: dict[str, Any], fingerprint: str | None,
+  captured_output_store: dict[str, dict[str, str]] | None, timing_store: dict[str, float] | None, disable_progress: bool,
+  in_process: bool = False
+) -> list[tuple[tuple, capnp._DynamicStructReader]]:
+  """
+  Replays processes in lock-step, returning their output messages, each along with its position in the schedule:
+  (trigger logMonoTime, 0 for internal trigger or 1 for trigger from logs, trigger index, process index, output index)
+  """
+  schedule = []
   try:
     containers = []
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      container = InProcessContainer(cfg) if in_process and cfg.proc_name in IN_PROCESS_PROCS else ProcessContainer(cfg)
       containers.append(container)
       container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
     all_pubs = {pub for container in containers for pub in container.pubs}
     all_subs = {sub for container in containers for sub in container.subs}
     lr_pubs = all_pubs - all_subs
-    pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
+    pubs_to_containers = {pub: [(cfg_id, container) for cfg_id, container in zip(cfg_ids, containers, strict=True) if pub in container.pubs]
+                          for pub in all_pubs}
+    wall_times = {container.cfg.proc_name: 0.0 for container in containers}
 
-    pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
-    # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
-    external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
+    # external queue for messages taken from logs along with their index in all_msgs;
+    # internal queue for messages generated by processes, which will be republished
+    external_pub_queue = deque((i, msg) for i, msg in enumerate(all_msgs) if msg.which() in lr_pubs)
     internal_pub_queue: list[capnp._DynamicStructReader] = []
     # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
     internal_pub_index_heap: list[tuple[int, int]] = []
 
     pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
     while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
-      if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
-        msg = external_pub_queue.pop(0)
+      if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0][1].logMonoTime < internal_pub_index_heap[0][0]):
+        index, msg = external_pub_queue.popleft()
+        trigger = (msg.logMonoTime, 1, index)
         pbar.update(1)
       else:
         _, index = heapq.heappop(internal_pub_index_heap)
         msg = internal_pub_queue[index]
+        trigger = (msg.logMonoTime, 0, index)
 
-      target_containers = pubs_to_containers[msg.which()]
-      for container in target_containers:
+      for cfg_id, container in pubs_to_containers[msg.which()]:
+        t = time.monotonic()
         output_msgs = container.run_step(msg, frs)
-        for m in output_msgs:
+        wall_times[container.cfg.proc_name] += time.monotonic() - t
+        for i, m in enumerate(output_msgs):
           if m.which() in all_pubs:
             internal_pub_queue.append(m)
             heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
-        log_msgs.extend(output_msgs)
+          schedule.append(((*trigger, cfg_id, i), m))
+
+    if timing_store is not None:
+      timing_store.update(wall_times)
   finally:
     for container in containers:
       container.stop()
@@ -754,7 +902,7 @@ def _replay_multi_process(
         out, err = container.capture.read_outerr()
         captured_output_store[container.cfg.proc_name] = {"out": out, "err": err}
 
-  return log_msgs
+  return schedule
 
 
 def generate_params_config(lr=None, CP=None, fingerprint=None, custom_params=None) -> dict[str, Any]:
@@ -41,7 +41,7 @@ class DummyFrameReader(BaseFrameReader):
 
 def regen_segment(
   lr: LogIterable, frs: dict[str, Any] = None,
-  processes: Iterable[ProcessConfig] = CONFIGS, disable_tqdm: bool = False
+  processes: Iterable[ProcessConfig] = CONFIGS, disable_tqdm: bool = False, num_workers: int = 1
 ) -> list[capnp._DynamicStructReader]:
   all_msgs = sorted(lr, key=lambda m: m.logMonoTime)
   custom_params = get_custom_params_from_lr(all_msgs)
@@ -49,7 +49,13 @@ def regen_segment(
   print("Replayed processes:", [p.proc_name for p in processes])
   print("\n\n", "*"*30, "\n\n", sep="")
 
-  output_logs = replay_process(processes, all_msgs, frs, return_all_logs=True, custom_params=custom_params, disable_progress=disable_tqdm)
+  wall_times: dict[str, float] = {}
+  output_logs = replay_process(processes, all_msgs, frs, return_all_logs=True, custom_params=custom_params, disable_progress=disable_tqdm,
+                               num_workers=num_workers, timing_store=wall_times)
+
+  print("Wall time per process:")
+  for proc_name, wall_time in sorted(wall_times.items(), key=lambda x: -x[1]):
+    print(f"  {proc_name}: {wall_time:.2f}s")
 
   return output_logs
 
@@ -93,7 +99,7 @@ def setup_data_readers(
 
 def regen_and_save(
   route: str, sidx: int, processes: str | Iterable[str] = "all", outdir: str = FAKEDATA,
-  upload: bool = False, use_route_meta: bool = False, disable_tqdm: bool = False, dummy_driver_cam: bool = False
+  upload: bool = False, use_route_meta: bool = False, disable_tqdm: bool = False, dummy_driver_cam: bool = False, num_workers: int = 1
 ) -> str:
   if not isinstance(processes, str) and not hasattr(processes, "__iter__"):
     raise ValueError("whitelist_proc must be a string or iterable")
@@ -114,7 +120,7 @@ def regen_and_save(
                                needs_driver_cam="driverCameraState" in all_vision_pubs,
                                needs_road_cam="roadCameraState" in all_vision_pubs or "wideRoadCameraState" in all_vision_pubs,
                                dummy_driver_cam=dummy_driver_cam)
-  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm, num_workers=num_workers)
 
   log_dir = os.path.join(outdir, time.strftime("%Y-%m-%d--%H-%M-%S--0", time.gmtime()))
   rel_log_dir = os.path.relpath(log_dir)
@@ -150,10 +156,12 @@ if __name__ == "__main__":
                       help="Comma-separated whitelist of processes to regen (e.g. controlsd,radard)")
   parser.add_argument("--blacklist-procs", type=comma_separated_list, default=[],
                       help="Comma-separated blacklist of processes to regen (e.g. controlsd,radard)")
+  parser.add_argument("-j", "--jobs", type=int, default=1, help="Max amount of independent process graphs to replay in parallel")
   parser.add_argument("route", type=str, help="The source route")
   parser.add_argument("seg", type=int, help="Segment in source route")
   args = parser.parse_args()
 
   blacklist_set = set(args.blacklist_procs)
   processes = [p for p in args.whitelist_procs if p not in blacklist_set]
-  regen_and_save(args.route, args.seg, processes=processes, upload=args.upload, outdir=args.outdir, dummy_driver_cam=args.dummy_dcamera)
+  regen_and_save(args.route, args.seg, processes=processes, upload=args.upload, outdir=args.outdir, dummy_driver_cam=args.dummy_dcamera,
+                 num_workers=args.jobs)
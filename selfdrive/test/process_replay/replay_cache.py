@@ -0,0 +1,204 @@
+import dataclasses
+import hashlib
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+import zstandard as zstd
+from functools import cache
+from typing import Any
+
+import capnp
+
+from cereal import log
+from openpilot.common.basedir import BASEDIR
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.manager.process import NativeProcess, PythonProcess
+from openpilot.system.manager.process_config import managed_processes
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR
+from openpilot.tools.lib.filereader import FileReader
+
+REPLAY_CACHE_DIR = os.getenv("REPLAY_CACHE_DIR", os.path.join(DEFAULT_CACHE_DIR, "process_replay"))
+REPLAY_CACHE_SIZE = int(os.getenv("REPLAY_CACHE_SIZE", 4 * 1024 * 1024 * 1024))
+REPLAY_CACHE_MAX_AGE = int(os.getenv("REPLAY_CACHE_MAX_AGE", 14 * 24 * 60 * 60))
+
+# packages with modules that are only imported at runtime, like the car interfaces picked by the fingerprint,
+# are hashed as a whole as soon as a process imports any of their modules
+RUNTIME_IMPORT_PACKAGES = ["opendbc"]
+# lock files pin the third party packages, which aren't hashed themselves
+DEPENDENCY_FILES = ["uv.lock"]
+
+# imports the process with the replay harness in a clean interpreter and lists all the loaded modules
+SOURCE_FILES_SCRIPT = """
+import importlib
+import sys
+import openpilot.selfdrive.test.process_replay.process_replay
+for module in sys.argv[1:]:
+  importlib.import_module(module)
+for module in list(sys.modules.values()):
+  fn = getattr(module, "__file__", None)
+  if fn is not None:
+    print(fn)
+"""
+
+
+def _walk_files(path: str) -> list[str]:
+  files = []
+  for root, dirs, fns in os.walk(path):
+    dirs[:] = [d for d in dirs if d != "__pycache__" and not d.startswith(".")]
+    files.extend(os.path.join(root, fn) for fn in fns if not fn.endswith(".pyc"))
+  return files
+
+
+@cache
+def _file_hash(fn: str, mtime_ns: int, size: int) -> str:
+  h = hashlib.sha256()
+  with open(fn, "rb") as f:
+    while chunk := f.read(1024 * 1024):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def get_process_source_files(proc_name: str) -> list[str]:
+  proc = managed_processes[proc_name]
+  modules = [proc.module] if isinstance(proc, PythonProcess) else []
+  out = subprocess.check_output([sys.executable, "-c", SOURCE_FILES_SCRIPT, *modules], cwd=BASEDIR, encoding="utf8")
+
+  files = {os.path.realpath(fn) for fn in out.splitlines()}
+  files = {fn for fn in files if fn.startswith(BASEDIR + "/") and os.path.isfile(fn)}
+  for package in RUNTIME_IMPORT_PACKAGES:
+    spec = importlib.util.find_spec(package)
+    if spec is not None and spec.submodule_search_locations:
+      package_dir = os.path.realpath(spec.submodule_search_locations[0])
+      if any(fn.startswith(package_dir + "/") for fn in files):
+        files.update(_walk_files(package_dir))
+
+  # native processes are hashed with their sources and the built binary
+  if isinstance(proc, NativeProcess):
+    files.update(_walk_files(os.path.join(BASEDIR, proc.cwd)))
+
+  files.update(os.path.join(BASEDIR, fn) for fn in DEPENDENCY_FILES if os.path.isfile(os.path.join(BASEDIR, fn)))
+  return sorted(files)
+
+
+def get_process_source_hash(proc_name: str) -> str:
+  h = hashlib.sha256()
+  for fn in get_process_source_files(proc_name):
+    st = os.stat(fn)
+    h.update(f"{os.path.relpath(fn, BASEDIR)}:{_file_hash(fn, st.st_mtime_ns, st.st_size)}\n".encode())
+  return h.hexdigest()
+
+
+def _stable_repr(v: Any) -> Any:
+  # JSON representation that doesn't change between runs, unlike repr() of functions and objects
+  if v is None or isinstance(v, (bool, int, float, str)):
+    return v
+  elif isinstance(v, bytes):
+    return hashlib.sha256(v).hexdigest()
+  elif isinstance(v, (list, tuple)):
+    return [_stable_repr(x) for x in v]
+  elif isinstance(v, (set, frozenset)):
+    return sorted(_stable_repr(x) for x in v)
+  elif isinstance(v, dict):
+    return {str(k): _stable_repr(x) for k, x in v.items()}
+  elif hasattr(v, "__qualname__"):
+    return f"{v.__module__}.{v.__qualname__}"
+  return {"type": f"{type(v).__module__}.{type(v).__qualname__}", "state": _stable_repr(vars(v))}
+
+
+def get_replay_key(cfg, source_hash: str, segment_hash: str, custom_params: dict[str, Any] | None = None) -> str:
+  config = {f.name: _stable_repr(getattr(cfg, f.name)) for f in dataclasses.fields(cfg)}
+  key = json.dumps([source_hash, config, segment_hash, _stable_repr(custom_params)], sort_keys=True)
+  return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ReplayCache:
+  """
+  Content addressed store of process replay outputs, keyed by get_replay_key(). Downloads of immutable files, like
+  the input segments and reference logs, are kept alongside them. Entries are pruned by age and least recent use.
+  """
+  def __init__(self, cache_dir: str = REPLAY_CACHE_DIR):
+    self.cache_dir = cache_dir
+    self.hits = 0
+    self.misses = 0
+
+  def _path(self, kind: str, name: str) -> str:
+    return os.path.join(self.cache_dir, kind, name)
+
+  def _read(self, path: str) -> bytes | None:
+    try:
+      with open(path, "rb") as f:
+        dat = f.read()
+    except FileNotFoundError:
+      return None
+    # the access time isn't reliably updated, so the modification time tracks use for pruning
+    os.utime(path)
+    return dat
+
+  def _write(self, path: str, dat: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+      f.write(dat)
+
+  def get(self, key: str) -> list[capnp._DynamicStructReader] | None:
+    dat = self._read(self._path("replays", f"{key}.zst"))
+    if dat is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return list(log.Event.read_multiple_bytes(zstd.decompress(dat)))
+
+  def put(self, key: str, msgs: list[capnp._DynamicStructReader]) -> None:
+    dat = b"".join(msg.as_builder().to_bytes() for msg in msgs)
+    self._write(self._path("replays", f"{key}.zst"), zstd.compress(dat, 10))
+
+  def get_file(self, fn: str) -> bytes:
+    if not fn.startswith(("http://", "https://")):
+      with FileReader(fn) as f:
+        return f.read()
+
+    path = self._path("files", hashlib.sha256(fn.encode()).hexdigest())
+    dat = self._read(path)
+    if dat is None:
+      with FileReader(fn) as f:
+        dat = f.read()
+      self._write(path, dat)
+    return dat
+
+  def _entries(self) -> list[tuple[float, int, str]]:
+    entries = []
+    for kind in ("replays", "files"):
+      if not os.path.isdir(os.path.join(self.cache_dir, kind)):
+        continue
+      with os.scandir(os.path.join(self.cache_dir, kind)) as it:
+        for entry in it:
+          try:
+            st = entry.stat()
+          except FileNotFoundError:
+            continue
+          entries.append((st.st_mtime, st.st_size, entry.path))
+    return entries
+
+  def usage(self) -> tuple[int, int]:
+    entries = self._entries()
+    return len(entries), sum(size for _, size, _ in entries)
+
+  def prune(self, max_size: int = REPLAY_CACHE_SIZE, max_age: float = REPLAY_CACHE_MAX_AGE) -> tuple[int, int]:
+    """Removes entries unused for max_age seconds, then the least recently used ones past max_size bytes."""
+    oldest = time.time() - max_age
+    entries = sorted(self._entries())
+    total = sum(size for _, size, _ in entries)
+    removed, removed_size = 0, 0
+    for mtime, size, path in entries:
+      if mtime >= oldest and total <= max_size:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+      removed += 1
+      removed_size += size
+    return removed, removed_size
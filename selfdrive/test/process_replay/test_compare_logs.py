@@ -0,0 +1,76 @@
+from cereal import log
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_process_diff
+
+IGNORE = ["logMonoTime", "carState.cumLagMs"]
+
+
+def car_state(t: int, **kwargs):
+  return log.Event.new_message(logMonoTime=t, carState=kwargs)
+
+
+def read(*msgs):
+  return list(log.Event.read_multiple_bytes(b"".join(m.to_bytes() for m in msgs)))
+
+
+class TestCompareLogs:
+  def test_identical(self):
+    log1 = read(car_state(0, vEgo=1.0, cumLagMs=1.0), car_state(1, vEgo=2.0, gearShifter="drive"))
+    log2 = read(car_state(5, vEgo=1.0, cumLagMs=2.0), car_state(6, vEgo=2.0, gearShifter="drive"))
+    assert compare_logs(log1, log2, IGNORE) == []
+
+  def test_changes(self):
+    log1 = read(car_state(0, vEgo=1.0), car_state(1, gearShifter="drive"), car_state(2, vEgo=float("nan"), canErrorCounter=1))
+    log2 = read(car_state(0, vEgo=1.5), car_state(1, gearShifter="park"), car_state(2, vEgo=float("nan"), canErrorCounter=2))
+    assert compare_logs(log1, log2, IGNORE) == [
+      ("change", "carState.vEgo", (1.0, 1.5), 0),
+      ("change", "carState.gearShifter", ("drive", "park"), 1),
+      ("change", "carState.canErrorCounter", (1, 2), 2),
+    ]
+
+  def test_tolerance(self):
+    log1, log2 = read(car_state(0, vEgo=1.0)), read(car_state(0, vEgo=1.05))
+    assert compare_logs(log1, log2, IGNORE, tolerance=0.1) == []
+    assert len(compare_logs(log1, log2, IGNORE, tolerance=0.01)) == 1
+
+  def test_lists(self):
+    log1 = read(car_state(0, buttonEvents=[{}, {}]), car_state(1, canMonoTimesDEPRECATED=[1, 2, 3]))
+    log2 = read(car_state(0, buttonEvents=[{"pressed": True}, {}, {}]), car_state(1, canMonoTimesDEPRECATED=[1, 5]))
+    assert compare_logs(log1, log2, IGNORE) == [
+      ("change", ["carState", "buttonEvents", 0, "pressed"], (False, True), 0),
+      ("add", "carState.buttonEvents", [(2, {"pressed": False, "type": "unknown"})], 0),
+      ("change", ["carState", "canMonoTimesDEPRECATED", 1], (2, 5), 1),
+      ("remove", "carState.canMonoTimesDEPRECATED", [(2, 3)], 1),
+    ]
+    assert compare_logs(log1[:1], log2[:1], IGNORE + ["carState.buttonEvents.0.pressed"]) == [
+      ("add", "carState.buttonEvents", [(2, {"pressed": False, "type": "unknown"})], 0),
+    ]
+
+  def test_nested(self):
+    log1 = read(car_state(0, cruiseState={"speed": 1.0, "enabled": True}), car_state(1, cruiseState={"speed": 1.0}))
+    log2 = read(car_state(0, cruiseState={"speed": 2.0, "enabled": True}), car_state(1, cruiseState={"speed": 1.0, "available": True}))
+    assert compare_logs(log1, log2, IGNORE) == [
+      ("change", "carState.cruiseState.speed", (1.0, 2.0), 0),
+      ("change", "carState.cruiseState.available", (False, True), 1),
+    ]
+    # ignored fields are skipped while walking the messages
+    assert compare_logs(log1, log2, IGNORE + ["carState.cruiseState.speed"]) == [
+      ("change", "carState.cruiseState.available", (False, True), 1),
+    ]
+    assert compare_logs(log1, log2, IGNORE + ["carState.cruiseState"]) == []
+
+  def test_parallel(self):
+    msgs1, msgs2 = [], []
+    for t in range(20):
+      msgs1 += [car_state(t, vEgo=t), log.Event.new_message(logMonoTime=t, radarState={"cumLagMs": t})]
+      msgs2 += [car_state(t, vEgo=t % 3), log.Event.new_message(logMonoTime=t, radarState={"cumLagMs": t % 5})]
+    log1, log2 = read(*msgs1), read(*msgs2)
+
+    diff = compare_logs(log1, log2, IGNORE)
+    assert len(diff) == 17 + 15
+    assert compare_logs(log1, log2, IGNORE, num_workers=2) == diff
+
+  def test_summary(self):
+    log1 = read(*[car_state(t, vEgo=t) for t in range(5)])
+    log2 = read(*[car_state(t, vEgo=t % 2) for t in range(5)])
+    diff_short, _ = format_process_diff(compare_logs(log1, log2, IGNORE))
+    assert diff_short == "        carState.vEgo: 3 (first at logMonoTime 2)\n"
@@ -0,0 +1,37 @@
+from parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.process_replay import IN_PROCESS_PROCS, get_process_config, replay_process
+from openpilot.tools.lib.openpilotci import get_url
+from openpilot.tools.lib.logreader import LogReader
+
+TESTED_SEGMENT = "regenE6D76723DC2|2024-07-29--23-00-08--0"  # TOYOTA.TOYOTA_PRIUS
+
+# measured wall times, which can't match between two replays
+TIMING_FIELDS = {
+  "radard": [("radarState", "cumLagMs")],
+  "plannerd": [("longitudinalPlan", "processingDelay"), ("longitudinalPlan", "solverExecutionTime")],
+}
+
+
+def to_bytes(msgs, proc_name):
+  dats = []
+  for m in msgs:
+    m = m.as_builder()
+    for which, field in TIMING_FIELDS.get(proc_name, []):
+      if m.which() == which:
+        setattr(getattr(m, which), field, 0)
+    dats.append(m.to_bytes())
+  return dats
+
+
+class TestInProcessReplay:
+  @parameterized.expand(sorted(IN_PROCESS_PROCS))
+  def test_matches_socket_replay(self, proc_name):
+    lr = list(LogReader(get_url(*TESTED_SEGMENT.rsplit("--", 1), "rlog")))
+    cfg = get_process_config(proc_name)
+
+    socket_msgs = replay_process(cfg, lr, disable_progress=True)
+    in_process_msgs = replay_process(cfg, lr, disable_progress=True, in_process=True)
+
+    assert len(socket_msgs) > 0
+    assert to_bytes(in_process_msgs, proc_name) == to_bytes(socket_msgs, proc_name)
@@ -0,0 +1,44 @@
+from collections import defaultdict
+
+from openpilot.selfdrive.test.process_replay.process_replay import ProcessConfig, get_process_config, get_process_graphs, replay_process
+from openpilot.tools.lib.openpilotci import get_url
+from openpilot.tools.lib.logreader import LogReader
+
+TESTED_SEGMENT = "regenE6D76723DC2|2024-07-29--23-00-08--0"  # TOYOTA.TOYOTA_PRIUS
+
+
+def group_by_service(msgs):
+  services = defaultdict(list)
+  for m in msgs:
+    services[m.which()].append(m.as_builder().to_bytes())
+  return services
+
+
+class TestProcessGraphs:
+  def test_configs(self):
+    names = ["radard", "calibrationd", "plannerd", "ubloxd", "paramsd"]
+    graphs = get_process_graphs([get_process_config(n) for n in names])
+    assert [[names[i] for i in g] for g in graphs] == [["radard", "plannerd"], ["calibrationd", "paramsd"], ["ubloxd"]]
+
+  def test_transitive(self):
+    # a and c only exchange messages through b, which joins them into one graph
+    cfgs = [
+      ProcessConfig("a", pubs=["x"], subs=["y"], ignore=[]),
+      ProcessConfig("c", pubs=["z"], subs=["w"], ignore=[]),
+      ProcessConfig("d", pubs=["x"], subs=["v"], ignore=[]),
+      ProcessConfig("b", pubs=["y"], subs=["z"], ignore=[]),
+    ]
+    assert get_process_graphs(cfgs) == [[0, 1, 3], [2]]
+
+  def test_parallel_replay(self):
+    lr = list(LogReader(get_url(*TESTED_SEGMENT.rsplit("--", 1), "rlog")))
+    cfgs = [get_process_config(n) for n in ["radard", "plannerd", "calibrationd", "paramsd"]]
+    assert len(get_process_graphs(cfgs)) > 1
+
+    serial_msgs = replay_process(cfgs, lr, disable_progress=True, num_workers=1)
+    parallel_msgs = replay_process(cfgs, lr, disable_progress=True, num_workers=4)
+
+    # messages of different graphs triggered at the same logMonoTime may be interleaved differently,
+    # but each service's messages are identical and in the same order
+    assert len(serial_msgs) > 0
+    assert group_by_service(parallel_msgs) == group_by_service(serial_msgs)
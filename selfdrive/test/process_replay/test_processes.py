@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import concurrent.futures
+import hashlib
 import os
 import sys
 from collections import defaultdict
@@ -13,6 +14,7 @@ from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
                                                                    check_openpilot_enabled, check_most_messages_valid
+from openpilot.selfdrive.test.process_replay.replay_cache import ReplayCache, get_process_source_hash, get_replay_key
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.logreader import LogReader, save_log
 
@@ -68,11 +70,16 @@ EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
+  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat, source_hash = data
   res = None
+  replay_cache = None
   if not args.upload_only:
     lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    replay_key = None
+    if source_hash is not None:
+      replay_cache = ReplayCache()
+      replay_key = get_replay_key(cfg, source_hash, hashlib.sha256(lr_dat).hexdigest())
+    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs, replay_cache, replay_key)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
 
@@ -81,27 +88,37 @@ def run_test_process(data):
     assert os.path.exists(cur_log_fn), f"Cannot find log to upload: {cur_log_fn}"
     upload_file(cur_log_fn, os.path.basename(cur_log_fn))
     os.remove(cur_log_fn)
-  return (segment, cfg.proc_name, res)
+  return (segment, cfg.proc_name, res, replay_cache.hits if replay_cache is not None else 0)
 
 
-def get_log_data(segment):
+def get_log_data(segment, use_cache=False):
   r, n = segment.rsplit("--", 1)
+  if use_cache:
+    return (segment, ReplayCache().get_file(get_url(r, n)))
   with FileReader(get_url(r, n)) as f:
     return (segment, f.read())
 
 
-def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None, replay_cache=None, replay_key=None):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
 
-  ref_log_msgs = list(LogReader(ref_log_path))
-
-  try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
-  except Exception as e:
-    raise Exception("failed on segment: " + segment) from e
+  if replay_cache is not None:
+    ref_log_msgs = list(LogReader.from_bytes(replay_cache.get_file(ref_log_path)))
+  else:
+    ref_log_msgs = list(LogReader(ref_log_path))
+
+  # processes whose sources, config and inputs haven't changed since a previous run aren't replayed again
+  log_msgs = replay_cache.get(replay_key) if replay_cache is not None else None
+  if log_msgs is None:
+    try:
+      log_msgs = replay_process(cfg, lr, disable_progress=True)
+    except Exception as e:
+      raise Exception("failed on segment: " + segment) from e
+    if replay_cache is not None:
+      replay_cache.put(replay_key, log_msgs)
 
   # check to make sure openpilot is engaged in the route
   if cfg.proc_name == "controlsd":
@@ -148,6 +165,8 @@ if __name__ == "__main__":
                       help="Skips testing processes and uploads logs from previous test run")
   parser.add_argument("-j", "--jobs", type=int, default=max(cpu_count - 2, 1),
                       help="Max amount of parallel jobs")
+  parser.add_argument("--no-replay-cache", action="store_true",
+                      help="Replays every process and downloads logs again, instead of reusing the results of previous runs")
   args = parser.parse_args()
 
   tested_procs = set(args.whitelist_procs) - set(args.blacklist_procs)
@@ -179,15 +198,22 @@ if __name__ == "__main__":
     untested = (set(interface_names) - set(excluded_interfaces)) - {c.lower() for c in tested_cars}
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
+  use_cache = not args.no_replay_cache and not args.upload_only
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
   with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    source_hashes: dict[str, str | None] = dict.fromkeys(tested_procs)
     if not args.upload_only:
       download_segments = [seg for car, seg in segments if car in tested_cars]
       log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
+      p1 = pool.map(get_log_data, download_segments, [use_cache] * len(download_segments))
       for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
         log_data[segment] = lr
 
+      if use_cache:
+        procs = sorted(tested_procs)
+        p0 = pool.map(get_process_source_hash, procs)
+        source_hashes = dict(tqdm(zip(procs, p0, strict=True), desc="Hashing Sources", total=len(procs)))
+
     pool_args: Any = []
     for car_brand, segment in segments:
       if car_brand not in tested_cars:
@@ -205,16 +231,25 @@ if __name__ == "__main__":
           ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
 
         dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
+        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat, source_hashes[cfg.proc_name]))
 
         log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
         log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
 
     results: Any = defaultdict(dict)
+    cache_hits = 0
     p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
+    for (segment, proc, result, hits) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
       if not args.upload_only:
         results[segment][proc] = result
+      cache_hits += hits
+
+  if use_cache:
+    replay_cache = ReplayCache()
+    pruned, pruned_size = replay_cache.prune()
+    entries, size = replay_cache.usage()
+    print(f"replay cache: reused {cache_hits}/{len(pool_args)} replays, {entries} entries ({size / 1e6:.1f} MB)")
+    print(f"replay cache: pruned {pruned} entries ({pruned_size / 1e6:.1f} MB)")
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
@@ -0,0 +1,60 @@
+import io
+import os
+import time
+
+from cereal import log
+from openpilot.selfdrive.test.process_replay import replay_cache
+from openpilot.selfdrive.test.process_replay.process_replay import get_process_config
+from openpilot.selfdrive.test.process_replay.replay_cache import ReplayCache, get_replay_key
+
+
+def make_log(n: int):
+  msgs = [log.Event.new_message(logMonoTime=i, radarState={"cumLagMs": i}) for i in range(n)]
+  return list(log.Event.read_multiple_bytes(b"".join(m.to_bytes() for m in msgs)))
+
+
+class TestReplayCache:
+  def test_key(self):
+    key = get_replay_key(get_process_config("radard"), "source", "segment")
+    assert key == get_replay_key(get_process_config("radard"), "source", "segment")
+
+    cfg = get_process_config("radard")
+    cfg.tolerance = 1e-3
+    assert get_replay_key(cfg, "source", "segment") != key
+    assert get_replay_key(get_process_config("radard"), "source2", "segment") != key
+    assert get_replay_key(get_process_config("radard"), "source", "segment2") != key
+    assert get_replay_key(get_process_config("radard"), "source", "segment", {"CarParamsPrevRoute": b"\x00"}) != key
+
+  def test_get_put(self, tmp_path):
+    cache = ReplayCache(str(tmp_path))
+    assert cache.get("key") is None
+
+    msgs = make_log(10)
+    cache.put("key", msgs)
+    cached = cache.get("key")
+    assert [m.as_builder().to_bytes() for m in cached] == [m.as_builder().to_bytes() for m in msgs]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+  def test_get_file(self, mocker, tmp_path):
+    reader = mocker.patch.object(replay_cache, "FileReader", side_effect=lambda fn: io.BytesIO(fn.encode()))
+    cache = ReplayCache(str(tmp_path))
+    for _ in range(2):
+      assert cache.get_file("https://example.com/a") == b"https://example.com/a"
+    assert reader.call_count == 1
+
+  def test_prune(self, tmp_path):
+    cache = ReplayCache(str(tmp_path))
+    for i in range(10):
+      cache.put(str(i), make_log(100))
+      path = os.path.join(tmp_path, "replays", f"{i}.zst")
+      os.utime(path, (time.time() - 1000 + 100 * i, time.time() - 1000 + 100 * i))
+    entries, size = cache.usage()
+    assert entries == 10
+
+    # entries older than max_age go first
+    assert cache.prune(max_size=size, max_age=550)[0] == 5
+    assert cache.get("4") is None and cache.get("5") is not None
+
+    # then the least recently used ones, past the size budget
+    cache.prune(max_size=size // 10 * 2, max_age=10000)
+    assert sorted(os.listdir(os.path.join(tmp_path, "replays"))) == ["5.zst", "9.zst"]
@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import base64
+import bisect
 import hashlib
 import io
 import json
@@ -31,12 +32,14 @@ import cereal.messaging as messaging
 from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import CallbackReader
+from openpilot.common.file_helpers import CallbackReader, atomic_write_in_dir
+from openpilot.common.inotify import IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW, Inotify
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
+from openpilot.system.loggerd.upload_scheduler import PRIORITY_HIGH, Transfer, UploadScheduler
 from openpilot.system.loggerd.uploader import LOG_COMPRESSION_LEVEL
-from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
+from openpilot.system.loggerd.xattr_cache import getxattr
 from openpilot.common.swaglog import cloudlog
 from openpilot.system.version import get_build_metadata
 from openpilot.system.hardware.hw import Paths
@@ -44,10 +47,18 @@ from openpilot.system.hardware.hw import Paths
 
 ATHENA_HOST = os.getenv('ATHENA_HOST', 'wss://athena.comma.ai')
 HANDLER_THREADS = int(os.getenv('HANDLER_THREADS', "4"))
+UPLOAD_HANDLER_THREADS = int(os.getenv('UPLOAD_HANDLER_THREADS', "2"))  # the upload scheduler decides how many upload at once
 LOCAL_PORT_WHITELIST = {8022}
 
+# forwarded swaglogs used to be tracked with this xattr, it's only read to build the index
 LOG_ATTR_NAME = 'user.upload'
 LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(2147483647, 4, sys.byteorder)
+LOG_PREFIX = 'swaglog'
+LOG_INDEX_NAME = '.forwarded'
+LOG_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+LOG_BATCH_SIZE = 512 * 1024  # bytes of logs per forwardLogs request
+MAX_LOG_REQUESTS = 4  # forwardLogs requests waiting for a response
+LOG_RESPONSE_TIMEOUT = 100  # seconds
 RECONNECT_TIMEOUT_S = 70
 
 RETRY_DELAY = 10  # seconds
@@ -143,9 +154,11 @@ def handle_long_poll(ws: WebSocket, exit_event: threading.Event | None) -> None:
     threading.Thread(target=ws_manage, args=(ws, end_event), name='ws_manage'),
     threading.Thread(target=ws_recv, args=(ws, end_event), name='ws_recv'),
     threading.Thread(target=ws_send, args=(ws, end_event), name='ws_send'),
-    threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler'),
     threading.Thread(target=log_handler, args=(end_event,), name='log_handler'),
     threading.Thread(target=stat_handler, args=(end_event,), name='stat_handler'),
+  ] + [
+    threading.Thread(target=upload_handler, args=(end_event,), name=f'upload_handler_{x}')
+    for x in range(UPLOAD_HANDLER_THREADS)
   ] + [
     threading.Thread(target=jsonrpc_handler, args=(end_event,), name=f'worker_{x}')
     for x in range(HANDLER_THREADS)
@@ -208,7 +221,7 @@ def retry_upload(tid: int, end_event: threading.Event, increase_count: bool = Tr
         break
 
 
-def cb(sm, item, tid, end_event: threading.Event, sz: int, cur: int) -> None:
+def cb(sm, item, tid, end_event: threading.Event, transfer: Transfer, sz: int, cur: int) -> None:
   # Abort transfer if connection changed to metered after starting upload
   # or if athenad is shutting down to re-connect the websocket
   sm.update(0)
@@ -220,10 +233,12 @@ def cb(sm, item, tid, end_event: threading.Event, sz: int, cur: int) -> None:
     raise AbortTransferException
 
   cur_upload_items[tid] = replace(item, progress=cur / sz if sz else 1)
+  transfer.update(cur)
 
 
 def upload_handler(end_event: threading.Event) -> None:
   sm = messaging.SubMaster(['deviceState'])
+  scheduler = UploadScheduler()
   tid = threading.get_ident()
 
   while not end_event.is_set():
@@ -250,6 +265,13 @@ def upload_handler(end_event: threading.Event) -> None:
         retry_upload(tid, end_event, False)
         continue
 
+      # user requested files go ahead of the uploader's files, under the same bandwidth limit
+      scheduler.set_network(network_type, metered)
+      transfer = scheduler.acquire(PRIORITY_HIGH, end_event)
+      if transfer is None:
+        retry_upload(tid, end_event, False)
+        continue
+
       try:
         fn = item.path
         try:
@@ -258,7 +280,9 @@ def upload_handler(end_event: threading.Event) -> None:
           sz = -1
 
         cloudlog.event("athena.upload_handler.upload_start", fn=fn, sz=sz, network_type=network_type, metered=metered, retry_count=item.retry_count)
-        response = _do_upload(item, partial(cb, sm, item, tid, end_event))
+        # the transfer is released before retrying
+        with transfer:
+          response = _do_upload(item, partial(cb, sm, item, tid, end_event, transfer))
 
         if response.status_code not in (200, 201, 401, 403, 412):
           cloudlog.event("athena.upload_handler.retry", status_code=response.status_code, fn=fn, sz=sz, network_type=network_type, metered=metered)
@@ -538,84 +562,178 @@ def takeSnapshot() -> str | dict[str, str] | None:
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
-  curr_time = int(time.time())
-  logs = []
-  for log_entry in os.listdir(Paths.swaglog_root()):
-    log_path = os.path.join(Paths.swaglog_root(), log_entry)
-    time_sent = 0
+class SwaglogIndex:
+  """
+  Swaglog files waiting to be forwarded, kept current with inotify instead of listing the directory. When each file
+  was sent and which ones were acknowledged is saved in an index file, rather than in an xattr on every file.
+  """
+  def __init__(self, root: str):
+    self.root = root
+    self.path = os.path.join(root, LOG_INDEX_NAME)
+    self.files: list[str] = []
+    self.sent: dict[str, int] = {}
+    self.acked: set[str] = set()
+    self.last_scan = 0.
+
     try:
-      value = getxattr(log_path, LOG_ATTR_NAME)
-      if value is not None:
-        time_sent = int.from_bytes(value, sys.byteorder)
-    except (ValueError, TypeError):
-      pass
+      self.inotify: Inotify | None = Inotify()
+    except OSError:
+      cloudlog.exception("athena.log_handler.inotify_unavailable")
+      self.inotify = None
+    self.scan()
+
+    try:
+      with open(self.path) as f:
+        index = json.load(f)
+      self.sent, self.acked = index["sent"], set(index["acked"])
+    except FileNotFoundError:
+      self.migrate_xattrs()
+    except Exception:
+      cloudlog.exception("athena.log_handler.index_load_failed")
+
+  def scan(self) -> None:
+    if self.inotify is not None:
+      # drop the pending events, the scan is more recent
+      self.inotify.read()
+      try:
+        self.inotify.add_watch(self.root, LOG_WATCH_MASK)
+      except OSError:
+        cloudlog.exception("athena.log_handler.add_watch_failed")
+    self.files = sorted(fn for fn in os.listdir(self.root) if fn.startswith(LOG_PREFIX))
+    self.last_scan = time.monotonic()
+
+  def migrate_xattrs(self) -> None:
+    # state of logs forwarded before the index was kept
+    for log_entry in self.files:
+      try:
+        value = getxattr(os.path.join(self.root, log_entry), LOG_ATTR_NAME)
+      except OSError:
+        continue
+      if value == LOG_ATTR_VALUE_MAX_UNIX_TIME:
+        self.acked.add(log_entry)
+      elif value is not None:
+        self.sent[log_entry] = int.from_bytes(value, sys.byteorder)
+
+  def save(self) -> None:
+    files = set(self.files)
+    self.sent = {k: v for k, v in self.sent.items() if k in files}
+    self.acked &= files
+    try:
+      with atomic_write_in_dir(self.path, overwrite=True) as f:
+        json.dump({"sent": self.sent, "acked": sorted(self.acked)}, f)
+    except OSError:
+      cloudlog.exception("athena.log_handler.index_save_failed")
+
+  def update(self, timeout: float = 0) -> None:
+    if self.inotify is None:
+      if time.monotonic() - self.last_scan > 10:
+        self.scan()
+      time.sleep(timeout)
+      return
+
+    events = self.inotify.read(timeout)
+    if any(event.mask & IN_Q_OVERFLOW for event in events):
+      self.scan()
+      return
+
+    for event in events:
+      if not event.name.startswith(LOG_PREFIX):
+        continue
+      i = bisect.bisect_left(self.files, event.name)
+      exists = i < len(self.files) and self.files[i] == event.name
+      if event.mask & (IN_CREATE | IN_MOVED_TO) and not exists:
+        self.files.insert(i, event.name)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM) and exists:
+        del self.files[i]
+
+  def pending(self) -> list[str]:
     # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+    curr_time = int(time.time())
+    logs = [f for f in self.files if f not in self.acked and curr_time - self.sent.get(f, 0) > 3600]
+    # excluding most recent (active) log file
+    if len(self.files) and len(logs) and logs[-1] == self.files[-1]:
+      logs.pop()
+    return logs
+
+  def mark_sent(self, log_entries: list[str]) -> None:
+    curr_time = int(time.time())
+    self.sent.update(dict.fromkeys(log_entries, curr_time))
+    self.save()
+
+  def mark_acked(self, log_entries: list[str]) -> None:
+    self.acked.update(log_entries)
+    for log_entry in log_entries:
+      self.sent.pop(log_entry, None)
+    self.save()
+
+
+def get_log_batch(index: SwaglogIndex) -> tuple[list[str], str]:
+  # newest logs first, several of them per request
+  log_entries: list[str] = []
+  logs: list[str] = []
+  size = 0
+  for log_entry in reversed(index.pending()):
+    try:
+      with open(os.path.join(index.root, log_entry)) as f:
+        dat = f.read()
+    except OSError:
+      continue  # file could be deleted by log rotation
+
+    if len(log_entries) and size + len(dat) > LOG_BATCH_SIZE:
+      break
+    log_entries.append(log_entry)
+    logs.append(dat)
+    size += len(dat)
+  return log_entries, "".join(logs)
 
 
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
-  last_scan = 0.
+  index = SwaglogIndex(Paths.swaglog_root())
+  # forwardLogs requests waiting for a response, by id
+  requests_sent: dict[str, float] = {}
   while not end_event.is_set():
     try:
-      curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
-
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
-          curr_time = int(time.time())
-          log_path = os.path.join(Paths.swaglog_root(), log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path) as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
-
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
+      # keep a few requests in flight, a response can take a while
+      curr_time = time.monotonic()
+      requests_sent = {k: t for k, t in requests_sent.items() if curr_time - t < LOG_RESPONSE_TIMEOUT}
+      while len(requests_sent) < MAX_LOG_REQUESTS:
+        log_entries, logs = get_log_batch(index)
+        if not len(log_entries):
           break
+
+        # the id lists the files, so a response is matched to them even after a restart
+        log_id = ",".join(log_entries)
+        cloudlog.debug(f"athena.log_handler.forward_request {log_id}")
+        index.mark_sent(log_entries)
+        jsonrpc = {
+          "method": "forwardLogs",
+          "params": {
+            "logs": logs
+          },
+          "jsonrpc": "2.0",
+          "id": log_id
+        }
+        low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+        requests_sent[log_id] = curr_time
+
+      # always read queue to process any old responses that arrive
+      while True:
         try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(Paths.swaglog_root(), log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
+          log_resp = json.loads(log_recv_queue.get_nowait())
         except queue.Empty:
-          if curr_log is None:
-            break
-
+          break
+        log_id = log_resp.get("id")
+        log_success = "result" in log_resp and log_resp["result"].get("success")
+        cloudlog.debug(f"athena.log_handler.forward_response {log_id} {log_success}")
+        if isinstance(log_id, str):
+          requests_sent.pop(log_id, None)
+          if log_success:
+            index.mark_acked(log_id.split(","))
+
+      index.update(timeout=1)
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
 
@@ -416,7 +416,7 @@ class TestAthenadMethods:
       end_event.set()
       thread.join()
 
-  def test_get_logs_to_send_sorted(self):
+  def test_swaglog_index(self):
     fl = list()
     for i in range(10):
       file = f'swaglog.{i:010}'
@@ -424,5 +424,27 @@ class TestAthenadMethods:
       fl.append(file)
 
     # ensure the list is all logs except most recent
-    sl = athenad.get_logs_to_send_sorted()
-    assert sl == fl[:-1]
+    index = athenad.SwaglogIndex(Paths.swaglog_root())
+    assert index.pending() == fl[:-1]
+
+    # sent and acknowledged logs are left out, also after a restart
+    index.mark_sent(fl[:4])
+    index.mark_acked(fl[:2])
+    assert index.pending() == fl[4:-1]
+    assert athenad.SwaglogIndex(Paths.swaglog_root()).pending() == fl[4:-1]
+
+    # new and rotated out logs are picked up
+    self._create_file('swaglog.0000000010', Paths.swaglog_root())
+    os.remove(os.path.join(Paths.swaglog_root(), fl[5]))
+    index.update(timeout=1)
+    assert index.pending() == fl[4:5] + fl[6:]
+
+  def test_get_log_batch(self, mocker):
+    mocker.patch.object(athenad, "LOG_BATCH_SIZE", 250)
+    for i in range(5):
+      self._create_file(f'swaglog.{i:010}', Paths.swaglog_root(), str(i).encode() * 100)
+
+    # newest logs first, as many as fit in a batch
+    log_entries, logs = athenad.get_log_batch(athenad.SwaglogIndex(Paths.swaglog_root()))
+    assert log_entries == ['swaglog.0000000003', 'swaglog.0000000002']
+    assert logs == '3' * 100 + '2' * 100
@@ -0,0 +1,96 @@
+import threading
+import time
+
+from openpilot.system.loggerd import upload_scheduler
+from openpilot.system.loggerd.upload_scheduler import PRIORITY_HIGH, PRIORITY_LOW, NetworkType, UploadScheduler
+
+
+def acquire_in_thread(scheduler: UploadScheduler, priority: int, granted: list, end_event: threading.Event) -> threading.Thread:
+  def acquire():
+    transfer = scheduler.acquire(priority, end_event)
+    if transfer is not None:
+      granted.append((priority, transfer))
+  thread = threading.Thread(target=acquire, daemon=True)
+  thread.start()
+  return thread
+
+
+class TestUploadScheduler:
+  def test_slots(self, tmp_path):
+    scheduler = UploadScheduler(str(tmp_path / "state.json"))
+    scheduler.set_network(NetworkType.wifi, False)
+
+    transfers = [scheduler.acquire(PRIORITY_LOW) for _ in range(3)]
+    assert scheduler.get_stats().active == 3
+
+    # the last slot is kept for high priority transfers
+    granted: list = []
+    end_event = threading.Event()
+    low = acquire_in_thread(scheduler, PRIORITY_LOW, granted, end_event)
+    time.sleep(1)
+    assert granted == []
+    assert scheduler.get_stats().waiting == 1
+
+    high = scheduler.acquire(PRIORITY_HIGH)
+    assert scheduler.get_stats().active == 4
+
+    transfers[0].release()
+    low.join(timeout=5)
+    assert [p for p, _ in granted] == [PRIORITY_LOW]
+
+    for t in [*transfers[1:], high, granted[0][1]]:
+      t.release()
+    assert scheduler.get_stats().active == 0
+
+  def test_priority_order(self, tmp_path):
+    # another process, or another instance in this one, sees the same state
+    scheduler = UploadScheduler(str(tmp_path / "state.json"))
+    other = UploadScheduler(str(tmp_path / "state.json"))
+    scheduler.set_network(NetworkType.cell4G, False)
+
+    first = scheduler.acquire(PRIORITY_LOW)
+    granted: list = []
+    end_event = threading.Event()
+    threads = [acquire_in_thread(other, PRIORITY_LOW, granted, end_event)]
+    time.sleep(0.5)
+    threads.append(acquire_in_thread(scheduler, PRIORITY_HIGH, granted, end_event))
+    time.sleep(0.5)
+    assert granted == []
+
+    first.release()
+    time.sleep(1)
+    assert [p for p, _ in granted] == [PRIORITY_HIGH]
+
+    end_event.set()
+    for t in threads:
+      t.join(timeout=5)
+    granted[0][1].release()
+    assert scheduler.get_stats() == (0, 0, upload_scheduler.BANDWIDTH_LIMITS["cell"], 0)
+
+  def test_bandwidth_limit(self, mocker, tmp_path):
+    limit = 1024 * 1024
+    mocker.patch.dict(upload_scheduler.BANDWIDTH_LIMITS, {"metered": limit})
+    scheduler = UploadScheduler(str(tmp_path / "state.json"))
+    scheduler.set_network(NetworkType.wifi, True)
+
+    st = time.monotonic()
+    with scheduler.acquire(PRIORITY_HIGH) as transfer:
+      for sent in range(0, 3 * limit + 1, 32 * 1024):
+        transfer.update(sent)
+    dt = time.monotonic() - st
+
+    # a second's worth can be sent at once, the rest is held to the limit
+    assert 1.8 < dt < 3
+    assert scheduler.get_stats().throughput > 0
+
+  def test_dead_process(self, tmp_path):
+    scheduler = UploadScheduler(str(tmp_path / "state.json"))
+    scheduler.set_network(NetworkType.cell4G, False)
+    with scheduler._state() as state:
+      state["transfers"]["dead"] = {"pid": 2**22 + 1, "priority": PRIORITY_HIGH, "since": 0., "active": True}
+
+    end_event = threading.Event()
+    threading.Timer(2, end_event.set).start()
+    transfer = scheduler.acquire(PRIORITY_LOW, end_event)
+    assert transfer is not None
+    transfer.release()
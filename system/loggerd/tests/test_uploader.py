@@ -1,12 +1,18 @@
 import os
+import re
 import time
 import threading
 import logging
 import json
+import pytest
+import requests
+import zstandard as zstd
 from pathlib import Path
+from urllib.parse import parse_qs, urlparse
 from openpilot.system.hardware.hw import Paths
 
 from openpilot.common.swaglog import cloudlog
+from openpilot.system.loggerd import uploader
 from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
 
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
@@ -148,6 +154,26 @@ class TestUploader(UploaderTestCase):
 
     assert log_handler.upload_order == exp_order, "Files uploaded in wrong order"
 
+  def test_upload_files_created_after_start(self):
+    uploader.UPLOAD_WORKERS = 4
+    self.start_thread()
+    time.sleep(0.25)
+
+    # picked up from the upload queue's watches, not the startup scan
+    seg_nums = [0, 1, 2]
+    for i in seg_nums:
+      self.seg_dir = self.seg_format.format(i)
+      self.gen_files(lock=True)
+      for f_path in Path(Paths.log_root()).glob("**/*.lock"):
+        f_path.unlink()
+
+    time.sleep(5)
+    self.join_thread()
+
+    exp_order = self.gen_order(seg_nums, [])
+    assert len(log_handler.upload_ignored) == 0, "Some files were ignored"
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Files not uploaded exactly once"
+
   def test_no_upload_with_lock_file(self):
     self.start_thread()
 
@@ -182,3 +208,69 @@ class TestUploader(UploaderTestCase):
     for f_path in f_paths:
       lock_path = f_path.with_suffix(f_path.suffix + ".lock")
       assert not lock_path.is_file(), "File lock not cleared on startup"
+
+
+class FakeBlobResponse:
+  def __init__(self, status_code, content=b""):
+    self.status_code = status_code
+    self.content = content
+
+
+class FakeBlockBlob:
+  def __init__(self, fail_after=None):
+    self.blocks: dict[str, bytes] = {}
+    self.blob = b""
+    self.sent_blocks = 0
+    self.fail_after = fail_after
+
+  def get(self, url, headers, timeout):
+    blocks = "".join(f"<Block><Name>{k}</Name><Size>{len(v)}</Size></Block>" for k, v in self.blocks.items())
+    return FakeBlobResponse(200, f"<BlockList><UncommittedBlocks>{blocks}</UncommittedBlocks></BlockList>".encode())
+
+  def put(self, url, data, headers, timeout):
+    query = parse_qs(urlparse(url).query)
+    if query["comp"] == ["block"]:
+      if self.fail_after is not None and self.sent_blocks >= self.fail_after:
+        raise requests.exceptions.ConnectionError
+      self.blocks[query["blockid"][0]] = data
+      self.sent_blocks += 1
+    else:
+      self.blob = b"".join(self.blocks[block_id] for block_id in re.findall(r"<Latest>(.*?)</Latest>", data))
+      self.blocks = {}
+    return FakeBlobResponse(201)
+
+
+class TestUploadStream:
+  def test_put_file(self, mocker, tmp_path):
+    fn = tmp_path / "qlog"
+    fn.write_bytes(os.urandom(1024 * 1024) * 8)
+    put = mocker.patch("requests.put")
+    for compress in (False, True):
+      put.side_effect = lambda url, data, headers, timeout: FakeBlobResponse(201, data.read())
+      progress = []
+      resp = uploader.put_file("http://localhost/qlog", {}, str(fn), compress, progress.append)
+      sent = zstd.decompress(resp.content) if compress else resp.content
+      assert sent == fn.read_bytes()
+      assert int(put.call_args.kwargs["headers"]["Content-Length"]) == len(resp.content) == progress[-1]
+
+  def test_resume_block_upload(self, mocker, tmp_path):
+    fn = tmp_path / "rlog"
+    fn.write_bytes(os.urandom(3 * uploader.UPLOAD_BLOCK_SIZE))
+    blob = FakeBlockBlob(fail_after=2)
+    mocker.patch("requests.get", side_effect=blob.get)
+    put = mocker.patch("requests.put", side_effect=blob.put)
+
+    headers = {"x-ms-blob-type": "BlockBlob"}
+    with pytest.raises(requests.exceptions.ConnectionError):
+      uploader.put_file_blocks("http://localhost/rlog.zst?sig=0", headers, str(fn), True)
+
+    # only the blocks that didn't make it are sent again
+    blob.fail_after = None
+    blob.sent_blocks = 0
+    put.reset_mock()
+    progress = []
+    assert uploader.put_file_blocks("http://localhost/rlog.zst?sig=0", headers, str(fn), True, progress.append).status_code == 201
+    assert blob.sent_blocks == 2
+    # skipped blocks aren't reported as sent
+    assert progress[-1] == sum(len(c.kwargs["data"]) for c in put.call_args_list if "comp=block&" in c.args[0])
+    assert zstd.decompress(blob.blob) == fn.read_bytes()
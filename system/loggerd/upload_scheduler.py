@@ -0,0 +1,221 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from typing import NamedTuple
+
+from cereal import log
+from openpilot.system.hardware.hw import Paths
+
+NetworkType = log.DeviceState.NetworkType
+
+PRIORITY_HIGH = 0  # qlogs, crash and boot logs, and files requested by the user
+PRIORITY_LOW = 1
+
+# concurrent transfers of all uploading processes, by network type. one of them is kept for high priority transfers
+MAX_TRANSFERS = {
+  NetworkType.wifi: 4,
+  NetworkType.ethernet: 4,
+}
+DEFAULT_MAX_TRANSFERS = 1
+
+# upload rate of all transfers in bytes/s, 0 for no limit
+BANDWIDTH_LIMITS = {
+  "unmetered": int(os.getenv("UPLOAD_BANDWIDTH_LIMIT", "0")),
+  "cell": int(os.getenv("UPLOAD_CELL_BANDWIDTH_LIMIT", str(2 * 1024 * 1024))),
+  "metered": int(os.getenv("UPLOAD_METERED_BANDWIDTH_LIMIT", str(512 * 1024))),
+}
+BANDWIDTH_BURST = 1.  # s of bandwidth that can be used at once after being idle
+
+SCHEDULE_INTERVAL = 0.2  # s between checks for a free transfer slot
+THROTTLE_BYTES = 128 * 1024  # bytes sent between updates of the shared bandwidth budget
+THROUGHPUT_WINDOW = 5  # s
+
+
+class UploadStats(NamedTuple):
+  active: int
+  waiting: int
+  bandwidth_limit: int
+  throughput: float  # bytes/s
+
+
+def get_bandwidth_limit(network_type: int, metered: bool) -> int:
+  if metered:
+    return BANDWIDTH_LIMITS["metered"]
+  elif network_type in (NetworkType.cell2G, NetworkType.cell3G, NetworkType.cell4G, NetworkType.cell5G):
+    return BANDWIDTH_LIMITS["cell"]
+  return BANDWIDTH_LIMITS["unmetered"]
+
+
+def _can_start(priority: int, active: list[int], max_transfers: int) -> bool:
+  if priority != PRIORITY_HIGH and max_transfers > 1 and active[PRIORITY_LOW] >= max_transfers - 1:
+    return False
+  return sum(active) < max_transfers
+
+
+def _pid_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+class Transfer:
+  def __init__(self, scheduler: "UploadScheduler", tid: str):
+    self.scheduler = scheduler
+    self.tid = tid
+    self.sent = 0
+    self.pending = 0
+
+  def __enter__(self) -> "Transfer":
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.release()
+
+  def update(self, sent: int) -> None:
+    """Called with the bytes sent so far, sleeps to keep all uploads under the bandwidth limit."""
+    if sent < self.sent:
+      # the upload was restarted
+      self.sent = sent
+      return
+
+    self.pending += sent - self.sent
+    self.sent = sent
+    if self.pending >= THROTTLE_BYTES:
+      self.scheduler.consume(self.pending)
+      self.pending = 0
+
+  def release(self) -> None:
+    if self.pending:
+      self.scheduler.consume(self.pending, wait=False)
+      self.pending = 0
+    self.scheduler.remove(self.tid)
+
+
+class UploadScheduler:
+  """
+  Schedules the transfers of all uploading processes, uploader and athenad, through state shared in a locked file.
+  Transfers wait for one of the slots of the current network, granted in priority order with one slot kept for high
+  priority transfers, and share a token bucket for the bandwidth limit of the current network.
+  """
+  def __init__(self, path: str = None):
+    self.path = path or os.path.join(Paths.config_root(), "upload_scheduler.json")
+    # the file lock is held by the process, threads take turns with this lock
+    self.lock = threading.Lock()
+    self.fd: int | None = None
+    self.count = 0
+    self.network: tuple[int, bool] | None = None
+
+  @contextlib.contextmanager
+  def _state(self, write: bool = True) -> Iterator[dict]:
+    with self.lock:
+      if self.fd is None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+
+      fcntl.flock(self.fd, fcntl.LOCK_EX)
+      try:
+        try:
+          state = json.loads(os.pread(self.fd, os.fstat(self.fd).st_size, 0))
+        except ValueError:
+          state = {}
+        state = {"max_transfers": DEFAULT_MAX_TRANSFERS, "limit": 0, "tokens": 0., "refilled": 0., "sent": [], "transfers": {},
+                 **state}
+        # transfers of processes that exited without releasing them
+        state["transfers"] = {k: t for k, t in state["transfers"].items() if _pid_alive(t["pid"])}
+
+        yield state
+
+        if write:
+          dat = json.dumps(state).encode()
+          os.pwrite(self.fd, dat, 0)
+          os.ftruncate(self.fd, len(dat))
+      finally:
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def set_network(self, network_type: int, metered: bool) -> None:
+    if self.network == (network_type, metered):
+      return
+    self.network = (network_type, metered)
+
+    with self._state() as state:
+      state["max_transfers"] = MAX_TRANSFERS.get(network_type, DEFAULT_MAX_TRANSFERS)
+      state["limit"] = get_bandwidth_limit(network_type, metered)
+
+  def _grant(self, state: dict, tid: str) -> bool:
+    transfers = state["transfers"]
+    active = [0, 0]
+    for t in transfers.values():
+      active[t["priority"]] += t["active"]
+
+    for priority, _, k in sorted((t["priority"], t["since"], k) for k, t in transfers.items() if not t["active"]):
+      if not _can_start(priority, active, state["max_transfers"]):
+        continue
+      if k == tid:
+        transfers[k]["active"] = True
+        return True
+      # leave the slot to a transfer that's waiting longer
+      active[priority] += 1
+    return False
+
+  def acquire(self, priority: int, end_event: threading.Event = None) -> Transfer | None:
+    """Waits for a transfer slot, returns None if end_event is set first."""
+    with self.lock:
+      self.count += 1
+      tid = f"{os.getpid()}-{threading.get_ident()}-{self.count}"
+
+    with self._state() as state:
+      state["transfers"][tid] = {"pid": os.getpid(), "priority": priority, "since": time.monotonic(), "active": False}
+
+    try:
+      while True:
+        with self._state() as state:
+          if self._grant(state, tid):
+            return Transfer(self, tid)
+
+        if end_event is None:
+          time.sleep(SCHEDULE_INTERVAL)
+        elif end_event.wait(SCHEDULE_INTERVAL):
+          self.remove(tid)
+          return None
+    except BaseException:
+      self.remove(tid)
+      raise
+
+  def remove(self, tid: str) -> None:
+    with self._state() as state:
+      state["transfers"].pop(tid, None)
+
+  def consume(self, nbytes: int, wait: bool = True) -> None:
+    now = time.monotonic()
+    with self._state() as state:
+      second = int(now)
+      sent = [s for s in state["sent"] if s[0] > second - THROUGHPUT_WINDOW]
+      if len(sent) and sent[-1][0] == second:
+        sent[-1][1] += nbytes
+      else:
+        sent.append([second, nbytes])
+      state["sent"] = sent
+
+      limit = state["limit"]
+      if limit > 0:
+        # tokens can go negative, the transfer that took them waits until they're paid back
+        tokens = min(limit * BANDWIDTH_BURST, state["tokens"] + (now - state["refilled"]) * limit) - nbytes
+        state["tokens"], state["refilled"] = tokens, now
+
+    if wait and limit > 0 and tokens < 0:
+      time.sleep(-tokens / limit)
+
+  def get_stats(self) -> UploadStats:
+    now = time.monotonic()
+    with self._state(write=False) as state:
+      active = sum(t["active"] for t in state["transfers"].values())
+      sent = sum(b for second, b in state["sent"] if second > int(now) - THROUGHPUT_WINDOW)
+      return UploadStats(active, len(state["transfers"]) - active, state["limit"], sent / THROUGHPUT_WINDOW)
@@ -1,22 +1,31 @@
 #!/usr/bin/env python3
-import io
+import base64
+import bisect
+import hashlib
 import json
 import os
 import random
 import requests
+import tempfile
 import threading
 import time
 import traceback
 import datetime
+import xml.etree.ElementTree as ET
 import zstandard as zstd
-from collections.abc import Iterator
+import capnp
+from collections.abc import Callable, Iterator
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
+from openpilot.common.file_helpers import CallbackReader
+from openpilot.common.inotify import IN_ATTRIB, IN_CREATE, IN_DELETE, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, \
+                                     IN_ONLYDIR, IN_Q_OVERFLOW, Inotify, InotifyEvent
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
+from openpilot.system.loggerd.upload_scheduler import PRIORITY_HIGH, PRIORITY_LOW, Transfer, UploadScheduler
 from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
 from openpilot.common.swaglog import cloudlog
 
@@ -26,12 +35,109 @@ UPLOAD_ATTR_VALUE = b'1'
 
 UPLOAD_QLOG_QCAM_MAX_SIZE = 5 * 1e6  # MB
 LOG_COMPRESSION_LEVEL = 10  # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_CHUNK_SIZE = 128 * 1024
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024  # resumable uploads are sent in blocks of this size, the most that's held in memory
+UPLOAD_QUEUE_RESCAN_INTERVAL = 10 * 60  # resync the upload queue with the disk, in case a change was missed
+UPLOAD_QUEUE_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ATTRIB | IN_ONLYDIR
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))  # the upload scheduler decides how many of them upload at once
 
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
 
+class UploadBody:
+  """File-like request body with a known length, so requests sends it with a Content-Length,
+  reading it as the socket drains instead of all at once."""
+  def __init__(self, f, length: int, callback: Callable[[int], None] = None):
+    self.f = CallbackReader(f, callback) if callback else f
+    self.length = length
+
+  def __len__(self) -> int:
+    return self.length
+
+  def read(self, *args) -> bytes:
+    return self.f.read(*args)
+
+
+def read_upload_chunks(fn: str, compress: bool) -> Iterator[bytes]:
+  # reads the file in chunks, zstd compressing it on the fly
+  with open(fn, "rb") as f:
+    if compress:
+      cctx = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
+      yield from cctx.read_to_iter(f, size=os.fstat(f.fileno()).st_size, read_size=UPLOAD_CHUNK_SIZE, write_size=UPLOAD_CHUNK_SIZE)
+    else:
+      while chunk := f.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+
+def read_upload_blocks(chunks: Iterator[bytes], block_size: int = UPLOAD_BLOCK_SIZE) -> Iterator[bytes]:
+  buf = bytearray()
+  for chunk in chunks:
+    buf += chunk
+    while len(buf) >= block_size:
+      yield bytes(buf[:block_size])
+      del buf[:block_size]
+  if len(buf):
+    yield bytes(buf)
+
+
+def _url_with_query(url: str, query: str) -> str:
+  return f"{url}{'&' if '?' in url else '?'}{query}"
+
+
+def put_file(url: str, headers: dict[str, str], fn: str, compress: bool, callback: Callable[[int], None] = None,
+             timeout: int = 10) -> requests.Response:
+  """Uploads the file in a single PUT, streamed from disk. Compressed data is spooled to disk past UPLOAD_BLOCK_SIZE."""
+  if not compress:
+    with open(fn, "rb") as f:
+      data = UploadBody(f, os.fstat(f.fileno()).st_size, callback)
+      return requests.put(url, data=data, headers={**headers, 'Content-Length': str(len(data))}, timeout=timeout)
+
+  with tempfile.SpooledTemporaryFile(max_size=UPLOAD_BLOCK_SIZE) as f:
+    for chunk in read_upload_chunks(fn, compress):
+      f.write(chunk)
+    data = UploadBody(f, f.tell(), callback)
+    f.seek(0)
+    return requests.put(url, data=data, headers={**headers, 'Content-Length': str(len(data))}, timeout=timeout)
+
+
+def put_file_blocks(url: str, headers: dict[str, str], fn: str, compress: bool, callback: Callable[[int], None] = None,
+                    timeout: int = 10) -> requests.Response:
+  """
+  Uploads the file as a block blob, compressing it while it's sent, one block at a time. Blocks are named after
+  their index and content, so blocks left uncommitted by an earlier attempt to upload the same file are not sent again.
+  The callback gets the bytes sent so far, which don't include those skipped blocks.
+  """
+  block_headers = {k: v for k, v in headers.items() if k.lower() != 'x-ms-blob-type'}
+
+  uploaded: dict[str, int] = {}
+  resp = requests.get(_url_with_query(url, "comp=blocklist&blocklisttype=uncommitted"), headers=block_headers, timeout=timeout)
+  if resp.status_code == 200:
+    for block in ET.fromstring(resp.content).iter("Block"):
+      uploaded[block.findtext("Name", "")] = int(block.findtext("Size", "0"))
+
+  block_ids = []
+  sent = 0
+  for i, block in enumerate(read_upload_blocks(read_upload_chunks(fn, compress))):
+    block_id = base64.b64encode(f"{i:06d}-{hashlib.sha1(block).hexdigest()}".encode()).decode()
+    block_ids.append(block_id)
+    if uploaded.get(block_id) != len(block):
+      resp = requests.put(_url_with_query(url, f"comp=block&blockid={requests.utils.quote(block_id, safe='')}"), data=block,
+                          headers=block_headers, timeout=timeout)
+      if resp.status_code not in (200, 201):
+        return resp
+
+      sent += len(block)
+      if callback is not None:
+        callback(sent)
+
+  block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+  return requests.put(_url_with_query(url, "comp=blocklist"), headers=block_headers, timeout=timeout,
+                      data=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>')
+
+
 class FakeRequest:
   def __init__(self):
     self.headers = {"Content-Length": "0"}
@@ -71,6 +177,146 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
+class UploadQueue:
+  """
+  Files waiting to be uploaded, in upload order: files in the immediate folders first, then the files with an
+  immediate priority, by log directory and priority. The log root is scanned once and then kept current with inotify,
+  instead of listing every log directory for each upload. Without inotify, it's rescanned on every update.
+  """
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+
+    # sorted (pass, directory sort, priority, name, logdir) entries, and the entry of each file
+    self.order: list[tuple] = []
+    self.entries: dict[str, tuple] = {}
+    # log directories with lock files, which are still being written
+    self.locked: set[str] = set()
+
+    self.root_wd: int | None = None
+    self.watches: dict[int, str] = {}
+    self.last_scan = 0.
+    try:
+      self.inotify: Inotify | None = Inotify()
+    except OSError:
+      cloudlog.exception("uploader inotify unavailable, rescanning on every update")
+      self.inotify = None
+
+  def _entry(self, logdir: str, name: str) -> tuple | None:
+    immediate = any(f in os.path.join(self.root, logdir, name) for f in self.immediate_folders)
+    if not immediate and name not in self.immediate_priority:
+      return None
+    return (0 if immediate else 1, get_directory_sort(logdir), self.immediate_priority.get(name, 1000), name, logdir)
+
+  def _add(self, logdir: str, name: str) -> None:
+    entry = self._entry(logdir, name)
+    if entry is None:
+      return
+
+    fn = os.path.join(self.root, logdir, name)
+    try:
+      is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+    except OSError:
+      # deleter could have deleted, so skip
+      is_uploaded = True
+    if is_uploaded:
+      self._remove(fn)
+    elif fn not in self.entries:
+      self.entries[fn] = entry
+      bisect.insort(self.order, entry)
+
+  def _remove(self, fn: str) -> None:
+    entry = self.entries.pop(fn, None)
+    if entry is not None:
+      self.order.remove(entry)
+
+  def _update_lock(self, logdir: str) -> None:
+    try:
+      locked = any(name.endswith(".lock") for name in os.listdir(os.path.join(self.root, logdir)))
+    except OSError:
+      locked = False
+    if locked:
+      self.locked.add(logdir)
+    else:
+      self.locked.discard(logdir)
+
+  def _scan_dir(self, logdir: str) -> None:
+    path = os.path.join(self.root, logdir)
+    # watch before listing, so files created in between aren't missed
+    if self.inotify is not None:
+      try:
+        self.watches[self.inotify.add_watch(path, UPLOAD_QUEUE_WATCH_MASK)] = logdir
+      except OSError:
+        return
+
+    try:
+      names = os.listdir(path)
+    except OSError:
+      return
+
+    if any(name.endswith(".lock") for name in names):
+      self.locked.add(logdir)
+    for name in names:
+      if not name.endswith(".lock"):
+        self._add(logdir, name)
+
+  def _remove_dir(self, logdir: str) -> None:
+    for fn, entry in list(self.entries.items()):
+      if entry[4] == logdir:
+        self._remove(fn)
+    self.locked.discard(logdir)
+
+  def scan(self) -> None:
+    self.order, self.entries, self.locked = [], {}, set()
+    self.last_scan = time.monotonic()
+    if self.inotify is not None:
+      # drop the pending events, the scan is more recent
+      self.inotify.read()
+      try:
+        self.root_wd = self.inotify.add_watch(self.root, UPLOAD_QUEUE_WATCH_MASK)
+      except OSError:
+        self.root_wd = None
+
+    for logdir in listdir_by_creation(self.root):
+      self._scan_dir(logdir)
+
+  def _handle_event(self, event: InotifyEvent) -> None:
+    if event.mask & IN_IGNORED:
+      self.watches.pop(event.wd, None)
+    elif event.wd == self.root_wd:
+      if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+        self._scan_dir(event.name)
+      elif event.mask & IN_ISDIR and event.mask & (IN_DELETE | IN_MOVED_FROM):
+        self._remove_dir(event.name)
+    elif event.wd in self.watches:
+      logdir = self.watches[event.wd]
+      if event.name.endswith(".lock"):
+        self._update_lock(logdir)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+        self._remove(os.path.join(self.root, logdir, event.name))
+      elif event.mask & (IN_CREATE | IN_MOVED_TO | IN_ATTRIB):
+        # attribute changes include the upload xattr being set, by us or athenad
+        self._add(logdir, event.name)
+
+  def update(self) -> None:
+    if self.inotify is None or self.root_wd is None or time.monotonic() - self.last_scan > UPLOAD_QUEUE_RESCAN_INTERVAL:
+      self.scan()
+      return
+
+    events = self.inotify.read()
+    if any(event.mask & IN_Q_OVERFLOW for event in events):
+      self.scan()
+      return
+    for event in events:
+      self._handle_event(event)
+
+  def pending(self) -> Iterator[tuple[str, str, str]]:
+    for *_, name, logdir in self.order:
+      if logdir not in self.locked:
+        yield name, os.path.join(logdir, name), os.path.join(self.root, logdir, name)
+
+
 class Uploader:
   def __init__(self, dongle_id: str, root: str):
     self.dongle_id = dongle_id
@@ -81,63 +327,54 @@ class Uploader:
 
     # stats for last successfully uploaded file
     self.last_filename = ""
+    self.last_time = 0.
+    self.last_speed = 0.
 
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self.queue = UploadQueue(root, self.immediate_folders, self.immediate_priority)
+
+    # the queue and the files being uploaded are shared by the upload workers
+    self.lock = threading.Lock()
+    self.uploading: set[str] = set()
+    self.scheduler = UploadScheduler()
 
   def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
     r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
     requested_routes = [] if r is None else r.split(",")
 
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
+    self.queue.update()
+    for name, key, fn in self.queue.pending():
+      if fn in self.uploading:
         continue
 
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
-          continue
-
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
+      # limit uploading on metered connections
+      if metered:
+        logdir = os.path.dirname(key)
+        if logdir in self.immediate_folders:
+          try:
+            ctime = os.path.getctime(fn)
+          except OSError:
+            cloudlog.event("uploader_getctime_failed", key=key, fn=fn)
             continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+          if (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < datetime.timedelta(hours=12):
             continue
 
-        yield name, key, fn
-
-  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
+        if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+          continue
 
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
+      yield name, key, fn
 
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
+  def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
+    # the queue is in upload order
+    return next(self.list_upload_files(metered), None)
 
-    return None
+  def get_priority(self, name: str, fn: str) -> int:
+    if any(f in fn for f in self.immediate_folders) or self.immediate_priority.get(name, 1000) == 0:
+      return PRIORITY_HIGH
+    return PRIORITY_LOW
 
-  def do_upload(self, key: str, fn: str):
+  def do_upload(self, key: str, fn: str, callback: Callable[[int], None] = None):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
     if url_resp.status_code == 412:
       return url_resp
@@ -150,15 +387,13 @@ class Uploader:
     if fake_upload:
       return FakeResponse()
 
-    with open(fn, "rb") as f:
-      content = f.read()
-      if key.endswith('.zst') and not fn.endswith('.zst'):
-        content = zstd.compress(content, LOG_COMPRESSION_LEVEL)
-
-      with io.BytesIO(content) as data:
-        return requests.put(url, data=data, headers=headers, timeout=10)
+    compress = key.endswith('.zst') and not fn.endswith('.zst')
+    # block blobs can be uploaded in parts, which lets a dropped upload resume where it left off
+    if headers.get('x-ms-blob-type') == 'BlockBlob':
+      return put_file_blocks(url, headers, fn, compress, callback)
+    return put_file(url, headers, fn, compress, callback)
 
-  def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> bool:
+  def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool, transfer: Transfer = None) -> bool:
     try:
       sz = os.path.getsize(fn)
     except OSError:
@@ -178,8 +413,17 @@ class Uploader:
 
       stat = None
       last_exc = None
+      # bytes sent of the file being uploaded
+      bytes_sent = 0
+
+      def update_progress(sent: int) -> None:
+        nonlocal bytes_sent
+        bytes_sent = sent
+        if transfer is not None:
+          transfer.update(sent)
+
       try:
-        stat = self.do_upload(key, fn)
+        stat = self.do_upload(key, fn, update_progress)
       except Exception as e:
         last_exc = (e, traceback.format_exc())
 
@@ -189,8 +433,9 @@ class Uploader:
         if stat.status_code == 412:
           cloudlog.event("upload_ignored", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
         else:
-          content_length = int(stat.request.headers.get("Content-Length", 0))
+          content_length = bytes_sent
           speed = (content_length / 1e6) / dt
+          self.last_time, self.last_speed = dt, speed
           cloudlog.event("upload_success", key=key, fn=fn, sz=sz, content_length=content_length,
                          network_type=network_type, metered=metered, speed=speed)
         success = True
@@ -208,18 +453,73 @@ class Uploader:
     return success
 
 
-  def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
+  def step(self, network_type: int, metered: bool, exit_event: threading.Event = None) -> bool | None:
+    with self.lock:
+      d = self.next_file_to_upload(metered)
     if d is None:
       return None
 
-    name, key, fn = d
+    transfer = self.scheduler.acquire(self.get_priority(d[0], d[2]), exit_event)
+    if transfer is None:
+      return None
 
-    # qlogs and bootlogs need to be compressed before uploading
-    if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
-      key += ".zst"
+    with transfer:
+      # the queue could have changed while waiting for the transfer
+      with self.lock:
+        d = self.next_file_to_upload(metered)
+        if d is None:
+          return None
+        name, key, fn = d
+        self.uploading.add(fn)
+
+      # qlogs and bootlogs need to be compressed before uploading
+      if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
+        key += ".zst"
+
+      try:
+        return self.upload(name, key, fn, network_type, metered, transfer)
+      finally:
+        with self.lock:
+          self.uploading.discard(fn)
+
+  def get_state(self) -> capnp.lib.capnp._DynamicStructBuilder:
+    stats = self.scheduler.get_stats()
+
+    msg = messaging.new_message('uploaderState', valid=True)
+    us = msg.uploaderState
+    us.immediateQueueCount = len(self.queue.order)
+    us.lastTime = self.last_time
+    us.lastSpeed = self.last_speed
+    us.lastFilename = self.last_filename
+    us.activeUploads = stats.active
+    us.waitingUploads = stats.waiting
+    us.throughput = stats.throughput / 1e6
+    us.bandwidthLimit = stats.bandwidth_limit / 1e6
+    return msg
+
+
+def upload_worker(uploader: Uploader, sm: messaging.SubMaster, exit_event: threading.Event) -> None:
+  params = Params()
+
+  backoff = 0.1
+  while not exit_event.is_set():
+    offroad = params.get_bool("IsOffroad")
+    network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
+    if network_type == NetworkType.none:
+      if allow_sleep:
+        exit_event.wait(60 if offroad else 5)
+      continue
 
-    return self.upload(name, key, fn, network_type, metered)
+    success = uploader.step(sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered, exit_event)
+    if success is None:
+      backoff = 60 if offroad else 5
+    elif success:
+      backoff = 0.1
+    else:
+      cloudlog.info("upload backoff %r", backoff)
+      backoff = min(backoff*2, 120)
+    if allow_sleep:
+      exit_event.wait(backoff + random.uniform(0, backoff))
 
 
 def main(exit_event: threading.Event = None) -> None:
@@ -241,28 +541,22 @@ def main(exit_event: threading.Event = None) -> None:
     raise Exception("uploader can't start without dongle id")
 
   sm = messaging.SubMaster(['deviceState'])
+  pm = messaging.PubMaster(['uploaderState'])
   uploader = Uploader(dongle_id, Paths.log_root())
 
-  backoff = 0.1
+  threads = [threading.Thread(target=upload_worker, args=(uploader, sm, exit_event), name=f"upload_worker_{i}")
+             for i in range(UPLOAD_WORKERS)]
+  for t in threads:
+    t.start()
+
   while not exit_event.is_set():
-    sm.update(0)
-    offroad = params.get_bool("IsOffroad")
+    sm.update(1000)
     network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
-    if network_type == NetworkType.none:
-      if allow_sleep:
-        time.sleep(60 if offroad else 5)
-      continue
+    uploader.scheduler.set_network(network_type, sm['deviceState'].networkMetered)
+    pm.send('uploaderState', uploader.get_state())
 
-    success = uploader.step(sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered)
-    if success is None:
-      backoff = 60 if offroad else 5
-    elif success:
-      backoff = 0.1
-    else:
-      cloudlog.info("upload backoff %r", backoff)
-      backoff = min(backoff*2, 120)
-    if allow_sleep:
-      time.sleep(backoff + random.uniform(0, backoff))
+  for t in threads:
+    t.join()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
+import math
 import os
 import zmq
 import time
 from pathlib import Path
-from collections import defaultdict
 from datetime import datetime, UTC
 from typing import NoReturn
 
@@ -20,6 +20,85 @@ from openpilot.system.loggerd.config import STATS_DIR_FILE_LIMIT, STATS_SOCKET,
 class METRIC_TYPE:
   GAUGE = 'g'
   SAMPLE = 'sa'
+  COUNTER = 'c'
+  HISTOGRAM = 'h'
+  TIMING = 'ms'
+
+# measurement prefix of the metrics aggregated into quantile sketches
+SKETCH_METRICS = {
+  METRIC_TYPE.SAMPLE: 'sample',
+  METRIC_TYPE.HISTOGRAM: 'histogram',
+  METRIC_TYPE.TIMING: 'timing',
+}
+
+
+class QuantileSketch:
+  """
+  Fixed memory quantile estimate of a stream of values, DDSketch style. Values are counted in logarithmically
+  sized bins, so quantiles are within relative_accuracy of the exact value. When more than max_bins bins are used,
+  the bins closest to zero are merged, which only affects the accuracy of the lowest quantiles.
+  """
+  def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_bins = max_bins
+
+    # bins of positive values, and of the magnitude of negative values
+    self.positive: dict[int, int] = {}
+    self.negative: dict[int, int] = {}
+    self.zero_count = 0
+
+    self.count = 0
+    self.sum = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  def _collapse(self, bins: dict[int, int]) -> None:
+    keys = sorted(bins)
+    merged = keys[:len(keys) - self.max_bins + 1]
+    bins[merged[-1]] = sum(bins.pop(k) for k in merged[:-1]) + bins[merged[-1]]
+
+  def add(self, value: float) -> None:
+    self.count += 1
+    self.sum += value
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+
+    if value == 0:
+      self.zero_count += 1
+      return
+
+    bins = self.positive if value > 0 else self.negative
+    key = math.ceil(math.log(abs(value)) / self.log_gamma)
+    bins[key] = bins.get(key, 0) + 1
+    if len(bins) > self.max_bins:
+      self._collapse(bins)
+
+  def _value(self, key: int) -> float:
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def quantile(self, q: float) -> float:
+    """Value with rank round(q * (count - 1)) among the sorted values."""
+    rank = round(q * (self.count - 1))
+    if rank == 0:
+      return self.min
+    elif rank == self.count - 1:
+      return self.max
+
+    seen = 0
+    for key in sorted(self.negative, reverse=True):
+      seen += self.negative[key]
+      if seen > rank:
+        return max(-self._value(key), self.min)
+    seen += self.zero_count
+    if seen > rank:
+      return 0.
+    for key in sorted(self.positive):
+      seen += self.positive[key]
+      if seen > rank:
+        return min(self._value(key), self.max)
+    return self.max
+
 
 class StatLog:
   def __init__(self):
@@ -53,28 +132,32 @@ class StatLog:
   def gauge(self, name: str, value: float) -> None:
     self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
 
-  # Samples will be recorded in a buffer and at aggregation time,
+  # Samples will be aggregated into a quantile sketch and at aggregation time,
   # statistical properties will be logged (mean, count, percentiles, ...)
   def sample(self, name: str, value: float):
     self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
 
+  def histogram(self, name: str, value: float) -> None:
+    self._send(f"{name}:{value}|{METRIC_TYPE.HISTOGRAM}")
+
+  # durations in milliseconds, aggregated like samples
+  def timing(self, name: str, value_ms: float) -> None:
+    self._send(f"{name}:{value_ms}|{METRIC_TYPE.TIMING}")
+
+  # counters are summed up until the next flush
+  def count(self, name: str, value: float = 1) -> None:
+    self._send(f"{name}:{value}|{METRIC_TYPE.COUNTER}")
+
 
 def main() -> NoReturn:
   dongle_id = Params().get("DongleId", encoding='utf-8')
   def get_influxdb_line(measurement: str, value: float | dict[str, float],  timestamp: datetime, tags: dict) -> str:
-    res = f"{measurement}"
-    for k, v in tags.items():
-      res += f",{k}={str(v)}"
-    res += " "
-
-    if isinstance(value, float):
+    if not isinstance(value, dict):
       value = {'value': value}
 
-    for k, v in value.items():
-      res += f"{k}={v},"
-
-    res += f"dongle_id=\"{dongle_id}\" {int(timestamp.timestamp() * 1e9)}\n"
-    return res
+    tag_str = "".join(f",{k}={v}" for k, v in tags.items())
+    field_str = "".join(f"{k}={v}," for k, v in value.items())
+    return f"{measurement}{tag_str} {field_str}dongle_id=\"{dongle_id}\" {int(timestamp.timestamp() * 1e9)}\n"
 
   # open statistics socket
   ctx = zmq.Context.instance()
@@ -103,8 +186,9 @@ def main() -> NoReturn:
 
   idx = 0
   last_flush_time = time.monotonic()
-  gauges = {}
-  samples: dict[str, list[float]] = defaultdict(list)
+  gauges: dict[str, float] = {}
+  counters: dict[str, float] = {}
+  sketches: dict[tuple[str, str], QuantileSketch] = {}
   try:
     while True:
       started_prev = sm['deviceState'].started
@@ -115,14 +199,19 @@ def main() -> NoReturn:
         try:
           metric = sock.recv_string(zmq.NOBLOCK)
           try:
-            metric_type = metric.split('|')[1]
-            metric_name = metric.split(':')[0]
-            metric_value = float(metric.split('|')[0].split(':')[1])
+            name_value, metric_type = metric.split('|')
+            metric_name, value_str = name_value.split(':')
+            metric_value = float(value_str)
 
             if metric_type == METRIC_TYPE.GAUGE:
               gauges[metric_name] = metric_value
-            elif metric_type == METRIC_TYPE.SAMPLE:
-              samples[metric_name].append(metric_value)
+            elif metric_type == METRIC_TYPE.COUNTER:
+              counters[metric_name] = counters.get(metric_name, 0) + metric_value
+            elif metric_type in SKETCH_METRICS:
+              sketch = sketches.get((metric_type, metric_name))
+              if sketch is None:
+                sketch = sketches[(metric_type, metric_name)] = QuantileSketch()
+              sketch.add(metric_value)
             else:
               cloudlog.event("unknown metric type", metric_type=metric_type)
           except Exception:
@@ -132,33 +221,33 @@ def main() -> NoReturn:
 
       # flush when started state changes or after FLUSH_TIME_S
       if (time.monotonic() > last_flush_time + STATS_FLUSH_TIME_S) or (sm['deviceState'].started != started_prev):
-        result = ""
+        lines = []
         current_time = datetime.now(UTC)
         tags['started'] = sm['deviceState'].started
 
         for key, value in gauges.items():
-          result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
+          lines.append(get_influxdb_line(f"gauge.{key}", value, current_time, tags))
 
-        for key, values in samples.items():
-          values.sort()
-          sample_count = len(values)
-          sample_sum = sum(values)
+        for key, value in counters.items():
+          lines.append(get_influxdb_line(f"counter.{key}", value, current_time, tags))
 
+        for (metric_type, key), sketch in sketches.items():
           stats = {
-            'count': sample_count,
-            'min': values[0],
-            'max': values[-1],
-            'mean': sample_sum / sample_count,
+            'count': sketch.count,
+            'min': sketch.min,
+            'max': sketch.max,
+            'mean': sketch.sum / sketch.count,
           }
           for percentile in [0.05, 0.5, 0.95]:
-            value = values[int(round(percentile * (sample_count - 1)))]
-            stats[f"p{int(percentile * 100)}"] = value
+            stats[f"p{int(percentile * 100)}"] = sketch.quantile(percentile)
 
-          result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
+          lines.append(get_influxdb_line(f"{SKETCH_METRICS[metric_type]}.{key}", stats, current_time, tags))
+        result = "".join(lines)
 
         # clear intermediate data
         gauges.clear()
-        samples.clear()
+        counters.clear()
+        sketches.clear()
         last_flush_time = time.monotonic()
 
         # check that we aren't filling up the drive
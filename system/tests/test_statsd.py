@@ -0,0 +1,35 @@
+import numpy as np
+
+from openpilot.system.statsd import QuantileSketch
+
+
+def exact_quantile(values: np.ndarray, q: float) -> float:
+  return np.sort(values)[int(round(q * (len(values) - 1)))]
+
+
+class TestQuantileSketch:
+  def test_accuracy(self):
+    rng = np.random.default_rng(0)
+    for values in (rng.lognormal(0, 2, 100_000), rng.normal(0, 10, 100_000), rng.integers(-5, 5, 10_000).astype(float)):
+      sketch = QuantileSketch(relative_accuracy=0.01)
+      for v in values:
+        sketch.add(v)
+
+      assert sketch.count == len(values)
+      assert np.isclose(sketch.sum, values.sum())
+      assert (sketch.min, sketch.max) == (values.min(), values.max())
+      for q in (0, 0.05, 0.5, 0.95, 1):
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= 0.01 * abs(expected) + 1e-9
+
+  def test_fixed_memory(self):
+    sketch = QuantileSketch(relative_accuracy=0.01, max_bins=64)
+    values = np.geomspace(1e-6, 1e6, 10_000)
+    for v in values:
+      sketch.add(v)
+
+    # only the lowest quantiles lose accuracy, the top 64 bins still cover the values above p95 here
+    assert len(sketch.positive) <= 64
+    for q in (0.98, 0.99):
+      expected = exact_quantile(values, q)
+      assert abs(sketch.quantile(q) - expected) <= 0.01 * expected
@@ -5,13 +5,16 @@ import os
 import pathlib
 import struct
 import sys
+import threading
 import time
 from abc import ABC, abstractmethod
 from collections import defaultdict, namedtuple
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import IO
 
 import requests
+from requests.adapters import HTTPAdapter
 from Crypto.Hash import SHA512
 from openpilot.system.updated.casync import tar
 from openpilot.system.updated.casync.common import create_casync_tar_package
@@ -28,6 +31,8 @@ CA_TABLE_MIN_LEN = CA_TABLE_HEADER_LEN + CA_TABLE_ENTRY_LEN
 
 CHUNK_DOWNLOAD_TIMEOUT = 60
 CHUNK_DOWNLOAD_RETRIES = 3
+# chunks fetched, verified and written at once. downloading, decompressing and hashing all release the GIL
+CHUNK_WORKERS = 8
 
 CAIBX_DOWNLOAD_TIMEOUT = 120
 
@@ -43,18 +48,27 @@ class ChunkReader(ABC):
 
 class BinaryChunkReader(ChunkReader):
   """Reads chunks from a local file"""
+  path: str | None = None
+
   def __init__(self, file_like: IO[bytes]) -> None:
     super().__init__()
     self.f = file_like
+    self.lock = threading.Lock()
 
   def read(self, chunk: Chunk) -> bytes:
-    self.f.seek(chunk.offset)
-    return self.f.read(chunk.length)
+    try:
+      fd = self.f.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+      with self.lock:
+        self.f.seek(chunk.offset)
+        return self.f.read(chunk.length)
+    return os.pread(fd, chunk.length, chunk.offset)
 
 
 class FileChunkReader(BinaryChunkReader):
   def __init__(self, path: str) -> None:
     super().__init__(open(path, 'rb'))
+    self.path = path
 
   def __del__(self):
     self.f.close()
@@ -63,10 +77,14 @@ class FileChunkReader(BinaryChunkReader):
 class RemoteChunkReader(ChunkReader):
   """Reads lzma compressed chunks from a remote store"""
 
-  def __init__(self, url: str) -> None:
+  def __init__(self, url: str, pool_size: int = CHUNK_WORKERS) -> None:
     super().__init__()
     self.url = url
+    # one connection per extract worker
     self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
 
   def read(self, chunk: Chunk) -> bytes:
     sha_hex = chunk.sha.hex()
@@ -168,17 +186,36 @@ def build_chunk_dict(chunks: list[Chunk]) -> ChunkDict:
 def extract(target: list[Chunk],
             sources: list[tuple[str, ChunkReader, ChunkDict]],
             out_path: str,
-            progress: Callable[[int], None] = None):
+            progress: Callable[[int], None] = None,
+            num_workers: int = CHUNK_WORKERS):
+  """
+  Writes the target chunks to out_path, taking each chunk from the first source that has it. Chunks are read,
+  verified and written by a pool of workers, and chunks used more than once in the target are only read once.
+  """
   stats: dict[str, int] = defaultdict(int)
 
+  # chunks at each offset they're used at in the target
+  target_chunks: dict[bytes, list[Chunk]] = defaultdict(list)
+  for chunk in target:
+    target_chunks[chunk.sha].append(chunk)
+
+  # the output is a source when resuming, chunks it already has are left as is
+  out_realpath = os.path.realpath(out_path)
+  out_sources = {name for name, reader, _ in sources if getattr(reader, 'path', None) and os.path.realpath(reader.path) == out_realpath}
+  out_name = next((name for name, _, _ in sources if name in out_sources), None)
+
   mode = 'rb+' if os.path.exists(out_path) else 'wb'
   with open(out_path, mode) as out:
-    for cur_chunk in target:
+    fd = out.fileno()
+
+    def extract_chunk(chunks: list[Chunk]) -> list[tuple[str, int]]:
+      cur_chunk = chunks[0]
 
       # Find source for desired chunk
       for name, chunk_reader, store_chunks in sources:
         if cur_chunk.sha in store_chunks:
-          bts = chunk_reader.read(store_chunks[cur_chunk.sha])
+          store_chunk = store_chunks[cur_chunk.sha]
+          bts = chunk_reader.read(store_chunk)
 
           # Check length
           if len(bts) != cur_chunk.length:
@@ -189,17 +226,28 @@ def extract(target: list[Chunk],
             continue
 
           # Write to output
-          out.seek(cur_chunk.offset)
-          out.write(bts)
+          for chunk in chunks:
+            if not (name in out_sources and store_chunk.offset == chunk.offset):
+              os.pwrite(fd, bts, chunk.offset)
 
-          stats[name] += cur_chunk.length
+          # further copies of the chunk are attributed to the output, like when they were read back from it
+          return [(name, cur_chunk.length)] + [(out_name or name, chunk.length) for chunk in chunks[1:]]
+
+      raise RuntimeError("Desired chunk not found in provided stores")
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+      futures = [pool.submit(extract_chunk, chunks) for chunks in target_chunks.values()]
+      try:
+        for future in as_completed(futures):
+          for name, length in future.result():
+            stats[name] += length
 
           if progress is not None:
             progress(sum(stats.values()))
-
-          break
-      else:
-        raise RuntimeError("Desired chunk not found in provided stores")
+      except BaseException:
+        for future in futures:
+          future.cancel()
+        raise
 
   return stats
 
@@ -1,3 +1,4 @@
+import io
 import pytest
 import os
 import pathlib
@@ -151,6 +152,79 @@ class TestCasync:
     assert stats['remote'] < len(self.contents)
 
 
+class FakeRemoteReader(casync.ChunkReader):
+  def __init__(self, data: bytes):
+    self.data = data
+    self.reads: list[casync.Chunk] = []
+
+  def read(self, chunk: casync.Chunk) -> bytes:
+    self.reads.append(chunk)
+    return self.data[chunk.offset:chunk.offset + chunk.length]
+
+
+class TestParallelExtract:
+  """Tests extracting from chunk lists built by hand, without the casync tool"""
+
+  def setup_method(self):
+    chunks = [os.urandom(64 * 1024) for _ in range(4)]
+    # chunks 0 and 1 are used twice
+    self.contents = b''.join(chunks[i] for i in [0, 1, 2, 0, 3, 1])
+    self.target = []
+    offset = 0
+    for i in [0, 1, 2, 0, 3, 1]:
+      self.target.append(casync.Chunk(casync.SHA512.new(chunks[i], truncate="256").digest(), offset, len(chunks[i])))
+      offset += len(chunks[i])
+
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.target_fn = os.path.join(self.tmpdir.name, 'target')
+
+  def teardown_method(self):
+    self.tmpdir.cleanup()
+
+  def test_only_missing_chunks_fetched(self):
+    # the seed has the first half of the image, and garbage where chunk 2 should be
+    seed = bytearray(self.contents)
+    seed[2 * 64 * 1024] ^= 0xff
+    seed_chunks = casync.build_chunk_dict(self.target[:3])
+    remote = FakeRemoteReader(self.contents)
+
+    progress = []
+    sources = [
+      ('seed', casync.BinaryChunkReader(io.BytesIO(bytes(seed))), seed_chunks),
+      ('remote', remote, casync.build_chunk_dict(self.target)),
+    ]
+    stats = casync.extract(self.target, sources, self.target_fn, progress.append)
+
+    with open(self.target_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert sorted(c.offset for c in remote.reads) == [2 * 64 * 1024, 4 * 64 * 1024]
+    assert stats['seed'] == 4 * 64 * 1024
+    assert stats['remote'] == 2 * 64 * 1024
+    assert progress[-1] == len(self.contents)
+
+  def test_resume(self):
+    # an interrupted extract left the first chunks in place
+    with open(self.target_fn, 'wb') as f:
+      f.write(self.contents[:3 * 64 * 1024])
+
+    remote = FakeRemoteReader(self.contents)
+    sources = [
+      ('target', casync.FileChunkReader(self.target_fn), casync.build_chunk_dict(self.target)),
+      ('remote', remote, casync.build_chunk_dict(self.target)),
+    ]
+    stats = casync.extract(self.target, sources, self.target_fn)
+
+    with open(self.target_fn, 'rb') as f:
+      assert f.read() == self.contents
+    assert [c.offset for c in remote.reads] == [4 * 64 * 1024]
+    assert stats['remote'] == 64 * 1024
+
+  def test_missing_chunk(self):
+    sources = [('seed', casync.BinaryChunkReader(io.BytesIO(self.contents)), casync.build_chunk_dict(self.target[:2]))]
+    with pytest.raises(RuntimeError):
+      casync.extract(self.target, sources, self.target_fn)
+
+
 @pytest.mark.skip("not used yet")
 class TestCasyncDirectory:
   """Tests extracting a directory stored as a casync tar archive"""
@@ -32,8 +32,8 @@ def file_exists(fn):
   return os.path.exists(fn)
 
 
-def FileReader(fn, debug=False):
+def FileReader(fn, debug=False, cache=None):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
-    return URLFile(fn, debug=debug)
+    return URLFile(fn, debug=debug, cache=cache)
   return open(fn, "rb")
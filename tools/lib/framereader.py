@@ -4,11 +4,13 @@ import pickle
 import struct
 import subprocess
 import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import IntEnum
+from fractions import Fraction
 from functools import wraps
 
 import numpy as np
-from lru import LRU
 
 import _io
 from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
@@ -17,11 +19,25 @@ from openpilot.tools.lib.vidindex import hevc_index
 from openpilot.common.file_helpers import atomic_write_in_dir
 
 from openpilot.tools.lib.filereader import FileReader, resolve_name
+from openpilot.tools.lib.url_file import DownloadCacheQuota, hash_256
+
+try:
+  import av
+  import av.filter
+except ImportError:
+  av = None
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+DECODER_WORKERS = int(os.getenv("FRAMEREADER_DECODER_WORKERS", os.cpu_count() or 1))
+#  Memory budget of the decoded frame cache shared by all readers in a process
+FRAME_CACHE_SIZE = int(os.getenv("FRAMEREADER_FRAME_CACHE_SIZE", 512 * 1024 * 1024))
+#  Frames evicted from memory are spilled to this directory if set, up to FRAME_SPILL_SIZE
+FRAME_SPILL_DIR = os.getenv("FRAMEREADER_FRAME_SPILL_DIR")
+FRAME_SPILL_SIZE = int(os.getenv("FRAMEREADER_FRAME_SPILL_SIZE", 10 * 1024 * 1024 * 1024))
+
 
 class GOPReader:
   def get_gop(self, num):
@@ -166,9 +182,51 @@ def rgb24tonv12(rgb):
   return nv12.clip(0, 255).astype('uint8')
 
 
+def frame_shape(w, h, pix_fmt):
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt in ("nv12", "yuv420p"):
+    return (h*w*3//2,)
+  elif pix_fmt == "yuv444p":
+    return (3, h, w)
+  else:
+    raise NotImplementedError
+
+
+def decompress_video_data_av(rawdat, vid_fmt, w, h, pix_fmt):
+  # in-process decoding, frames are converted by the same swscale path as the ffmpeg cli
+  codec = av.CodecContext.create(vid_fmt, "r")
+  codec.thread_count = int(os.getenv("FFMPEG_THREADS", "0"))
+  codec.options = {"flags2": "+showall"}
+  packets = codec.parse(bytes(rawdat)) + codec.parse()
+
+  # at most one frame per packet, so this is an upper bound on the number of frames
+  ret = np.empty((len(packets), *frame_shape(w, h, pix_fmt)), dtype=np.uint8)
+  n = 0
+  graph = None
+  for packet in packets + [None]:
+    try:
+      frames = codec.decode(packet)
+    except av.InvalidDataError:
+      # like the ffmpeg cli, skip over undecodable packets
+      continue
+
+    for frame in frames:
+      if graph is None:
+        graph = av.filter.Graph()
+        graph.link_nodes(graph.add_buffer(template=frame, time_base=Fraction(1, 20)), graph.add("format", pix_fmt), graph.add("buffersink")).configure()
+      graph.push(frame)
+      ret[n] = graph.pull().to_ndarray().reshape(ret.shape[1:])
+      n += 1
+  return ret[:n]
+
+
 def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   threads = os.getenv("FFMPEG_THREADS", "0")
   cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
+  if av is not None and not cuda:
+    return decompress_video_data_av(rawdat, vid_fmt, w, h, pix_fmt)
+
   args = ["ffmpeg", "-v", "quiet",
           "-threads", threads,
           "-hwaccel", "none" if not cuda else "cuda",
@@ -182,19 +240,101 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
           "-pix_fmt", pix_fmt,
           "-"]
   dat = subprocess.check_output(args, input=rawdat)
-
-  if pix_fmt == "rgb24":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
-  elif pix_fmt == "nv12":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  elif pix_fmt == "yuv420p":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, (h*w*3//2))
-  elif pix_fmt == "yuv444p":
-    ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, 3, h, w)
-  else:
-    raise NotImplementedError
-
-  return ret
+  return np.frombuffer(dat, dtype=np.uint8).reshape(-1, *frame_shape(w, h, pix_fmt))
+
+
+_decoder_pool: ThreadPoolExecutor|None = None
+
+def decoder_pool() -> ThreadPoolExecutor:
+  # shared by all readers, decoding releases the GIL so GOPs are decoded in parallel
+  global _decoder_pool
+  if _decoder_pool is None:
+    _decoder_pool = ThreadPoolExecutor(max_workers=DECODER_WORKERS, thread_name_prefix="gop_decoder")
+  return _decoder_pool
+
+def _reset_decoder_pool():
+  global _decoder_pool
+  _decoder_pool = None
+
+os.register_at_fork(after_in_child=_reset_decoder_pool)
+
+
+class FrameCache:
+  """Thread-safe LRU of decoded frames keyed by (file, frame number, pix_fmt) and bounded by bytes.
+  With a spill_dir, frames evicted from memory are saved there and read back memory-mapped. The spill
+  directory is evicted by least recent use past spill_size, and must only be used for spilled frames."""
+  def __init__(self, max_size: int, spill_dir: str|None = None, spill_size: int = FRAME_SPILL_SIZE):
+    self.max_size = max_size
+    self.size = 0
+    self.spill_dir = spill_dir
+    self._frames: OrderedDict[tuple[str, int, str], np.ndarray] = OrderedDict()
+    self._lock = threading.Lock()
+    self._spill_quota = DownloadCacheQuota(spill_size)
+    if spill_dir is not None:
+      os.makedirs(spill_dir, exist_ok=True)
+
+  def _spill_path(self, key: tuple[str, int, str]) -> str:
+    assert self.spill_dir is not None
+    fn, num, pix_fmt = key
+    return os.path.join(self.spill_dir, f"{hash_256(fn)}_{num}_{pix_fmt}.npy")
+
+  def __contains__(self, key: tuple[str, int, str]) -> bool:
+    with self._lock:
+      if key in self._frames:
+        return True
+    return self.spill_dir is not None and os.path.exists(self._spill_path(key))
+
+  def get(self, key: tuple[str, int, str]) -> np.ndarray|None:
+    with self._lock:
+      frame = self._frames.get(key)
+      if frame is not None:
+        self._frames.move_to_end(key)
+        return frame
+
+    if self.spill_dir is None:
+      return None
+    try:
+      frame = np.load(self._spill_path(key), mmap_mode="r")
+      #  keep track of recently used frames for eviction
+      os.utime(self._spill_path(key))
+    except FileNotFoundError:
+      return None
+    return frame
+
+  def put(self, key: tuple[str, int, str], frame: np.ndarray) -> None:
+    evicted = []
+    with self._lock:
+      if key in self._frames:
+        self._frames.move_to_end(key)
+        return
+      self._frames[key] = frame
+      self.size += frame.nbytes
+      while self.size > self.max_size:
+        evicted.append(self._frames.popitem(last=False))
+        self.size -= evicted[-1][1].nbytes
+
+    if self.spill_dir is not None:
+      for evicted_key, evicted_frame in evicted:
+        if os.path.exists(self._spill_path(evicted_key)):
+          continue
+        with atomic_write_in_dir(self._spill_path(evicted_key), mode="wb", overwrite=True) as f:
+          np.save(f, evicted_frame)
+        self._spill_quota.add(self.spill_dir, evicted_frame.nbytes)
+
+
+_frame_cache: FrameCache|None = None
+
+def default_frame_cache() -> FrameCache:
+  global _frame_cache
+  if _frame_cache is None:
+    _frame_cache = FrameCache(FRAME_CACHE_SIZE, FRAME_SPILL_DIR)
+  return _frame_cache
+
+def _reset_frame_cache():
+  global _frame_cache
+  _frame_cache = None
+
+os.register_at_fork(after_in_child=_reset_frame_cache)
 
 
 class BaseFrameReader:
@@ -213,14 +353,14 @@ class BaseFrameReader:
     raise NotImplementedError
 
 
-def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None):
+def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None, frame_cache=None):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_dir)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind, frame_cache=frame_cache)
   else:
     raise NotImplementedError(frame_type)
 
@@ -426,12 +566,13 @@ class StreamGOPReader(GOPReader):
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, frame_cache=None):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = frame_cache if frame_cache is not None else default_frame_cache()
+    self.pending_gops: dict[tuple[int, str], Future] = {}
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -470,32 +611,58 @@ class GOPFrameReader(BaseFrameReader):
       num, pix_fmt = self.readahead_last
 
       if self.readbehind:
-        for k in range(num - 1, max(0, num - self.readahead_len), -1):
-          self._get_one(k, pix_fmt)
+        nums = range(num - 1, max(0, num - self.readahead_len), -1)
       else:
-        for k in range(num, min(self.frame_count, num + self.readahead_len)):
-          self._get_one(k, pix_fmt)
+        nums = range(num, min(self.frame_count, num + self.readahead_len))
 
-  def _get_one(self, num, pix_fmt):
-    assert num < self.frame_count
+      # submit every GOP in the window before waiting, so they're decoded in parallel
+      futures = {self._submit_gop(k, pix_fmt) for k in nums if (self.fn, k, pix_fmt) not in self.frame_cache}
+      for future in futures:
+        self._wait_gop(future, pix_fmt)
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+  def _decode_gop(self, frame_b, num_frames, skip_frames, rawdat, pix_fmt):
+    ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+    ret = ret[skip_frames:]
+    assert ret.shape[0] == num_frames
+    return frame_b, ret
 
+  def _submit_gop(self, num, pix_fmt):
+    # returns the decode of the GOP containing num, shared with any decode already in flight
     with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
-
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+      if (num, pix_fmt) not in self.pending_gops:
+        frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+        future = decoder_pool().submit(self._decode_gop, frame_b, num_frames, skip_frames, rawdat, pix_fmt)
+        for i in range(frame_b, frame_b + num_frames):
+          self.pending_gops[(i, pix_fmt)] = future
+      return self.pending_gops[(num, pix_fmt)]
+
+  def _wait_gop(self, future, pix_fmt):
+    try:
+      frame_b, ret = future.result()
+    finally:
+      with self.cache_lock:
+        for key in [k for k, v in self.pending_gops.items() if v is future]:
+          del self.pending_gops[key]
+
+    # cached frames are copies, so each one only keeps its own bytes alive and not the whole GOP, and
+    # are read-only, so callers can't change them for the other readers of the cache
+    frames = []
+    for i in range(ret.shape[0]):
+      frame = ret[i].copy()
+      frame.setflags(write=False)
+      self.frame_cache.put((self.fn, frame_b+i, pix_fmt), frame)
+      frames.append(frame)
+    return frame_b, frames
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
-      ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
+  def _get_one(self, num, pix_fmt):
+    assert num < self.frame_count
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+    frame = self.frame_cache.get((self.fn, num, pix_fmt))
+    if frame is not None:
+      return frame
 
-      return self.frame_cache[(num, pix_fmt)]
+    frame_b, ret = self._wait_gop(self._submit_gop(num, pix_fmt), pix_fmt)
+    return ret[num - frame_b]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -518,9 +685,9 @@ class GOPFrameReader(BaseFrameReader):
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, frame_cache=None):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, frame_cache)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
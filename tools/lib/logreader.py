@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 import bz2
-from functools import cache, partial
+from functools import cache, partial, reduce
 import multiprocessing
 import capnp
 import enum
+import numpy as np
 import os
 import pathlib
+import pickle
+import struct
 import sys
 import tqdm
 import urllib.parse
@@ -13,19 +16,30 @@ import warnings
 import zstandard as zstd
 
 from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.pool import ThreadPool
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.common.swaglog import cloudlog
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
-from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
+from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available, resolve_name
 from openpilot.tools.lib.route import Route, SegmentRange
+from openpilot.tools.lib.url_file import CHUNK_SIZE
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
+# https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'
+STREAM_READ_SIZE = 4 * CHUNK_SIZE
+LOG_INDEX_VERSION = 1
+FILE_CHECK_WORKERS = 16
+
 
 def save_log(dest, log_msgs, compress=True):
   dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
@@ -39,10 +53,194 @@ def save_log(dest, log_msgs, compress=True):
     f.write(dat)
 
 
+def _capnp_message_size(dat, offset: int) -> int | None:
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  if len(dat) - offset < 4:
+    return None
+  num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+  header_size = (4 * (num_segments + 1) + 7) & ~7
+  if len(dat) - offset < header_size:
+    return None
+  return header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", dat, offset + 4))
+
+
+def _decompressed_chunks(f, ext: str | None, read_size: int) -> Iterator[bytes]:
+  dat = f.read(read_size)
+
+  if ext == ".bz2" or dat.startswith(b'BZh9'):
+    new_decompressor = bz2.BZ2Decompressor
+  elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+    new_decompressor = zstd.ZstdDecompressor().decompressobj
+  else:
+    new_decompressor = None
+
+  decompressor = new_decompressor() if new_decompressor is not None else None
+  while dat:
+    if decompressor is None:
+      yield dat
+    else:
+      # handle concatenated streams/frames
+      while dat:
+        out = decompressor.decompress(dat)
+        if out:
+          yield out
+        dat = b""
+        if decompressor.eof:
+          dat = decompressor.unused_data
+          decompressor = new_decompressor()
+    dat = f.read(read_size)
+
+
+def _stream_events(chunks: Iterable[bytes]) -> Iterator[capnp._DynamicStructReader]:
+  pending = b""
+  for chunk in chunks:
+    dat = pending + chunk if pending else chunk
+
+    # only hand complete messages to capnp, keep the partial tail for the next chunk
+    offset = 0
+    while (size := _capnp_message_size(dat, offset)) is not None and offset + size <= len(dat):
+      offset += size
+
+    if offset > 0:
+      try:
+        yield from capnp_log.Event.read_multiple_bytes(memoryview(dat)[:offset])
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+        return
+    pending = dat[offset:]
+
+  if len(pending):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+
+def _zstd_decompress_frames(dat) -> tuple[bytearray, list[tuple[int, int]]]:
+  # decompress all concatenated frames, keeping track of the (compressed, decompressed) offset of each one
+  out = bytearray()
+  frames = []
+  mv = memoryview(dat)
+  offset = 0
+  while mv[offset:offset + 4] == ZSTD_MAGIC:
+    frames.append((offset, len(out)))
+    decompressor = zstd.ZstdDecompressor().decompressobj()
+    pos = offset
+    while not decompressor.eof and pos < len(dat):
+      out += decompressor.decompress(mv[pos:pos + CHUNK_SIZE])
+      pos += CHUNK_SIZE
+    if not decompressor.eof:
+      break
+    offset = min(pos, len(dat)) - len(decompressor.unused_data)
+  frames.append((len(dat), len(out)))
+  return out, frames
+
+
+def _decompress(dat, compression: str | None):
+  if compression == "bz2":
+    return bz2.decompress(dat)
+  elif compression == "zst":
+    return _zstd_decompress_frames(dat)[0]
+  return dat
+
+
+def log_index_path(fn: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+  return cache_path_for_file_path(fn, cache_dir) + ".logindex"
+
+
+def build_log_index(dat, compression: str | None, frames: list[tuple[int, int]], file_size: int) -> dict:
+  """Maps each message type to the (offset, size, logMonoTime) of its events in the decompressed log.
+  frames holds the (compressed, decompressed) start offsets of each independently decompressible block."""
+  types: dict[str, list[tuple[int, int, int]]] = {}
+  offset = 0
+  try:
+    for ent in capnp_log.Event.read_multiple_bytes(dat):
+      size = _capnp_message_size(dat, offset)
+      try:
+        types.setdefault(ent.which(), []).append((offset, size, ent.logMonoTime))
+      except capnp.KjException:
+        pass
+      offset += size
+  except capnp.KjException:
+    pass
+
+  return {
+    'version': LOG_INDEX_VERSION,
+    'file_size': file_size,
+    'compression': compression,
+    'frames': np.array(frames, dtype=np.uint64).reshape(-1, 2),
+    'types': {k: np.array(v, dtype=np.uint64) for k, v in types.items()},
+  }
+
+
+def load_log_index(fn: str, cache_dir: str = DEFAULT_CACHE_DIR) -> dict | None:
+  index_path = log_index_path(fn, cache_dir)
+  if not os.path.exists(index_path):
+    return None
+
+  with open(index_path, "rb") as f:
+    index = pickle.load(f)
+  if index['version'] != LOG_INDEX_VERSION:
+    return None
+  # remote logs are immutable, local ones may be rewritten
+  if not resolve_name(fn).startswith(("http://", "https://")) and os.path.getsize(fn) != index['file_size']:
+    return None
+  return index
+
+
+def read_indexed_events(fn: str, index: dict, msg_type: str, sort_by_time: bool = False) -> list[capnp._DynamicStructReader]:
+  """Reads only the events of msg_type, seeking to and decompressing just the blocks of the file that contain them."""
+  ents = index['types'].get(msg_type)
+  if ents is None:
+    return []
+
+  starts, ends = ents[:, 0], ents[:, 0] + ents[:, 1]
+  frames = index['frames']
+
+  # blocks of (compressed start, compressed end, decompressed start) to read
+  blocks: list[list[int]] = []
+  if index['compression'] is None:
+    # merge nearby events to limit the number of reads
+    for start, end in zip(starts.tolist(), ends.tolist(), strict=True):
+      if len(blocks) and start - blocks[-1][1] <= CHUNK_SIZE:
+        blocks[-1][1] = end
+      else:
+        blocks.append([start, end, start])
+  else:
+    # an event can span multiple frames, mark all frames between its first and last byte
+    first = np.searchsorted(frames[:, 1], starts, side='right') - 1
+    last = np.searchsorted(frames[:, 1], ends - 1, side='right') - 1
+    needed = np.zeros(len(frames), dtype=np.int64)
+    np.add.at(needed, first, 1)
+    np.add.at(needed, last + 1, -1)
+    for i in np.flatnonzero(np.cumsum(needed)[:-1] > 0).tolist():
+      if len(blocks) and blocks[-1][1] == int(frames[i, 0]):
+        blocks[-1][1] = int(frames[i + 1, 0])
+      else:
+        blocks.append([int(frames[i, 0]), int(frames[i + 1, 0]), int(frames[i, 1])])
+
+  events = []
+  with FileReader(fn) as f:
+    for cstart, cend, dstart in blocks:
+      f.seek(cstart)
+      dat = memoryview(_decompress(f.read(cend - cstart), index['compression']))
+      lo, hi = np.searchsorted(starts, [dstart, dstart + len(dat)])
+      for start, end in zip((starts[lo:hi] - dstart).tolist(), (ends[lo:hi] - dstart).tolist(), strict=True):
+        events.append(next(iter(capnp_log.Event.read_multiple_bytes(dat[start:end]))))
+
+  if sort_by_time:
+    events.sort(key=lambda x: x.logMonoTime)
+  return events
+
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, streaming=False, cache=None):
+    assert not (streaming and sort_by_time), "sort_by_time requires reading the whole log, can't be used with streaming"
+
     self.data_version = None
+    self._fn = fn
     self._only_union_types = only_union_types
+    self._ents: list[capnp._DynamicStructReader] | None = None
+    self._dat = None
+    # cache: keep downloads in the cache directory, None follows FILEREADER_CACHE
+    self._cache = cache
 
     ext = None
     if not dat:
@@ -50,15 +248,27 @@ class _LogFileReader:
       if ext not in ('', '.bz2', '.zst'):
         # old rlogs weren't compressed
         raise Exception(f"unknown extension {ext}")
+    self._ext = ext
+
+    # in streaming mode, events are decompressed and decoded incrementally on each iteration
+    if streaming and not dat:
+      return
 
-      with FileReader(fn) as f:
+    if not dat:
+      with FileReader(fn, cache=cache) as f:
         dat = f.read()
 
+    self._file_size = len(dat)
+    self._compression = None
+    self._frames = [(0, 0)]
     if ext == ".bz2" or dat.startswith(b'BZh9'):
+      self._compression = "bz2"
       dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
-      dat = zstd.decompress(dat)
+      self._frames.append((self._file_size, len(dat)))
+    elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+      self._compression = "zst"
+      dat, self._frames = _zstd_decompress_frames(dat)
+    self._dat = dat
 
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
@@ -72,8 +282,21 @@ class _LogFileReader:
     if sort_by_time:
       self._ents.sort(key=lambda x: x.logMonoTime)
 
+  def save_index(self, cache_dir: str = DEFAULT_CACHE_DIR) -> None:
+    assert self._dat is not None, "index can only be built when the whole log is read"
+    index = build_log_index(self._dat, self._compression, self._frames, self._file_size)
+    with atomic_write_in_dir(log_index_path(self._fn, cache_dir), mode="wb", overwrite=True) as f:
+      pickle.dump(index, f, -1)
+
+  def _iter_ents(self) -> Iterator[capnp._DynamicStructReader]:
+    if self._ents is not None:
+      yield from self._ents
+    else:
+      with FileReader(self._fn, cache=self._cache) as f:
+        yield from _stream_events(_decompressed_chunks(f, self._ext, STREAM_READ_SIZE))
+
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in self._iter_ents():
       if self._only_union_types:
         try:
           ent.which()
@@ -84,6 +307,86 @@ class _LogFileReader:
         yield ent
 
 
+# column dtype of each scalar field type, enums are stored by their raw value
+COLUMN_DTYPES = {
+  'bool': np.bool_, 'int8': np.int8, 'int16': np.int16, 'int32': np.int32, 'int64': np.int64,
+  'uint8': np.uint8, 'uint16': np.uint16, 'uint32': np.uint32, 'uint64': np.uint64,
+  'float32': np.float32, 'float64': np.float64, 'text': np.str_, 'data': np.bytes_, 'enum': np.uint16,
+}
+
+
+def column_dtype(msg_type: str, path: list[str]) -> type[np.generic]:
+  """Resolves the dtype of a field path from the schema. Only scalar fields and unions (stored as the name of
+  their active member) fit in a column, anything else raises a ValueError."""
+  field_path = '.'.join([msg_type, *path])
+  schema, kind = capnp_log.Event.schema, 'struct'
+  for name in [msg_type, *path]:
+    if kind != 'struct':
+      raise ValueError(f"invalid field path {field_path}, can't select {name} from a {kind}")
+    if name not in schema.fields:
+      raise ValueError(f"invalid field path {field_path}, unknown field {name}")
+    field = schema.fields[name]
+    kind = field.proto.slot.type.which() if field.proto.which() == 'slot' else 'struct'
+    if kind == 'struct':
+      schema = field.schema
+
+  if kind == 'struct':
+    if not len(schema.union_fields):
+      raise ValueError(f"{field_path} is a struct without a union, select one of its fields instead")
+    return np.str_
+  elif kind not in COLUMN_DTYPES:
+    raise ValueError(f"{field_path} is a {kind}, only scalar fields and unions can be stored in a column")
+  return COLUMN_DTYPES[kind]
+
+
+def column_fill_value(dtype: type[np.generic]):
+  """Value of a field behind an inactive union member: NaN for floats, the type's default otherwise."""
+  return np.nan if np.issubdtype(dtype, np.floating) else dtype()
+
+
+def _column_value(msg, path: list[str], fill):
+  try:
+    for name in path:
+      msg = getattr(msg, name)
+  except capnp.KjException:
+    # inactive union member
+    return fill
+
+  if isinstance(msg, capnp.lib.capnp._DynamicEnum):
+    return msg.raw
+  elif isinstance(msg, capnp.lib.capnp._DynamicStructReader):
+    return msg.which()
+  return msg
+
+
+def extract_columns(lr: LogIterable, fields: dict[str, list[str]]) -> dict[str, dict[str, np.ndarray]]:
+  """Extracts the fields (msg_type -> field paths) of each message type in a single pass, along with their logMonoTime."""
+  dtypes = {msg_type: {'logMonoTime': np.uint64, **{f: column_dtype(msg_type, f.split('.')) for f in msg_fields}}
+            for msg_type, msg_fields in fields.items()}
+  paths = {msg_type: [(f, f.split('.'), column_fill_value(dtypes[msg_type][f])) for f in msg_fields] for msg_type, msg_fields in fields.items()}
+  values: dict[str, dict[str, list]] = {msg_type: {f: [] for f in ['logMonoTime', *msg_fields]} for msg_type, msg_fields in fields.items()}
+
+  for msg in lr:
+    which = msg.which()
+    if which not in values:
+      continue
+    vals = values[which]
+    vals['logMonoTime'].append(msg.logMonoTime)
+    m = getattr(msg, which)
+    for f, path, fill in paths[which]:
+      vals[f].append(_column_value(m, path, fill))
+
+  return {msg_type: {f: np.array(v, dtype=dtypes[msg_type][f]) for f, v in vals.items()} for msg_type, vals in values.items()}
+
+
+def columns_cache_path(fn: str, msg_type: str, field: str, cache_dir: str = DEFAULT_CACHE_DIR) -> str:
+  return os.path.join(cache_path_for_file_path(fn, cache_dir) + ".columns", f"{msg_type}.{field}.npy")
+
+
+def _run_on_segment(func, lr_kwargs, identifier):
+  return func(_LogFileReader(identifier, **lr_kwargs))
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -105,9 +408,16 @@ def default_valid_file(fn: LogPath) -> bool:
   return fn is not None and file_exists(fn)
 
 
+def check_files(valid_file: ValidFileCallable, files: LogPaths) -> list[bool]:
+  # checking remote files is dominated by request latency, so check them concurrently
+  with ThreadPoolExecutor(max_workers=FILE_CHECK_WORKERS) as executor:
+    return list(executor.map(valid_file, files))
+
+
 def auto_strategy(rlog_paths: LogPaths, qlog_paths: LogPaths, interactive: bool, valid_file: ValidFileCallable) -> LogPaths:
   # auto select logs based on availability
-  missing_rlogs = [rlog is None or not valid_file(rlog) for rlog in rlog_paths].count(True)
+  valid_rlogs = check_files(lambda rlog: rlog is not None and valid_file(rlog), rlog_paths)
+  missing_rlogs = valid_rlogs.count(False)
   if missing_rlogs != 0:
     if interactive:
       if input(f"{missing_rlogs}/{len(rlog_paths)} rlogs were not found, would you like to fallback to qlogs for those segments? (y/n) ").lower() != "y":
@@ -115,8 +425,9 @@ def auto_strategy(rlog_paths: LogPaths, qlog_paths: LogPaths, interactive: bool,
     else:
       cloudlog.warning(f"{missing_rlogs}/{len(rlog_paths)} rlogs were not found, falling back to qlogs for those segments...")
 
-    return [rlog if valid_file(rlog) else (qlog if valid_file(qlog) else None)
-            for (rlog, qlog) in zip(rlog_paths, qlog_paths, strict=True)]
+    missing_qlogs = [qlog for qlog, valid in zip(qlog_paths, valid_rlogs, strict=True) if not valid]
+    fallback_qlogs = iter(qlog if valid else None for qlog, valid in zip(missing_qlogs, check_files(valid_file, missing_qlogs), strict=True))
+    return [rlog if valid else next(fallback_qlogs) for rlog, valid in zip(rlog_paths, valid_rlogs, strict=True)]
   return rlog_paths
 
 
@@ -185,8 +496,8 @@ def direct_source(file_or_url: str) -> LogPaths:
 
 
 def get_invalid_files(files):
-  for f in files:
-    if f is None or not file_exists(f):
+  for f, valid in zip(files, check_files(lambda f: f is not None and file_exists(f), files), strict=True):
+    if not valid:
       yield f
 
 
@@ -197,27 +508,47 @@ def check_source(source: Source, *args) -> LogPaths:
   return files
 
 
+def first_valid_source(sources: list[Source], sr: SegmentRange, mode: ReadMode, exceptions: dict[str, Exception]) -> LogPaths | None:
+  # probe all sources concurrently, but keep their priority order
+  executor = ThreadPoolExecutor(max_workers=len(sources))
+  try:
+    futures = [executor.submit(check_source, source, sr, mode) for source in sources]
+    for source, future in zip(sources, futures, strict=True):
+      try:
+        return future.result()
+      except Exception as e:
+        exceptions[source.__name__] = e
+    return None
+  finally:
+    # don't wait on the lower priority sources
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
 def auto_source(sr: SegmentRange, mode=ReadMode.RLOG) -> LogPaths:
   if mode == ReadMode.SANITIZED:
     return comma_car_segments_source(sr, mode)
 
   SOURCES: list[Source] = [internal_source, internal_source_zst, openpilotci_source, comma_api_source, comma_car_segments_source, testing_closet_source,]
-  exceptions = {}
+  exceptions: dict[str, Exception] = {}
 
   # for automatic fallback modes, auto_source needs to first check if rlogs exist for any source
   if mode in [ReadMode.AUTO, ReadMode.AUTO_INTERACTIVE]:
-    for source in SOURCES:
-      try:
-        return check_source(source, sr, ReadMode.RLOG)
-      except Exception:
-        pass
+    files = first_valid_source(SOURCES, sr, ReadMode.RLOG, {})
+    if files is not None:
+      return files
 
   # Automatically determine viable source
-  for source in SOURCES:
-    try:
-      return check_source(source, sr, mode)
-    except Exception as e:
-      exceptions[source.__name__] = e
+  if mode == ReadMode.AUTO_INTERACTIVE:
+    # sources may prompt the user, so check them one at a time
+    for source in SOURCES:
+      try:
+        return check_source(source, sr, mode)
+      except Exception as e:
+        exceptions[source.__name__] = e
+  else:
+    files = first_valid_source(SOURCES, sr, mode, exceptions)
+    if files is not None:
+      return files
 
   raise Exception("auto_source could not find any valid source, exceptions for sources:\n  - " +
                   "\n  - ".join([f"{k}: {repr(v)}" for k, v in exceptions.items()]))
@@ -276,36 +607,68 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               default_source=auto_source, sort_by_time=False, only_union_types=False):
+               default_source=auto_source, sort_by_time=False, only_union_types=False, streaming=False, use_index=False,
+               prefetch=0, cache_dir=DEFAULT_CACHE_DIR):
     self.default_mode = default_mode
     self.default_source = default_source
     self.identifier = identifier
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    # streaming: decode segments incrementally in bounded memory, re-reading the files on every iteration
+    self.streaming = streaming
+    # use_index: keep a message type index per log in the cache, so filter() and first() only decode matching events
+    self.use_index = use_index
+    # prefetch: number of segments to download and decompress in the background while iterating
+    self.prefetch = prefetch
+    # cache_dir: where indexes are kept
+    self.cache_dir = cache_dir
 
     self.__lrs: dict[int, _LogFileReader] = {}
     self.reset()
 
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                                     streaming=self.streaming)
     return self.__lrs[i]
 
   def __iter__(self):
-    for i in range(len(self.logreader_identifiers)):
-      yield from self._get_lr(i)
+    num_segs = len(self.logreader_identifiers)
+    if self.prefetch == 0 or self.streaming:
+      for i in range(num_segs):
+        yield from self._get_lr(i)
+      return
 
-  def _run_on_segment(self, func, i):
-    return func(self._get_lr(i))
+    executor = ThreadPoolExecutor(max_workers=self.prefetch)
+    try:
+      futures = {}
+      for i in range(num_segs):
+        for j in range(i, min(i + self.prefetch + 1, num_segs)):
+          if j not in futures and j not in self.__lrs:
+            futures[j] = executor.submit(self._get_lr, j)
+        yield from (futures.pop(i).result() if i in futures else self._get_lr(i))
+    finally:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  def map_across_segments(self, num_workers, func, ordered=True, threads=False, desc=None, cache=None):
+    """Runs func on each segment in a pool of processes (or threads), yielding the results as they come in.
+    Workers only receive the log identifiers, and share downloads through the cache with cache=True. The default
+    of None follows FILEREADER_CACHE."""
+    lr_kwargs = {'sort_by_time': self.sort_by_time, 'only_union_types': self.only_union_types, 'streaming': self.streaming, 'cache': cache}
+    num_segs = len(self.logreader_identifiers)
+    with (ThreadPool if threads else multiprocessing.Pool)(num_workers) as pool:
+      imap = pool.imap if ordered else pool.imap_unordered
+      yield from tqdm.tqdm(imap(partial(_run_on_segment, func, lr_kwargs), self.logreader_identifiers), total=num_segs, desc=desc)
+
+  def reduce_across_segments(self, num_workers, func, combine, initial, ordered=True, threads=False, desc=None, cache=None):
+    return reduce(combine, self.map_across_segments(num_workers, func, ordered=ordered, threads=threads, desc=desc, cache=cache), initial)
 
   def run_across_segments(self, num_processes, func, desc=None):
-    with multiprocessing.Pool(num_processes) as pool:
-      ret = []
-      num_segs = len(self.logreader_identifiers)
-      for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, desc=desc):
-        ret.extend(p)
-      return ret
+    ret = []
+    for p in self.map_across_segments(num_processes, func, desc=desc):
+      ret.extend(p)
+    return ret
 
   def reset(self):
     self.logreader_identifiers = self._parse_identifiers(self.identifier)
@@ -314,12 +677,72 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
+  def _filter_segment(self, i, msg_type: str):
+    if self.use_index and i not in self.__lrs:
+      fn = self.logreader_identifiers[i]
+      index = load_log_index(fn, self.cache_dir)
+      if index is not None:
+        return read_indexed_events(fn, index, msg_type, sort_by_time=self.sort_by_time)
+      elif not self.streaming:
+        self._get_lr(i).save_index(self.cache_dir)
+    return (m for m in self._get_lr(i) if m.which() == msg_type)
+
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    return (getattr(m, msg_type) for i in range(len(self.logreader_identifiers)) for m in self._filter_segment(i, msg_type))
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def _segment_columns(self, i, fields: dict[str, list[str]], cache: bool) -> dict[str, dict[str, np.ndarray]]:
+    fn = self.logreader_identifiers[i]
+    if not cache:
+      return extract_columns(_LogFileReader(fn, only_union_types=True, streaming=True), fields)
+
+    # only extract the columns that aren't cached yet, in one pass
+    is_remote = resolve_name(fn).startswith(("http://", "https://"))
+    missing: dict[str, list[str]] = {}
+    for msg_type, msg_fields in fields.items():
+      for f in ['logMonoTime', *msg_fields]:
+        path = columns_cache_path(fn, msg_type, f, self.cache_dir)
+        # remote logs are immutable, local ones may be rewritten
+        if not os.path.exists(path) or (not is_remote and os.path.getmtime(path) < os.path.getmtime(fn)):
+          missing.setdefault(msg_type, []).append(f)
+
+    if len(missing):
+      extracted = extract_columns(_LogFileReader(fn, only_union_types=True, streaming=True),
+                                  {msg_type: [f for f in msg_fields if f != 'logMonoTime'] for msg_type, msg_fields in missing.items()})
+      for msg_type, msg_fields in missing.items():
+        os.makedirs(os.path.dirname(columns_cache_path(fn, msg_type, 'logMonoTime', self.cache_dir)), exist_ok=True)
+        for f in msg_fields:
+          with atomic_write_in_dir(columns_cache_path(fn, msg_type, f, self.cache_dir), mode="wb", overwrite=True) as cache_file:
+            np.save(cache_file, extracted[msg_type][f], allow_pickle=False)
+
+    return {msg_type: {f: np.load(columns_cache_path(fn, msg_type, f, self.cache_dir), mmap_mode='r') for f in ['logMonoTime', *msg_fields]}
+            for msg_type, msg_fields in fields.items()}
+
+  def to_columns(self, fields: list[str], cache: bool = False) -> dict[str, dict[str, np.ndarray]]:
+    """Returns an array per field path (e.g. "carState.vEgo") and a logMonoTime array, grouped by message type.
+    Fields behind an inactive union member are filled with NaN for floats and the type's default otherwise.
+    With cache, the columns of each log are stored in the cache directory and memory-mapped on later calls."""
+    msg_fields: dict[str, list[str]] = {}
+    for field in fields:
+      msg_type, _, path = field.partition('.')
+      assert len(path), f"invalid field path {field}, expected <msg type>.<field>"
+      column_dtype(msg_type, path.split('.'))
+      msg_fields.setdefault(msg_type, []).append(path)
+
+    segments = [self._segment_columns(i, msg_fields, cache) for i in range(len(self.logreader_identifiers))]
+    if self.sort_by_time:
+      for seg in segments:
+        for msg_type, cols in seg.items():
+          order = np.argsort(cols['logMonoTime'], kind='stable')
+          seg[msg_type] = {f: col[order] for f, col in cols.items()}
+
+    if len(segments) <= 1:
+      return segments[0] if len(segments) else extract_columns([], msg_fields)
+    return {msg_type: {f: np.concatenate([seg[msg_type][f] for seg in segments]) for f in ['logMonoTime', *msg_fields[msg_type]]}
+            for msg_type in msg_fields}
+
 
 if __name__ == "__main__":
   import codecs
@@ -1,12 +1,13 @@
 import http.server
 import os
+import random
 import shutil
 import socket
 import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.url_file import CHUNK_SIZE, DownloadCacheQuota, URLFile
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -28,11 +29,49 @@ class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
     self.end_headers()
 
 
+class RangeTestRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = random.Random(0).randbytes(int(3.5 * CHUNK_SIZE))
+  gets: list[str | None] = []
+  heads = 0
+  fail_ranges: set[str] = set()
+
+  def do_GET(self):
+    self.gets.append(self.headers.get("Range"))
+    start, end = 0, len(self.DATA) - 1
+    if "Range" in self.headers:
+      start, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+    self.send_response(206 if "Range" in self.headers else 200)
+    self.send_header("Content-Length", str(end - start + 1))
+    self.end_headers()
+    if self.headers.get("Range") in self.fail_ranges:
+      # drop the connection halfway through once
+      self.fail_ranges.remove(self.headers["Range"])
+      self.wfile.write(self.DATA[start:start + (end - start) // 2])
+      return
+    self.wfile.write(self.DATA[start:end + 1])
+
+  def do_HEAD(self):
+    RangeTestRequestHandler.heads += 1
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
 @pytest.fixture
 def host():
   with http_server_context(handler=CachingTestRequestHandler) as (host, port):
     yield f"http://{host}:{port}"
 
+
+@pytest.fixture
+def range_host():
+  RangeTestRequestHandler.gets.clear()
+  RangeTestRequestHandler.heads = 0
+  RangeTestRequestHandler.fail_ranges.clear()
+  URLFile.reset()
+  with http_server_context(handler=RangeTestRequestHandler) as (host, port):
+    yield f"http://{host}:{port}"
+
 class TestFileDownload:
 
   def test_pipeline_defaults(self, host):
@@ -128,3 +167,54 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+  def test_coalesced_chunks(self, range_host):
+    data = RangeTestRequestHandler.DATA
+    f = URLFile(f"{range_host}/test.bin", cache=True)
+    f.seek(CHUNK_SIZE // 2)
+    assert f.read(CHUNK_SIZE) == data[CHUNK_SIZE // 2:CHUNK_SIZE * 3 // 2]
+
+    # missing chunks around the cached ones are downloaded with one request per gap
+    RangeTestRequestHandler.gets.clear()
+    f.seek(0)
+    assert f.read() == data
+    assert RangeTestRequestHandler.gets == [f"bytes={2 * CHUNK_SIZE}-{len(data) - 1}"]
+
+    # hot chunks are served from memory, and readinto matches read
+    RangeTestRequestHandler.gets.clear()
+    buf = bytearray(len(data) - 100)
+    f.seek(100)
+    assert f.readinto(buf) == len(buf)
+    assert buf == data[100:]
+    assert RangeTestRequestHandler.gets == []
+
+  def test_cache_eviction(self, range_host, mocker):
+    mocker.patch.object(URLFile, "_disk_quota", DownloadCacheQuota(2 * CHUNK_SIZE))
+    f = URLFile(f"{range_host}/test.bin", cache=True)
+    assert f.read() == RangeTestRequestHandler.DATA
+
+    cache_size = sum(os.path.getsize(os.path.join(Paths.download_cache_root(), fn)) for fn in os.listdir(Paths.download_cache_root()))
+    assert cache_size <= 2 * CHUNK_SIZE
+
+  @pytest.mark.parametrize("cache_enabled", [True, False])
+  def test_parallel_ranges(self, range_host, mocker, cache_enabled):
+    mocker.patch("openpilot.tools.lib.url_file.PARALLEL_DOWNLOAD_SIZE", CHUNK_SIZE)
+    data = RangeTestRequestHandler.DATA
+    ranges = [f"bytes={start}-{min(start + CHUNK_SIZE, len(data)) - 1}" for start in range(0, len(data), CHUNK_SIZE)]
+    RangeTestRequestHandler.fail_ranges.add(ranges[1])
+
+    f = URLFile(f"{range_host}/test.bin", cache=cache_enabled)
+    if not cache_enabled:
+      # the length isn't known yet, so a full read is a single request without a HEAD
+      result = f.read()
+      assert result == data
+      assert isinstance(result, bytes)
+      assert RangeTestRequestHandler.gets == [None]
+      assert RangeTestRequestHandler.heads == 0
+      RangeTestRequestHandler.gets.clear()
+      f.get_length()
+      f.seek(0)
+
+    assert f.read() == data
+    assert sorted(RangeTestRequestHandler.gets) == sorted([*ranges, ranges[1]])
+    assert RangeTestRequestHandler.heads == 1
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import av
+import numpy as np
+import pytest
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.framereader import FrameCache, FrameReader, decompress_video_data, frame_shape
+from openpilot.tools.lib.vidindex import hevc_index
+
+W, H = 320, 240
+GOP_SIZE = 20
+FRAME_COUNT = 100
+PIX_FMTS = ["yuv420p", "nv12", "rgb24", "yuv444p"]
+FRAME_SIZE = W * H * 3
+
+
+@pytest.fixture(scope="module")
+def video():
+  with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+    container = av.open(f.name, "w", format="hevc")
+    stream = container.add_stream("libx265", rate=20)
+    stream.width, stream.height, stream.pix_fmt = W, H, "yuv420p"
+    stream.options = {"x265-params": f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:bframes=0:scenecut=0:log-level=error"}
+    for i in range(FRAME_COUNT):
+      img = np.zeros((H, W, 3), dtype=np.uint8)
+      img[:, :, 0] = i * 2
+      img[i:i+20, 2*i:2*i+20, 1] = 255
+      container.mux(stream.encode(av.VideoFrame.from_ndarray(img, format="rgb24")))
+    container.mux(stream.encode())
+    container.close()
+
+    frame_types, dat_len, prefix = hevc_index(f.name)
+    yield f.name, {
+      'index': np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32),
+      'global_prefix': prefix,
+      'probe': {'streams': [{'width': W, 'height': H}]},
+    }
+
+
+class TestFrameReader:
+  @pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+  @pytest.mark.parametrize("pix_fmt", PIX_FMTS)
+  def test_decoders_match(self, mocker, video, pix_fmt):
+    fr = FrameReader(video[0], index_data=video[1])
+    gops = [fr.get_gop(num)[3] for num in range(0, FRAME_COUNT, GOP_SIZE)]
+    decoded = [decompress_video_data(rawdat, "hevc", W, H, pix_fmt) for rawdat in gops]
+    assert all(frames.shape[0] == GOP_SIZE for frames in decoded)
+
+    # the ffmpeg cli output is the reference
+    mocker.patch.object(framereader, "av", None)
+    for rawdat, frames in zip(gops, decoded, strict=True):
+      assert np.array_equal(frames, decompress_video_data(rawdat, "hevc", W, H, pix_fmt))
+
+  @pytest.mark.parametrize("pix_fmt", PIX_FMTS)
+  def test_readahead(self, video, pix_fmt):
+    with FrameReader(video[0], index_data=video[1], frame_cache=FrameCache(FRAME_SIZE * FRAME_COUNT)) as fr:
+      expected = fr.get(0, FRAME_COUNT, pix_fmt=pix_fmt)
+
+    with FrameReader(video[0], index_data=video[1], readahead=True, frame_cache=FrameCache(FRAME_SIZE * FRAME_COUNT)) as fr:
+      for num in range(0, FRAME_COUNT, 7):
+        count = min(7, FRAME_COUNT - num)
+        for i, frame in enumerate(fr.get(num, count, pix_fmt=pix_fmt)):
+          assert np.array_equal(frame, expected[num + i])
+      assert not fr.pending_gops
+
+  def test_frame_cache_budget(self):
+    cache = FrameCache(10 * FRAME_SIZE)
+    for i in range(15):
+      cache.put(("a", i, "rgb24"), np.full(frame_shape(W, H, "rgb24"), i, dtype=np.uint8))
+    cache.get(("a", 5, "rgb24"))
+    cache.put(("a", 15, "rgb24"), np.zeros(frame_shape(W, H, "rgb24"), dtype=np.uint8))
+
+    assert cache.size == 10 * FRAME_SIZE
+    assert ("a", 5, "rgb24") in cache
+    assert ("a", 6, "rgb24") not in cache
+    assert ("b", 14, "rgb24") not in cache and ("a", 14, "yuv420p") not in cache
+    assert np.all(cache.get(("a", 14, "rgb24")) == 14)
+
+  def test_shared_frame_cache(self, mocker, video):
+    decode = mocker.spy(framereader, "decompress_video_data")
+    cache = FrameCache(FRAME_SIZE * FRAME_COUNT)
+    frames = FrameReader(video[0], index_data=video[1], frame_cache=cache).get(0, FRAME_COUNT, pix_fmt="rgb24")
+    assert decode.call_count == FRAME_COUNT // GOP_SIZE
+
+    for frame, cached in zip(frames, FrameReader(video[0], index_data=video[1], frame_cache=cache).get(0, FRAME_COUNT, pix_fmt="rgb24"), strict=True):
+      assert np.shares_memory(frame, cached)
+      # each cached frame owns its bytes instead of keeping its decoded GOP alive
+      assert cached.base is None and not cached.flags.writeable
+    assert decode.call_count == FRAME_COUNT // GOP_SIZE
+
+  def test_frame_cache_spill(self, mocker, video):
+    decode = mocker.spy(framereader, "decompress_video_data")
+    with tempfile.TemporaryDirectory() as spill_dir:
+      cache = FrameCache(GOP_SIZE * FRAME_SIZE, spill_dir)
+      frames = [np.copy(f) for f in FrameReader(video[0], index_data=video[1], frame_cache=cache).get(0, FRAME_COUNT, pix_fmt="rgb24")]
+      assert cache.size <= GOP_SIZE * FRAME_SIZE
+      assert len(os.listdir(spill_dir)) == FRAME_COUNT - GOP_SIZE
+
+      fr = FrameReader(video[0], index_data=video[1], frame_cache=FrameCache(GOP_SIZE * FRAME_SIZE, spill_dir))
+      for i in range(FRAME_COUNT - GOP_SIZE):
+        frame = fr.get(i, pix_fmt="rgb24")[0]
+        assert isinstance(frame, np.memmap)
+        assert np.array_equal(frame, frames[i])
+      assert decode.call_count == FRAME_COUNT // GOP_SIZE
@@ -1,16 +1,21 @@
+import bz2
 import capnp
 import contextlib
+import numpy as np
 import io
 import shutil
 import tempfile
+import time
 import os
 import pytest
 import requests
+import zstandard as zstd
 
 from parameterized import parameterized
 
-from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from cereal import car, log as capnp_log
+from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException, \
+                                         _LogFileReader, auto_source, log_index_path
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
 
@@ -24,6 +29,10 @@ def noop(segment: LogIterable):
   return segment
 
 
+def log_mono_times(segment: LogIterable):
+  return [m.logMonoTime for m in segment]
+
+
 @contextlib.contextmanager
 def setup_source_scenario(mocker, is_internal=False):
   internal_source_mock = mocker.patch("openpilot.tools.lib.logreader.internal_source")
@@ -255,3 +264,207 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_streaming(self, mocker, ext):
+    mocker.patch("openpilot.tools.lib.logreader.STREAM_READ_SIZE", 1000)
+    msgs = []
+    for i in range(2000):
+      msg = capnp_log.Event.new_message(logMonoTime=i)
+      msg.init("carState").vEgo = i
+      msgs.append(msg.to_bytes())
+    dat = b"".join(msgs)
+    if ext == ".bz2":
+      # multiple concatenated streams
+      dat = bz2.compress(dat[:len(dat) // 2]) + bz2.compress(dat[len(dat) // 2:])
+    elif ext == ".zst":
+      dat = zstd.compress(dat)
+
+    with tempfile.NamedTemporaryFile(suffix=ext) as log:
+      with open(log.name, "wb") as f:
+        f.write(dat)
+
+      lr = LogReader(log.name)
+      lr_streaming = LogReader(log.name, streaming=True)
+      expected = [(m.logMonoTime, m.carState.vEgo) for m in lr]
+      assert len(expected) == 2000
+      # ensure re-iteration works
+      for _ in range(2):
+        assert [(m.logMonoTime, m.carState.vEgo) for m in lr_streaming] == expected
+      assert len(list(lr_streaming.filter("carState"))) == 2000
+
+  def test_streaming_truncated(self, mocker):
+    mocker.patch("openpilot.tools.lib.logreader.STREAM_READ_SIZE", 100)
+    with tempfile.NamedTemporaryFile() as log:
+      with open(log.name, "wb") as f:
+        f.write(b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(100))[:-3])
+
+      with pytest.warns(RuntimeWarning, match="Corrupted events detected"):
+        msgs = list(LogReader(log.name, streaming=True))
+      assert [m.logMonoTime for m in msgs] == list(range(99))
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_index(self, mocker, ext):
+    msgs = []
+    for i in range(3000):
+      msg = capnp_log.Event.new_message(logMonoTime=3000 - i)
+      if i % 100 == 0:
+        msg.init("carParams").carFingerprint = str(i)
+      else:
+        msg.init("carState").vEgo = i
+      msgs.append(msg.to_bytes())
+    dat = b"".join(msgs)
+    if ext == ".bz2":
+      dat = bz2.compress(dat)
+    elif ext == ".zst":
+      # multiple frames, some events span frame boundaries
+      dat = b"".join(zstd.compress(dat[i:i + 4096]) for i in range(0, len(dat), 4096))
+
+    with tempfile.NamedTemporaryFile(suffix=ext) as log, tempfile.TemporaryDirectory() as cache_dir:
+      with open(log.name, "wb") as f:
+        f.write(dat)
+
+      expected = [m.carFingerprint for m in LogReader(log.name).filter("carParams")]
+      assert len(expected) == 30
+
+      # first read builds the index
+      assert [m.carFingerprint for m in LogReader(log.name, use_index=True, cache_dir=cache_dir).filter("carParams")] == expected
+
+      lfr_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader", wraps=_LogFileReader)
+      lr = LogReader(log.name, use_index=True, cache_dir=cache_dir)
+      assert [m.carFingerprint for m in lr.filter("carParams")] == expected
+      assert lr.first("carParams").carFingerprint == expected[0]
+      assert len(list(lr.filter("carState"))) == 3000 - 30
+      assert len(list(lr.filter("controlsState"))) == 0
+      assert lfr_mock.call_count == 0
+      assert os.listdir(os.path.join(cache_dir, "local")) == [os.path.basename(log_index_path(log.name, cache_dir))]
+
+      sorted_fingerprints = [m.carFingerprint for m in LogReader(log.name, use_index=True, sort_by_time=True, cache_dir=cache_dir).filter("carParams")]
+      assert sorted_fingerprints == expected[::-1]
+
+  def test_prefetch(self, mocker):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      logs = []
+      for seg in range(5):
+        logs.append(os.path.join(tmpdir, f"{seg}.zst"))
+        with open(logs[-1], "wb") as f:
+          f.write(zstd.compress(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 100 + i).to_bytes() for i in range(100))))
+
+      lfr_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader", wraps=_LogFileReader)
+      lr = LogReader(logs, prefetch=2)
+      for _ in range(2):
+        assert [m.logMonoTime for m in lr] == list(range(500))
+      assert lfr_mock.call_count == 5
+
+  def test_auto_source_priority(self, mocker):
+    with tempfile.NamedTemporaryFile() as log:
+      def slow_source(sr, mode):
+        time.sleep(0.5)
+        return [log.name]
+
+      sources = {
+        "internal_source": InternalUnavailableException,
+        "internal_source_zst": InternalUnavailableException,
+        "openpilotci_source": lambda sr, mode: [None],
+        "comma_api_source": slow_source,
+        "comma_car_segments_source": lambda sr, mode: [QLOG_FILE],
+        "testing_closet_source": lambda sr, mode: [QLOG_FILE],
+      }
+      for name, side_effect in sources.items():
+        source_mock = mocker.patch(f"openpilot.tools.lib.logreader.{name}", side_effect=side_effect)
+        source_mock.__name__ = name
+
+      assert auto_source(SegmentRange(f"{TEST_ROUTE}/0")) == [log.name]
+
+  @pytest.mark.parametrize("threads", [True, False])
+  def test_map_across_segments(self, threads):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      logs = []
+      for seg in range(8):
+        logs.append(os.path.join(tmpdir, f"{seg}.bz2"))
+        with open(logs[-1], "wb") as f:
+          f.write(bz2.compress(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 100 + i).to_bytes() for i in range(100))))
+
+      lr = LogReader(logs)
+      results = list(lr.map_across_segments(4, log_mono_times, threads=threads))
+      assert results == [list(range(seg * 100, (seg + 1) * 100)) for seg in range(8)]
+
+      results = list(lr.map_across_segments(4, log_mono_times, ordered=False, threads=threads))
+      assert sorted(results) == [list(range(seg * 100, (seg + 1) * 100)) for seg in range(8)]
+
+      assert lr.reduce_across_segments(4, log_mono_times, lambda a, b: a + len(b), 0, ordered=False, threads=threads) == 800
+      assert lr.run_across_segments(4, log_mono_times) == list(range(800))
+
+  def test_map_across_segments_cache(self, mocker):
+    dat = b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(100))
+    url_file = mocker.patch("openpilot.tools.lib.filereader.URLFile")
+    url_file.return_value.__enter__.return_value.read.return_value = dat
+
+    # workers share downloads through the cache when asked to, otherwise FILEREADER_CACHE decides
+    lr = LogReader([f"https://example.com/{seg}" for seg in range(4)])
+    assert sum(lr.map_across_segments(2, lambda lr: len(list(lr)), threads=True, cache=True)) == 400
+    assert all(call.kwargs["cache"] for call in url_file.call_args_list)
+    assert url_file.call_count == 4
+
+    url_file.reset_mock()
+    assert sum(lr.map_across_segments(2, lambda lr: len(list(lr)), threads=True)) == 400
+    assert all(call.kwargs["cache"] is None for call in url_file.call_args_list)
+    assert url_file.call_count == 4
+
+  @pytest.mark.parametrize("cache", [True, False])
+  def test_to_columns(self, cache):
+    with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryDirectory() as cache_dir:
+      logs = []
+      for seg in range(2):
+        logs.append(os.path.join(tmpdir, f"{seg}.zst"))
+        msgs = []
+        for i in range(100):
+          msg = capnp_log.Event.new_message(logMonoTime=seg * 100 + i)
+          if i % 2 == 0:
+            cs = msg.init("carState")
+            cs.vEgo = i
+            cs.gearShifter = "drive"
+          else:
+            lat = msg.init("controlsState").lateralControlState
+            if i % 3 == 0:
+              pid = lat.init("pidState")
+              pid.p = i
+              pid.saturated = True
+            else:
+              lat.init("torqueState")
+          msgs.append(msg.to_bytes())
+        with open(logs[-1], "wb") as f:
+          f.write(zstd.compress(b"".join(msgs)))
+
+      fields = ["carState.vEgo", "carState.gearShifter", "controlsState.lateralControlState", "controlsState.lateralControlState.pidState.p",
+                "controlsState.lateralControlState.pidState.saturated"]
+      for _ in range(2):
+        cols = LogReader(logs, cache_dir=cache_dir).to_columns(fields, cache=cache)
+        assert set(cols) == {"carState", "controlsState"}
+        assert cols["carState"]["logMonoTime"].dtype == np.uint64
+        assert cols["carState"]["logMonoTime"].tolist() == [seg * 100 + i for seg in range(2) for i in range(0, 100, 2)]
+        assert cols["carState"]["vEgo"].tolist() == list(range(0, 100, 2)) * 2
+        assert (cols["carState"]["gearShifter"] == car.CarState.GearShifter.drive).all()
+
+        lat_types = ["pidState" if i % 3 == 0 else "torqueState" for i in range(1, 100, 2)] * 2
+        assert cols["controlsState"]["lateralControlState"].tolist() == lat_types
+        # inactive union members are filled per dtype
+        assert cols["controlsState"]["lateralControlState.pidState.p"].dtype == np.float32
+        np.testing.assert_equal(cols["controlsState"]["lateralControlState.pidState.p"], [i if i % 3 == 0 else np.nan for i in range(1, 100, 2)] * 2)
+        assert cols["controlsState"]["lateralControlState.pidState.saturated"].tolist() == [i % 3 == 0 for i in range(1, 100, 2)] * 2
+
+      assert os.path.isdir(os.path.join(cache_dir, "local")) == cache
+
+      # cached columns are memory-mapped on later loads
+      if cache:
+        cols = LogReader(logs[0], cache_dir=cache_dir).to_columns(["carState.vEgo"], cache=True)
+        assert isinstance(cols["carState"]["vEgo"], np.memmap)
+
+  @pytest.mark.parametrize("field", ["carState.buttonEvents", "carState.cruiseState", "controlsState.lateralControlState.pidState",
+                                     "carState.vEgo.value", "carState.notAField", "notAMsgType.vEgo"])
+  def test_to_columns_invalid_field(self, field):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as log:
+      log.write(zstd.compress(capnp_log.Event.new_message(logMonoTime=0).to_bytes()))
+      log.flush()
+      with pytest.raises(ValueError):
+        LogReader(log.name).to_columns([field])
@@ -0,0 +1,63 @@
+import random
+import tempfile
+import pytest
+
+from openpilot.tools.lib.vidindex import NAL_UNIT_START_CODE, HevcNalUnitType, VideoFileInvalid, hevc_index
+
+# first_slice_segment_in_pic_flag, [no_output_of_prior_pics_flag], slice_pic_parameter_set_id = 0, slice_type
+SLICE_HEADERS = {
+  HevcNalUnitType.IDR_W_RADL: (2, bytes([0b11101100])),
+  HevcNalUnitType.TRAIL_R: (1, bytes([0b11010000])),
+  HevcNalUnitType.TRAIL_N: (0, bytes([0b11100000])),
+}
+
+
+def nal_unit(rng: random.Random, nal_unit_type: HevcNalUnitType, payload: bytes = b"") -> bytes:
+  # zero-free filler can't contain a start code
+  filler = bytes(rng.randint(1, 255) for _ in range(rng.randint(0, 5000)))
+  return NAL_UNIT_START_CODE + bytes([nal_unit_type << 1, 1]) + payload + filler
+
+
+def make_hevc(seed: int) -> tuple[bytes, list[tuple[int, int]], bytes]:
+  rng = random.Random(seed)
+  dat = b"\x00"
+  prefix = b""
+  for nal_unit_type in (HevcNalUnitType.VPS_NUT, HevcNalUnitType.SPS_NUT, HevcNalUnitType.PPS_NUT):
+    nal = nal_unit(rng, nal_unit_type)
+    prefix += nal
+    dat += nal
+
+  frame_types = []
+  for i in range(200):
+    nal_unit_type = HevcNalUnitType.IDR_W_RADL if i % 20 == 0 else rng.choice([HevcNalUnitType.TRAIL_R, HevcNalUnitType.TRAIL_N])
+    slice_type, header = SLICE_HEADERS[nal_unit_type]
+    frame_types.append((slice_type, len(dat)))
+    dat += nal_unit(rng, nal_unit_type, header)
+    if rng.random() < 0.2:
+      # slice segment which isn't the first of the picture
+      dat += nal_unit(rng, nal_unit_type, b"\x40")
+    if rng.random() < 0.2:
+      dat += nal_unit(rng, HevcNalUnitType.PREFIX_SEI_NUT)
+    if rng.random() < 0.2:
+      # four byte start code
+      dat += b"\x00"
+  return dat, frame_types, prefix
+
+
+class TestVidIndex:
+  @pytest.mark.parametrize("read_size", [7, 1000, 10_000_000])
+  def test_hevc_index(self, mocker, read_size):
+    mocker.patch("openpilot.tools.lib.vidindex.INDEX_READ_SIZE", read_size)
+    dat, frame_types, prefix = make_hevc(read_size)
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(dat)
+      f.flush()
+      assert hevc_index(f.name) == (frame_types, len(dat), prefix)
+
+  def test_invalid(self):
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(b"\x00\x00\x02\x00" + bytes(100))
+      f.flush()
+      with pytest.raises(VideoFileInvalid):
+        hevc_index(f.name)
+      assert hevc_index(f.name, allow_corrupt=True) == ([], 104, b"")
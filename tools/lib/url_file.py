@@ -1,9 +1,14 @@
 import logging
 import os
 import socket
+import threading
 import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
+from urllib3.exceptions import HTTPError
 from urllib3.response import BaseHTTPResponse
 from urllib3.util import Timeout
 
@@ -12,6 +17,14 @@ from openpilot.system.hardware.hw import Paths
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+#  Disk quota of the download cache, least recently used chunks are evicted past it
+DOWNLOAD_CACHE_SIZE = int(os.getenv("FILEREADER_CACHE_SIZE", 10 * 1000 * CHUNK_SIZE))
+#  Size of the in-process cache of hot chunks
+MEMORY_CACHE_SIZE = int(os.getenv("FILEREADER_MEMORY_CACHE_SIZE", 64 * CHUNK_SIZE))
+#  Reads larger than this are split into concurrent ranged requests of this size
+PARALLEL_DOWNLOAD_SIZE = 8 * CHUNK_SIZE
+PARALLEL_DOWNLOAD_WORKERS = 8
+RANGE_RETRIES = 3
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -24,12 +37,80 @@ class URLFileException(Exception):
   pass
 
 
+class ChunkLRU:
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self.size = 0
+    self._chunks: OrderedDict[str, bytes] = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: str) -> bytes|None:
+    with self._lock:
+      data = self._chunks.get(key)
+      if data is not None:
+        self._chunks.move_to_end(key)
+      return data
+
+  def put(self, key: str, data: bytes) -> None:
+    with self._lock:
+      if key in self._chunks:
+        return
+      self._chunks[key] = data
+      self.size += len(data)
+      while self.size > self.max_size:
+        _, evicted = self._chunks.popitem(last=False)
+        self.size -= len(evicted)
+
+
+class DownloadCacheQuota:
+  """Tracks the size of a download cache directory and evicts the least recently used files past the quota.
+  The usage is only rescanned on eviction, so it's approximate when multiple processes share the directory."""
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self._usage: dict[str, int] = {}
+    self._lock = threading.Lock()
+
+  def _evict(self, root: str) -> None:
+    entries = []
+    with os.scandir(root) as it:
+      for entry in it:
+        try:
+          st = entry.stat()
+        except FileNotFoundError:
+          continue
+        entries.append((st.st_mtime, st.st_size, entry.path))
+
+    # evict down to 90% of the quota, so we don't rescan on every new chunk
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= 0.9 * self.max_size:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+    self._usage[root] = total
+
+  def add(self, root: str, size: int) -> None:
+    with self._lock:
+      if root not in self._usage:
+        self._evict(root)
+      self._usage[root] += size
+      if self._usage[root] > self.max_size:
+        self._evict(root)
+
+
 class URLFile:
   _pool_manager: PoolManager|None = None
+  _memory_cache = ChunkLRU(MEMORY_CACHE_SIZE)
+  _disk_quota = DownloadCacheQuota(DOWNLOAD_CACHE_SIZE)
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    URLFile._memory_cache = ChunkLRU(MEMORY_CACHE_SIZE)
+    URLFile._disk_quota = DownloadCacheQuota(DOWNLOAD_CACHE_SIZE)
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -41,6 +122,7 @@ class URLFile:
 
   def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None):
     self._url = url
+    self._url_hash = hash_256(url)
     self._timeout = Timeout(connect=timeout, read=timeout)
     self._pos = 0
     self._length: int|None = None
@@ -73,7 +155,7 @@ class URLFile:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
+    file_length_path = os.path.join(Paths.download_cache_root(), self._url_hash + "_length")
     if not self._force_download and os.path.exists(file_length_path):
       with open(file_length_path) as file_length:
         content = file_length.read()
@@ -82,55 +164,140 @@ class URLFile:
 
     self._length = self.get_length_online()
     if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w") as file_length:
+      with atomic_write_in_dir(file_length_path, mode="w", overwrite=True) as file_length:
         file_length.write(str(self._length))
     return self._length
 
-  def read(self, ll: int|None=None) -> bytes:
+  def _chunk_path(self, chunk_number: int) -> str:
+    #  float chunk numbers for compatibility with existing caches
+    return os.path.join(Paths.download_cache_root(), f"{self._url_hash}_{float(chunk_number)}")
+
+  def _get_cached_chunk(self, chunk_number: int) -> bytes|None:
+    full_path = self._chunk_path(chunk_number)
+    data = URLFile._memory_cache.get(full_path)
+    if data is not None:
+      return data
+
+    try:
+      with open(full_path, "rb") as cached_file:
+        data = cached_file.read()
+      #  keep track of recently used chunks for eviction
+      os.utime(full_path)
+    except FileNotFoundError:
+      return None
+    URLFile._memory_cache.put(full_path, data)
+    return data
+
+  def _download_chunks(self, first_chunk: int, end_chunk: int) -> list[bytes]:
+    #  download consecutive missing chunks in a single request
+    self._pos = first_chunk * CHUNK_SIZE
+    data = memoryview(self.read_aux(ll=(end_chunk - first_chunk) * CHUNK_SIZE))
+
+    chunks = []
+    for i, chunk_number in enumerate(range(first_chunk, end_chunk)):
+      chunk = bytes(data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE])
+      full_path = self._chunk_path(chunk_number)
+      with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
+        new_cached_file.write(chunk)
+      URLFile._disk_quota.add(Paths.download_cache_root(), len(chunk))
+      URLFile._memory_cache.put(full_path, chunk)
+      chunks.append(chunk)
+    return chunks
+
+  def _read_cached(self, file_begin: int, file_end: int) -> Iterator[memoryview]:
+    if file_begin >= file_end:
+      return
+
+    #  We have to align with chunks we store
+    chunk_number = file_begin // CHUNK_SIZE
+    last_chunk = (file_end - 1) // CHUNK_SIZE
+    while chunk_number <= last_chunk:
+      data = self._get_cached_chunk(chunk_number)
+      if data is not None:
+        chunks = [data]
+      else:
+        end_chunk = chunk_number + 1
+        while end_chunk <= last_chunk and not os.path.exists(self._chunk_path(end_chunk)):
+          end_chunk += 1
+        chunks = self._download_chunks(chunk_number, end_chunk)
+
+      for data in chunks:
+        position = chunk_number * CHUNK_SIZE
+        yield memoryview(data)[max(0, file_begin - position):min(CHUNK_SIZE, file_end - position)]
+        chunk_number += 1
+
+  def _cached_range(self, ll: int|None) -> tuple[int, int]:
+    length = self.get_length()
+    assert length != -1, f"Remote file is empty or doesn't exist: {self._url}"
+    file_end = min(self._pos + ll, length) if ll is not None else length
+    return self._pos, max(self._pos, file_end)
+
+  def read(self, ll: int|None=None) -> bytes|bytearray:
     if self._force_download:
       return self.read_aux(ll=ll)
 
-    file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    file_begin, file_end = self._cached_range(ll)
+    response = b"".join(self._read_cached(file_begin, file_end))
+    self._pos = file_end
+    return response
 
-  def read_aux(self, ll: int|None=None) -> bytes:
+  def readinto(self, buf) -> int:
+    view = memoryview(buf).cast('B')
+    if self._force_download:
+      data = self.read_aux(ll=len(view))
+      view[:len(data)] = data
+      return len(data)
+
+    file_begin, file_end = self._cached_range(len(view))
+    n = 0
+    for data in self._read_cached(file_begin, file_end):
+      view[n:n + len(data)] = data
+      n += len(data)
+    self._pos = file_end
+    return n
+
+  def _download_ranges(self, view: memoryview, start: int) -> None:
+    #  download into view from start in concurrent ranged requests, retrying failed ranges individually
+    def download(range_start: int) -> None:
+      range_end = min(range_start + PARALLEL_DOWNLOAD_SIZE, start + len(view))
+      headers = {'Range': f"bytes={range_start}-{range_end - 1}"}
+      error: Exception|None = None
+      for _ in range(RANGE_RETRIES):
+        try:
+          response = self._request('GET', self._url, headers=headers)
+          if response.status == 206 and len(response.data) == range_end - range_start:
+            view[range_start - start:range_end - start] = response.data
+            return
+          error = URLFileException(f"Error, requested range but got unexpected response {response.status} {headers} ({self._url}): " +
+                                   f"{repr(response.data)[:500]}")
+        except HTTPError as e:
+          error = e
+      assert error is not None
+      raise error
+
+    with ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOAD_WORKERS) as executor:
+      list(executor.map(download, range(start, start + len(view), PARALLEL_DOWNLOAD_SIZE)))
+
+  def read_aux(self, ll: int|None=None) -> bytes|bytearray:
     download_range = False
     headers = {}
-    if self._pos != 0 or ll is not None:
+    #  full reads are only split up when the length is already known, finding it out would cost a HEAD request
+    if self._pos != 0 or ll is not None or (self._length is not None and self._length > PARALLEL_DOWNLOAD_SIZE):
       if ll is None:
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
 
+      if end + 1 - self._pos > PARALLEL_DOWNLOAD_SIZE:
+        ret = bytearray(end + 1 - self._pos)
+        self._download_ranges(memoryview(ret), self._pos)
+        self._pos += len(ret)
+        return ret
+
     if self._debug:
       t1 = time.time()
 
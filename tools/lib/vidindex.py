@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import argparse
+import itertools
 import os
 import struct
+from collections.abc import Iterator
 from enum import IntEnum
 
 from openpilot.tools.lib.filereader import FileReader
+from openpilot.tools.lib.url_file import CHUNK_SIZE
 
 DEBUG = int(os.getenv("DEBUG", "0"))
 
@@ -17,6 +20,7 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+INDEX_READ_SIZE = 4 * CHUNK_SIZE
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -258,38 +262,69 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
-def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
-  with FileReader(hevc_file_name) as f:
-    dat = f.read()
-
-  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
-    raise VideoFileInvalid("data is too short")
-
-  if dat[0] != 0x00:
-    raise VideoFileInvalid("first byte must be 0x00")
+def iter_hevc_nal_units(chunks: Iterator[bytes]) -> Iterator[tuple[int, memoryview]]:
+  # yields the start index and data of each NAL unit, only buffering the current NAL unit
+  # the start code can't occur inside a NAL unit (emulation prevention), so a plain byte search finds the boundaries
+  buf = b""
+  buf_offset = 0
+  nal_unit_start = 1 # skip past first byte 0x00
+  search = nal_unit_start + NAL_UNIT_START_CODE_SIZE
+  for chunk in chunks:
+    # a start code can span chunks
+    search = max(search, buf_offset + len(buf) - (NAL_UNIT_START_CODE_SIZE - 1))
+    drop = min(nal_unit_start - buf_offset, len(buf))
+    buf = buf[drop:] + chunk
+    buf_offset += drop
+
+    while (pos := buf.find(NAL_UNIT_START_CODE, search - buf_offset)) != -1:
+      yield nal_unit_start, memoryview(buf)[nal_unit_start - buf_offset:pos]
+      nal_unit_start = buf_offset + pos
+      search = nal_unit_start + NAL_UNIT_START_CODE_SIZE
+
+  if nal_unit_start < buf_offset + len(buf):
+    yield nal_unit_start, memoryview(buf)[nal_unit_start - buf_offset:]
 
-  prefix_dat = b""
+def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  dat_len = 0
+  def read_chunks(f) -> Iterator[bytes]:
+    nonlocal dat_len
+    while chunk := f.read(INDEX_READ_SIZE):
+      dat_len += len(chunk)
+      yield chunk
+
+  prefix_dat = []
   frame_types = list()
 
-  i = 1 # skip past first byte 0x00
-  try:
-    while i < len(dat):
-      require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
-      nal_unit_type = get_hevc_nal_unit_type(dat, i)
-      if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
-      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
-        slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
-        if is_first_slice:
-          frame_types.append((slice_type, i))
-      i += nal_unit_len
-  except Exception as e:
-    if not allow_corrupt:
-      raise
-    print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
-
-  return frame_types, len(dat), prefix_dat
+  with FileReader(hevc_file_name) as f:
+    chunks = read_chunks(f)
+    first_chunk = next(chunks, b"")
+    if len(first_chunk) < NAL_UNIT_START_CODE_SIZE + 1:
+      raise VideoFileInvalid("data is too short")
+
+    if first_chunk[0] != 0x00:
+      raise VideoFileInvalid("first byte must be 0x00")
+
+    i = 1 # skip past first byte 0x00
+    try:
+      require_nal_unit_start(first_chunk, i)
+      for i, nal_unit in iter_hevc_nal_units(itertools.chain([first_chunk], chunks)):
+        if DEBUG:
+          print("  nal_unit_len:", len(nal_unit))
+        nal_unit_type = get_hevc_nal_unit_type(nal_unit, 0)
+        if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+          prefix_dat.append(bytes(nal_unit))
+        elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
+          slice_type, is_first_slice = get_hevc_slice_type(nal_unit, 0, nal_unit_type)
+          if is_first_slice:
+            frame_types.append((slice_type, i))
+    except Exception as e:
+      if not allow_corrupt:
+        raise
+      print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
+      for _ in chunks:
+        pass
+
+  return frame_types, dat_len, b"".join(prefix_dat)
 
 def main() -> None:
   parser = argparse.ArgumentParser()